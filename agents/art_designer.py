@@ -1,56 +1,262 @@
 from models.character import Character
 from models.story import Scene
-import requests
 import os
-from typing import Optional
-from datetime import datetime
-from services.sd_service import SDService
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import time
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Union
+from services.sd_service import PreviewCallback, SDService
+from services.workflow_templates import upgrade_workflow
+from services.render_cache import RenderCache
+from services.image_transfer import ImageTransfer
+from services.image_derivatives import DerivativeStore
+from services.metrics import STAGE_SECONDS
+from config import CONFIG
 from agents.prompt_engineer import PromptEngineer
 
 class ArtDesigner:
-    def __init__(self, comfyui_api_url: str):
+    def __init__(self, comfyui_api_url: Union[str, Sequence[str], None] = None, render_cache: Optional[RenderCache] = None,
+                 image_transfer: Optional[ImageTransfer] = None,
+                 derivatives: Optional[DerivativeStore] = None):
         self.sd_service = SDService(api_url=comfyui_api_url)
         self.prompt_engineer = PromptEngineer()
         self.output_dir = "static/images"
         os.makedirs(self.output_dir, exist_ok=True)
+        self.render_cache = render_cache or RenderCache(self.output_dir)
+        # 流式下载或（与 ComfyUI 同机时）直接链接输出文件
+        self.image_transfer = image_transfer or ImageTransfer(
+            CONFIG["comfyui"].get("output_dir"),
+            chunk_size=CONFIG["comfyui"].get("transfer_chunk_size", 256 * 1024),
+            local_node=self.sd_service.api_url
+        )
+        # 网页派生图（WebP/AVIF/JPEG 缩略图），eager 模式下渲染完成即在后台生成
+        self.derivatives = derivatives
     
-    def generate_scene_image(self, scene: Scene, character: Character) -> Optional[str]:
+    def generate_scene_image(self, scene: Scene, character: Character, preset: Optional[str] = None) -> Optional[str]:
         """生成场景图片"""
+        result = self.render_scene(scene, character, preset)
+        return result["image_path"] if result else None
+
+    def render_scene(self, scene: Scene, character: Character, preset: Optional[str] = None,
+                     on_preview: Optional[PreviewCallback] = None,
+                     quality: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        生成场景图片并返回渲染信息：
+        image_path、cache（"hit"/"miss"）、render_seconds（本次或原始渲染耗时），
+        未命中缓存时还有 transfer（http/hardlink/reflink）、transfer_bytes、transfer_seconds，
+        以及 cached_nodes（ComfyUI 从缓存复用、没有重新执行的工作流节点）；
+        草稿质量时 latent 为保存的首遍潜在图（ComfyUI 上的位置）。
+        preset 为工作流风格预设名，为空时使用默认预设；on_preview 接收渲染途中的预览（命中缓存时不调用）
+        """
         try:
-            # 使用 PromptEngineer 生成提示词
-            scene_elements = {
-                'description': scene.description,
-                'title': scene.title,
-                'image_prompt': scene.image_prompt
-            }
-            
-            # 获取正向和负向提示词，传入角色信息
-            full_prompt = self.prompt_engineer.generate_scene_prompt(scene_elements, character)
-            negative_prompt = self.prompt_engineer.generate_negative_prompt()
-            
-            # 生成图片
-            image_path = self.sd_service.generate_image(
-                prompt=full_prompt,
-                negative_prompt=negative_prompt,
-                width=1000,
-                height=600,
-                steps=20
-            )
-            
-            if not image_path:
-                print("Error: Failed to generate image")
-                return None
-            
-            # 保存图片
-            safe_title = ''.join(e for e in scene.title if e.isalnum() or e in ('_', '-'))
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            output_path = os.path.join(self.output_dir, f"scene_{safe_title}_{timestamp}.png")
-            
-            with open(output_path, "wb") as f:
-                f.write(requests.get(f"{self.sd_service.api_url}/view?filename={image_path}").content)
-            
-            return output_path
-            
+            graph = self.scene_workflow(scene, character, preset, quality)
+            return self._render_graph(graph, on_preview)
         except Exception as e:
             print(f"Error generating scene image: {str(e)}")
-            return None 
\ No newline at end of file
+            return None
+
+    def upgrade_scene(self, scene: Scene, character: Character, preset: Optional[str] = None,
+                      latent: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """
+        把草稿场景升级为最终质量：有草稿潜在图时在保存它的节点上只补做高清修复第二遍，
+        潜在图不可用（节点已宕机、文件已删除等）时退回完整渲染。
+        返回 render_scene 的渲染信息，另有 upgraded（"latent" / "rerender"）
+        """
+        if latent:
+            try:
+                graph = upgrade_workflow(self.scene_workflow(scene, character, preset, "final"), latent)
+                result = self._render_graph(graph, node=latent.get("node")) if graph else None
+                if result:
+                    return dict(result, upgraded="latent")
+                print(f"Upgrading from draft latent failed, re-rendering scene: {scene.title}")
+            except Exception as e:
+                print(f"Error upgrading scene image: {str(e)}")
+        result = self.render_scene(scene, character, preset, quality="final")
+        return dict(result, upgraded="rerender") if result else None
+
+    def scene_workflow(self, scene: Scene, character: Character, preset: Optional[str] = None,
+                       quality: Optional[str] = None) -> Dict[str, Any]:
+        """为场景生成提示词并绑定工作流"""
+        # 使用 PromptEngineer 生成提示词
+        scene_elements = {
+            'description': scene.description,
+            'title': scene.title,
+            'image_prompt': scene.image_prompt
+        }
+
+        # 获取正向和负向提示词，传入角色信息
+        with STAGE_SECONDS.time(stage="prompt"):
+            full_prompt = self.prompt_engineer.generate_scene_prompt(scene_elements, character)
+            negative_prompt = self.prompt_engineer.generate_negative_prompt()
+
+        return self.sd_service.build_workflow(
+            prompt=full_prompt,
+            negative_prompt=negative_prompt,
+            width=1000,
+            height=600,
+            preset=preset,
+            quality=quality
+        )
+
+    def _render_graph(self, graph: Dict[str, Any], on_preview: Optional[PreviewCallback] = None,
+                      node: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        # 相同的图直接复用之前的渲染结果
+        cache_key = self.render_cache.key_for(graph)
+        cached = self.render_cache.get(cache_key)
+        if cached:
+            self._schedule_derivatives(cached["image_path"])
+            return {"image_path": cached["image_path"], "cache": "hit",
+                    "render_seconds": cached["render_seconds"], "latent": cached["latent"]}
+
+        # 生成图片
+        started = time.monotonic()
+        image = self.sd_service.render_image(graph, on_preview, node=node)
+        render_seconds = round(time.monotonic() - started, 2)
+
+        if not image:
+            print("Error: Failed to generate image")
+            return None
+        STAGE_SECONDS.observe(render_seconds, stage="image_render")
+
+        # 写入临时文件后以图哈希命名原子地提交
+        tmp_path = self.render_cache.temp_path()
+        try:
+            transfer = self.image_transfer.fetch(self.sd_service.client_for(image), image, tmp_path)
+        except Exception:
+            self.render_cache.discard_temp(tmp_path)
+            raise
+        STAGE_SECONDS.observe(transfer["transfer_seconds"], stage="download")
+        output_path = self.render_cache.put_file(cache_key, tmp_path, render_seconds, image.get("latent"))
+        self._schedule_derivatives(output_path)
+
+        return dict(transfer, image_path=output_path, cache="miss", render_seconds=render_seconds,
+                    cached_nodes=image.get("cached_nodes", []), latent=image.get("latent"))
+
+    def _schedule_derivatives(self, image_path: str):
+        if self.derivatives:
+            self.derivatives.schedule(image_path)
+
+    def render_scenes(self, character: Character, max_in_flight: int = 8,
+                      preset: Optional[str] = None, quality: Optional[str] = None) -> "SceneRenderBatch":
+        """创建一个并发渲染批次，场景可以陆续提交"""
+        return SceneRenderBatch(self, character, max_in_flight, preset, quality)
+
+
+class SceneRenderBatch:
+    """
+    并发渲染一个故事的场景。
+
+    场景通过 submit() 提交后立即进入 ComfyUI 队列（最多 max_in_flight 个同时在途），
+    events() 按完成顺序产出带场景序号的进度事件，
+    ordered_images() 按故事顺序返回图片路径。
+    """
+
+    _DONE = object()
+
+    def __init__(self, art_designer: ArtDesigner, character: Character, max_in_flight: int = 8,
+                 preset: Optional[str] = None, quality: Optional[str] = None):
+        self.art_designer = art_designer
+        self.character = character
+        self.preset = preset
+        self.quality = quality
+        self.total: Optional[int] = None
+        self.image_paths: Dict[int, Optional[str]] = {}
+        self.latents: Dict[int, Optional[Dict[str, Any]]] = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.gpu_seconds_saved = 0.0
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_in_flight),
+                                            thread_name_prefix="scene-render")
+        self._events: "queue.Queue" = queue.Queue()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._submitted = 0
+        self._closed = False
+
+    def submit(self, index: int, scene: Scene):
+        """提交一个场景（index 从 0 开始）"""
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Cannot submit scenes to a closed batch")
+            self._pending += 1
+            self._submitted += 1
+        self._executor.submit(self._render, index, scene, time.monotonic())
+
+    def close(self, total: Optional[int] = None):
+        """声明不会再提交新场景"""
+        with self._lock:
+            self._closed = True
+            self.total = total if total is not None else self._submitted
+            if self._pending == 0:
+                self._events.put(self._DONE)
+
+    def _render(self, index: int, scene: Scene, submitted: float):
+        # 排队等待 = 提交后等待渲染线程空出的时间
+        STAGE_SECONDS.observe(time.monotonic() - submitted, stage="image_queue_wait")
+        try:
+            self._events.put({"status": "generating_image", "scene": index + 1, "total": self.total})
+            result = self.art_designer.render_scene(
+                scene, self.character, self.preset,
+                on_preview=lambda preview: self._events.put(
+                    dict(preview, status="scene_preview", scene=index + 1, total=self.total)),
+                quality=self.quality)
+            self.image_paths[index] = result["image_path"] if result else None
+            if result:
+                # 潜在图位置只留在服务端（升级草稿用），不放进事件
+                self.latents[index] = result.pop("latent", None)
+                with self._lock:
+                    if result["cache"] == "hit":
+                        self.cache_hits += 1
+                        self.gpu_seconds_saved += result["render_seconds"] or 0
+                    else:
+                        self.cache_misses += 1
+                self._events.put(dict(result, status="image_completed",
+                                      scene=index + 1, total=self.total))
+            else:
+                self._events.put({"status": "image_failed", "scene": index + 1,
+                                  "total": self.total, "title": scene.title})
+        finally:
+            with self._lock:
+                self._pending -= 1
+                if self._closed and self._pending == 0:
+                    self._events.put(self._DONE)
+
+    def events(self) -> Iterator[dict]:
+        """按完成顺序产出进度事件，直到批次关闭且全部场景结束"""
+        while True:
+            event = self._events.get()
+            if event is self._DONE:
+                return
+            if event.get("total") is None:
+                event["total"] = self.total
+            yield event
+
+    def poll(self) -> Iterator[dict]:
+        """不阻塞地取出当前已有的进度事件"""
+        while True:
+            try:
+                event = self._events.get_nowait()
+            except queue.Empty:
+                return
+            if event is self._DONE:
+                self._events.put(event)
+                return
+            yield event
+
+    def ordered_images(self) -> List[Optional[str]]:
+        """按故事顺序返回图片路径"""
+        return [self.image_paths.get(i) for i in range(self.total or 0)]
+
+    def ordered_latents(self) -> List[Optional[Dict[str, Any]]]:
+        """按故事顺序返回草稿潜在图位置（非草稿或命中旧缓存时为 None）"""
+        return [self.latents.get(i) for i in range(self.total or 0)]
+
+    def cache_summary(self) -> Dict[str, Any]:
+        """本批次的渲染缓存命中情况"""
+        return {"cache_hits": self.cache_hits, "cache_misses": self.cache_misses,
+                "gpu_seconds_saved": round(self.gpu_seconds_saved, 2)}
+
+    def shutdown(self):
+        """取消尚未开始的场景（例如客户端断开时）"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
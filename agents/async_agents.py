@@ -0,0 +1,373 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import aiohttp
+
+from agents.art_designer import ArtDesigner
+from agents.character_designer import CharacterDesigner
+from agents.story_creator import StoryCreator
+from models.character import Character
+from models.story import Scene, Story
+from services.async_llm_pool import AsyncLLMPool
+from services.async_sd_service import AsyncSDService
+from services.sd_service import PreviewCallback
+from services.metrics import LLM_JSON_OUTCOMES, LLM_RETRIES, STAGE_SECONDS, record_llm_usage
+from services.resilience import BackendUnavailable, Resilience
+from services.workflow_templates import upgrade_workflow
+from utils.json_stream import SceneStreamParser
+from utils.llm_json import combine_followup, response_format_rejected
+
+logger = logging.getLogger(__name__)
+
+# 以下代理只替换网络等待；提示词、解析与校验逻辑都复用对应的同步代理，
+# 缓存读写（SQLite / 磁盘）放到线程池中执行，避免阻塞事件循环。
+
+
+async def _wait_before_retry(resilience: Resilience, attempt: int, max_retries: int) -> bool:
+    """第 attempt 次尝试失败后按退避等待；已是最后一次、预算耗尽或熔断器打开时返回 False"""
+    delay = resilience.retry_delay(attempt) if attempt < max_retries - 1 else None
+    if delay is None:
+        return False
+    LLM_RETRIES.inc()
+    await asyncio.sleep(delay)
+    return True
+
+
+class AsyncCharacterDesigner:
+    def __init__(self, designer: CharacterDesigner):
+        self.designer = designer
+        self.llm = AsyncLLMPool(designer.llm)
+
+    def create_character_from_data(self, character_data) -> Optional[Character]:
+        return self.designer.create_character_from_data(character_data)
+
+    async def create_character(self, user_input: str, use_cache: bool = True) -> Optional[Character]:
+        try:
+            payload = self.designer._build_payload(user_input)
+            cache = self.designer.completion_cache
+            use_cache = use_cache and cache is not None
+            result = await asyncio.to_thread(cache.get, payload) if use_cache else None
+            from_cache = result is not None
+
+            if not from_cache:
+                if not await self.llm.is_healthy():
+                    logger.error("无法连接到 LM Studio 服务，请确保服务已启动")
+                    return None
+                result = await self._request(payload)
+                if not result:
+                    return None
+            else:
+                character, _, _ = self.designer._parse_character(result['choices'][0]['message']['content'])
+                return character
+
+            character, character_text = await self._repair_character(payload, result)
+            if character and use_cache:
+                await asyncio.to_thread(cache.put, payload,
+                                        {"choices": [{"message": {"content": character_text}}]})
+            return character
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"创建角色时发生错误: {str(e)}")
+            return None
+
+    async def _request(self, payload: dict) -> Optional[dict]:
+        """与 CharacterDesigner._request 相同的重试策略"""
+        max_retries = self.designer.max_retries
+        for attempt in range(max_retries):
+            try:
+                started = time.monotonic()
+                async with self.llm.post("/v1/chat/completions", json=payload) as response:
+                    fallback = response_format_rejected(payload, response.status)
+                    if fallback:
+                        payload = fallback
+                        continue
+                    if response.status == 200:
+                        result = json.loads(await response.text())
+                        record_llm_usage(result, time.monotonic() - started)
+                        return result
+                    logger.error(f"生成角色失败，状态码：{response.status}")
+                    if response.status < 500:
+                        return None
+            except BackendUnavailable as e:
+                logger.error(str(e))
+                return None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"角色生成请求异常 (尝试 {attempt + 1}/{max_retries}): {str(e)}")
+
+            if not await _wait_before_retry(self.llm.resilience, attempt, max_retries):
+                break
+        return None
+
+    async def _repair_character(self, payload: dict, result: dict) -> Tuple[Optional[Character], str]:
+        """与 CharacterDesigner._repair_character 相同，补救请求走异步客户端"""
+        character_text = result['choices'][0]['message']['content']
+        character, error, repaired = self.designer._parse_character(character_text)
+        outcome = "repaired" if repaired else "clean"
+        for _ in range(self.designer.json_fix_attempts if error else 0):
+            followup, truncated = self.designer._followup(payload, character_text, error, result)
+            result = await self._request(followup)
+            if not result:
+                break
+            character_text = combine_followup(character_text, result['choices'][0]['message']['content'], truncated)
+            character, error, _ = self.designer._parse_character(character_text)
+            outcome = "fixed"
+            if character:
+                break
+        if error:
+            outcome = "failed"
+            logger.error(f"解析角色JSON失败 - {error}")
+            logger.debug(f"原始响应：{character_text}")
+        LLM_JSON_OUTCOMES.inc(kind="character", outcome=outcome)
+        return character, character_text
+
+
+class AsyncStoryCreator:
+    def __init__(self, creator: StoryCreator):
+        self.creator = creator
+        self.llm = AsyncLLMPool(creator.llm)
+        self.max_retries = creator.max_retries
+
+    async def _make_api_request(self, payload: dict) -> Optional[dict]:
+        """发送API请求并处理重试逻辑"""
+        for attempt in range(self.max_retries):
+            try:
+                started = time.monotonic()
+                async with self.llm.post("/v1/chat/completions", json=payload) as response:
+                    if response.status == 200:
+                        result = json.loads(await response.text())
+                        record_llm_usage(result, time.monotonic() - started)
+                        return result
+                    fallback = response_format_rejected(payload, response.status)
+                    if fallback:
+                        payload = fallback
+                        continue
+                    logger.warning(f"API请求失败 (尝试 {attempt + 1}/{self.max_retries}): 状态码 {response.status}")
+            except BackendUnavailable as e:
+                logger.error(str(e))
+                return None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"API请求异常 (尝试 {attempt + 1}/{self.max_retries}): {str(e)}")
+
+            if not await _wait_before_retry(self.llm.resilience, attempt, self.max_retries):
+                break
+        return None
+
+    async def create_story(self, character: Character, use_cache: bool = True) -> Optional[Story]:
+        try:
+            payload = self.creator._build_payload(self.creator._build_prompt(character))
+            cache = self.creator.completion_cache
+            use_cache = use_cache and cache is not None
+            result = await asyncio.to_thread(cache.get, payload) if use_cache else None
+            from_cache = result is not None
+
+            if not from_cache:
+                if not await self.llm.is_healthy():
+                    logger.error("无法连接到 LM Studio 服务，请确保服务已启动")
+                    return None
+                result = await self._make_api_request(payload)
+                if not result:
+                    logger.error("多次尝试后仍无法生成故事")
+                    return None
+
+            story_text = result['choices'][0]['message']['content']
+            if from_cache:
+                story, _, _ = self.creator._parse_story(story_text, character)
+                return story
+            story, story_text = await self._repair_story(payload, result, story_text, character)
+            if story and use_cache:
+                await asyncio.to_thread(cache.put, payload, {"choices": [{"message": {"content": story_text}}]})
+            return story
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"故事生成过程中发生错误: {str(e)}")
+            return None
+
+    async def _repair_story(self, payload: dict, result: Optional[dict], story_text: str,
+                            character: Character) -> Tuple[Optional[Story], str]:
+        """与 StoryCreator._repair_story 相同，补救请求走异步客户端"""
+        story, error, repaired = self.creator._parse_story(story_text, character, result)
+        outcome = "repaired" if repaired else "clean"
+        for _ in range(self.creator.json_fix_attempts if error else 0):
+            followup, truncated = self.creator._followup(payload, story_text, error, result)
+            result = await self._make_api_request(followup)
+            if not result:
+                break
+            story_text = combine_followup(story_text, result['choices'][0]['message']['content'], truncated)
+            story, error, _ = self.creator._parse_story(story_text, character, result)
+            outcome = "fixed"
+            if story:
+                break
+        if error:
+            outcome = "failed"
+            logger.error(f"故事数据无效：{error}")
+            logger.debug(f"原始响应：{story_text}")
+        LLM_JSON_OUTCOMES.inc(kind="story", outcome=outcome)
+        return story, story_text
+
+    async def _stream_completion(self, payload: dict) -> AsyncIterator[str]:
+        """以流式方式请求补全，逐段产出文本；只在收到首个片段之前重试"""
+        payload = dict(payload, stream=True, stream_options={"include_usage": True})
+        for attempt in range(self.max_retries):
+            try:
+                started = time.monotonic()
+                async with self.llm.post("/v1/chat/completions", json=payload) as response:
+                    fallback = response_format_rejected(payload, response.status)
+                    if fallback:
+                        payload = fallback
+                        continue
+                    if response.status != 200:
+                        logger.warning(f"API请求失败 (尝试 {attempt + 1}/{self.max_retries}): 状态码 {response.status}")
+                    else:
+                        async for raw in response.content:
+                            line = raw.decode('utf-8').strip()
+                            if not line.startswith('data:'):
+                                continue
+                            data = line[len('data:'):].strip()
+                            if data == '[DONE]':
+                                return
+                            chunk = json.loads(data)
+                            if chunk.get('usage'):
+                                record_llm_usage(chunk, time.monotonic() - started)
+                            choices = chunk.get('choices') or [{}]
+                            content = choices[0].get('delta', {}).get('content')
+                            if content:
+                                yield content
+                        return
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"API请求异常 (尝试 {attempt + 1}/{self.max_retries}): {str(e)}")
+
+            if not await _wait_before_retry(self.llm.resilience, attempt, self.max_retries):
+                break
+        raise RuntimeError("多次尝试后仍无法生成故事")
+
+    async def stream_story(self, character: Character,
+                           use_cache: bool = True) -> AsyncIterator[Tuple[str, Any]]:
+        """与 StoryCreator.stream_story 相同的产出协议"""
+        try:
+            payload = self.creator._build_payload(self.creator._build_prompt(character))
+            cache = self.creator.completion_cache
+            use_cache = use_cache and cache is not None
+            cached = await asyncio.to_thread(cache.get, payload) if use_cache else None
+
+            if cached is not None:
+                async def replay():
+                    yield cached['choices'][0]['message']['content']
+                chunks = replay()
+            else:
+                if not await self.llm.is_healthy():
+                    logger.error("无法连接到 LM Studio 服务，请确保服务已启动")
+                    yield "story", None
+                    return
+                chunks = self._stream_completion(payload)
+
+            parser = SceneStreamParser()
+            emitted: List[Scene] = []
+            async for chunk in chunks:
+                for scene_data in parser.feed(chunk):
+                    if not self.creator._validate_scene(scene_data):
+                        logger.error("场景数据缺少必要字段")
+                        yield "story", None
+                        return
+                    scene = Scene(
+                        title=scene_data['title'],
+                        description=scene_data['description'],
+                        image_prompt=scene_data['image_prompt']
+                    )
+                    yield "scene", (len(emitted), scene)
+                    emitted.append(scene)
+
+            if cached is not None:
+                story, _, _ = self.creator._parse_story(parser.text, character)
+            else:
+                story, story_text = await self._repair_story(payload, None, parser.text, character)
+            remaining = self.creator._remaining_scenes(story, emitted) if story else []
+            if remaining is None:
+                story = None
+            for scene in remaining or []:
+                yield "scene", (len(emitted), scene)
+                emitted.append(scene)
+            if story and use_cache and cached is None:
+                await asyncio.to_thread(cache.put, payload,
+                                        {"choices": [{"message": {"content": story_text}}]})
+            yield "story", story
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"故事生成过程中发生错误: {str(e)}")
+            yield "story", None
+
+
+class AsyncArtDesigner:
+    def __init__(self, art_designer: ArtDesigner):
+        self.art_designer = art_designer
+        self.render_cache = art_designer.render_cache
+        self.image_transfer = art_designer.image_transfer
+        self.sd_service = AsyncSDService(art_designer.sd_service)
+
+    async def render_scene(self, scene: Scene, character: Character, preset: Optional[str] = None,
+                           on_preview: Optional[PreviewCallback] = None,
+                           quality: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """与 ArtDesigner.render_scene 返回相同的渲染信息"""
+        try:
+            graph = self.art_designer.scene_workflow(scene, character, preset, quality)
+            return await self._render_graph(graph, on_preview)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error generating scene image: {str(e)}")
+            return None
+
+    async def upgrade_scene(self, scene: Scene, character: Character, preset: Optional[str] = None,
+                            latent: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """与 ArtDesigner.upgrade_scene 相同：在保存草稿潜在图的节点上只补做第二遍，失败时完整渲染"""
+        if latent:
+            try:
+                graph = upgrade_workflow(self.art_designer.scene_workflow(scene, character, preset, "final"), latent)
+                result = await self._render_graph(graph, node=latent.get("node")) if graph else None
+                if result:
+                    return dict(result, upgraded="latent")
+                logger.warning(f"Upgrading from draft latent failed, re-rendering scene: {scene.title}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error upgrading scene image: {str(e)}")
+        result = await self.render_scene(scene, character, preset, quality="final")
+        return dict(result, upgraded="rerender") if result else None
+
+    async def _render_graph(self, graph: Dict[str, Any], on_preview: Optional[PreviewCallback] = None,
+                            node: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        cache_key = self.render_cache.key_for(graph)
+        cached = await asyncio.to_thread(self.render_cache.get, cache_key)
+        if cached:
+            self.art_designer._schedule_derivatives(cached["image_path"])
+            return {"image_path": cached["image_path"], "cache": "hit",
+                    "render_seconds": cached["render_seconds"], "latent": cached["latent"]}
+
+        started = time.monotonic()
+        image = await self.sd_service.render_image(graph, on_preview, node=node)
+        render_seconds = round(time.monotonic() - started, 2)
+        if not image:
+            logger.error("Failed to generate image")
+            return None
+        STAGE_SECONDS.observe(render_seconds, stage="image_render")
+
+        tmp_path = self.render_cache.temp_path()
+        try:
+            transfer = await self.image_transfer.fetch_async(self.sd_service.client_for(image), image, tmp_path)
+        except BaseException:
+            self.render_cache.discard_temp(tmp_path)
+            raise
+        STAGE_SECONDS.observe(transfer["transfer_seconds"], stage="download")
+        output_path = await asyncio.to_thread(self.render_cache.put_file, cache_key, tmp_path,
+                                              render_seconds, image.get("latent"))
+        self.art_designer._schedule_derivatives(output_path)
+        return dict(transfer, image_path=output_path, cache="miss", render_seconds=render_seconds,
+                    cached_nodes=image.get("cached_nodes", []), latent=image.get("latent"))
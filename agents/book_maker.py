@@ -1,30 +1,114 @@
 from models.story import Story
 from PIL import Image
 import textwrap
+from reportlab import rl_config
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import inch
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 import os
-from typing import List
+import hashlib
+import logging
+import multiprocessing
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Optional, Tuple
 from datetime import datetime
 
+logger = logging.getLogger(__name__)
+
+# PDF 是二进制文件，不需要把 JPEG 等数据流再做 ASCII85 编码（会增大约 25%）
+rl_config.useA85 = 0
+
 class BookMaker:
-    def __init__(self):
+    def __init__(self,
+                 image_dpi: int = 150,
+                 jpeg_quality: int = 85,
+                 image_cache_dir: str = "output/cache/book_images",
+                 workers: int = 2):
         self.page_size = A4
         self.margin = inch
         self.line_height = 14
         self.font_size = 12
         self.output_dir = "output/books"
         self.image_dir = "static/images"  # 添加图片目录
+        # 嵌入 PDF 前把图片缩到版面尺寸对应的分辨率并编码为 JPEG（DCT），
+        # 结果按原图内容哈希缓存，重建同一本书时直接复用
+        self.image_dpi = image_dpi
+        self.jpeg_quality = jpeg_quality
+        self.image_cache_dir = image_cache_dir
+        self.workers = workers
         os.makedirs(self.output_dir, exist_ok=True)
+        os.makedirs(self.image_cache_dir, exist_ok=True)
+        self._executor: Optional[Executor] = None
+        # 进程池损坏后不再 fork：此时进程内已有其他线程，子进程可能继承被占用的锁而死锁
+        self._pool_broken = False
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # 提交到工作进程时只需要排版参数
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        state["_lock"] = None
+        return state
+
+    @property
+    def executor(self) -> Executor:
+        """
+        排版用的进程池：Pillow 解码和 reportlab 压缩不再占用本进程的 GIL。
+        只在支持 fork 的平台上使用进程（spawn 会在子进程中重新导入 app.py），
+        否则退回线程池；进程池损坏后也一直使用线程池。
+        """
+        with self._lock:
+            if self._executor is None:
+                if (self.workers > 0 and not self._pool_broken
+                        and "fork" in multiprocessing.get_all_start_methods()):
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers, mp_context=multiprocessing.get_context("fork"))
+                else:
+                    self._executor = ThreadPoolExecutor(max_workers=max(1, self.workers),
+                                                        thread_name_prefix="book")
+            return self._executor
+
+    def _discard_executor(self, executor: Executor):
+        """进程池损坏（工作进程被杀等）后关闭并丢弃它，下次访问 executor 时改用线程池"""
+        with self._lock:
+            self._pool_broken = True
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def start_pool(self):
+        """提前启动工作进程（应在启动其他线程之前调用，fork 时进程内只有主线程）"""
+        self.executor.submit(int).result()
+
+    def start_book(self) -> "BookAssembly":
+        return BookAssembly(self)
         
     def create_book(self, story: Story, images: List[str]) -> str:
+        book = self.build_book(story, images)
+        return book["book_path"] if book else ""
+
+    def build_book(self, story: Story, images: List[str],
+                   pages: Optional[Dict[str, Dict[str, Any]]] = None) -> Optional[Dict[str, Any]]:
+        """
+        生成绘本，返回 PDF 路径及文件大小、耗时、图片统计；失败时返回 None。
+        pages 为 prepare_page() 提前准备好的场景页（以图片路径为键），其余场景在此处理。
+        """
         try:
+            started = time.monotonic()
+            stats = {"images": 0, "unique_images": 0, "image_cache_hits": 0, "prepared_ahead": 0,
+                     "source_image_bytes": 0, "embedded_image_bytes": 0, "prepare_seconds": 0.0}
+            embedded = set()
             # 生成PDF文件名
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            pdf_path = os.path.join(self.output_dir, f"story_{timestamp}.pdf")
+            # 同一秒内完成的多本书不能互相覆盖
+            pdf_path = os.path.join(self.output_dir, f"story_{timestamp}_{uuid.uuid4().hex[:8]}.pdf")
             
             # 创建PDF
             c = canvas.Canvas(pdf_path, pagesize=self.page_size)
@@ -50,21 +134,22 @@ class BookMaker:
                 image_filename = os.path.basename(image_path)  # 从URL路径中提取文件名
                 image_filepath = os.path.join(self.image_dir, image_filename)  # 构建实际的文件路径
                 
-                if os.path.exists(image_filepath):
-                    img = Image.open(image_filepath)
-                    # 调整图片大小以适应页面
-                    img_width, img_height = img.size
-                    max_width = self.page_size[0] - 2 * self.margin
-                    max_height = self.page_size[1] / 2
-                    
-                    scale = min(max_width / img_width, max_height / img_height)
-                    new_width = img_width * scale
-                    new_height = img_height * scale
-                    
-                    # 居中显示图片
-                    x = (self.page_size[0] - new_width) / 2
-                    y = self.page_size[1] - self.margin - new_height
-                    c.drawImage(image_filepath, x, y, width=new_width, height=new_height)
+                page = (pages or {}).get(image_path)
+                if page:
+                    stats["prepared_ahead"] += 1
+                elif os.path.exists(image_filepath):
+                    page = self.prepare_page(image_path)
+                if page:
+                    for key, value in page["stats"].items():
+                        stats[key] += value
+                    x, y, new_width, new_height = page["box"]
+                    # 同一内容的图片对应同一个预处理文件，ReportLab 只嵌入一次（同一个 XObject）
+                    prepared_path = page["prepared_path"]
+                    if prepared_path not in embedded:
+                        embedded.add(prepared_path)
+                        stats["unique_images"] += 1
+                        stats["embedded_image_bytes"] += os.path.getsize(prepared_path)
+                    c.drawImage(prepared_path, x, y, width=new_width, height=new_height)
                 else:
                     print(f"警告：找不到图片文件 {image_filepath}")
                 
@@ -88,12 +173,81 @@ class BookMaker:
                 y -= self.line_height
             
             # 保存PDF
+            save_started = time.monotonic()
             c.save()
-            return pdf_path
+            stats.update(
+                book_path=pdf_path,
+                book_bytes=os.path.getsize(pdf_path),
+                save_seconds=round(time.monotonic() - save_started, 3),
+                build_seconds=round(time.monotonic() - started, 3),
+                prepare_seconds=round(stats["prepare_seconds"], 3)
+            )
+            return stats
             
         except Exception as e:
             print(f"创建绘本时发生错误: {str(e)}")
-            return ""
+            return None
+
+    def prepare_page(self, image_path: str) -> Optional[Dict[str, Any]]:
+        """
+        预处理一个场景页：计算图片版面位置，并把图片缩放、编码为 JPEG。
+        可以在工作进程中执行，图片不存在时返回 None。
+        """
+        image_filepath = os.path.join(self.image_dir, os.path.basename(image_path))
+        if not os.path.exists(image_filepath):
+            return None
+        stats = {"images": 0, "image_cache_hits": 0, "source_image_bytes": 0, "prepare_seconds": 0.0}
+        with Image.open(image_filepath) as img:
+            # 调整图片大小以适应页面
+            img_width, img_height = img.size
+        max_width = self.page_size[0] - 2 * self.margin
+        max_height = self.page_size[1] / 2
+        
+        scale = min(max_width / img_width, max_height / img_height)
+        new_width = img_width * scale
+        new_height = img_height * scale
+        
+        # 居中显示图片
+        x = (self.page_size[0] - new_width) / 2
+        y = self.page_size[1] - self.margin - new_height
+        prepared_path = self._prepare_image(image_filepath, new_width, new_height, stats)
+        return {"prepared_path": prepared_path, "box": (x, y, new_width, new_height), "stats": stats}
+
+    def _prepare_image(self, image_filepath: str, width: float, height: float,
+                       stats: Dict[str, Any]) -> str:
+        """按 image_dpi 把图片缩放到版面尺寸（单位：点）并编码为 JPEG，返回缓存文件路径"""
+        started = time.monotonic()
+        with open(image_filepath, 'rb') as f:
+            data = f.read()
+        stats["images"] += 1
+        stats["source_image_bytes"] += len(data)
+        digest = hashlib.sha256(data).hexdigest()[:32]
+
+        with Image.open(image_filepath) as img:
+            size = self._target_size(img.size, width, height)
+            path = os.path.join(self.image_cache_dir,
+                                f"{digest}_{size[0]}x{size[1]}_q{self.jpeg_quality}.jpg")
+            if os.path.exists(path):
+                stats["image_cache_hits"] += 1
+            else:
+                img = img.convert('RGB')
+                if img.size != size:
+                    img = img.resize(size, Image.Resampling.LANCZOS)
+                fd, tmp_path = tempfile.mkstemp(dir=self.image_cache_dir, prefix=".tmp_")
+                os.close(fd)
+                try:
+                    img.save(tmp_path, 'JPEG', quality=self.jpeg_quality, optimize=True)
+                    os.replace(tmp_path, path)
+                except Exception:
+                    os.remove(tmp_path)
+                    raise
+        stats["prepare_seconds"] += time.monotonic() - started
+        return path
+
+    def _target_size(self, size: Tuple[int, int], width: float, height: float) -> Tuple[int, int]:
+        """版面尺寸在目标 DPI 下的像素数；不放大原图"""
+        scale = min(1.0, width / 72 * self.image_dpi / size[0], height / 72 * self.image_dpi / size[1])
+        return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
     
     def _add_cover(self, c, title):
         """添加封面"""
@@ -102,4 +256,53 @@ class BookMaker:
         text_width = c.stringWidth(title, "Helvetica-Bold", 24)
         x = (self.page_size[0] - text_width) / 2
         y = self.page_size[1] / 2
-        c.drawString(x, y, title)
\ No newline at end of file
+        c.drawString(x, y, title)
+
+
+class BookAssembly:
+    """
+    一本书的增量排版：每张场景图片落盘后立即在工作进程中预处理（add_image），
+    最后 build() 只需把预处理好的场景页与封面、寓意页拼到一起。
+    """
+
+    def __init__(self, book_maker: BookMaker):
+        self.book_maker = book_maker
+        self._pages: Dict[str, Future] = {}
+
+    def add_image(self, image_path: Optional[str]):
+        if image_path and image_path not in self._pages:
+            executor = self.book_maker.executor
+            try:
+                future = executor.submit(self.book_maker.prepare_page, image_path)
+            except BrokenProcessPool as e:
+                logger.warning(f"排版进程异常，改为在当前进程中预处理: {e}")
+                self.book_maker._discard_executor(executor)
+                future = Future()
+                try:
+                    future.set_result(self.book_maker.prepare_page(image_path))
+                except Exception as exc:
+                    future.set_exception(exc)
+            self._pages[image_path] = future
+
+    def build(self, story: Story, images: List[str]) -> Optional[Dict[str, Any]]:
+        """等待预处理完成后在工作进程中生成 PDF（阻塞调用方，但不占用 GIL）"""
+        pages = {}
+        for image_path, future in self._pages.items():
+            try:
+                page = future.result()
+            except BrokenProcessPool as e:
+                logger.warning(f"排版进程异常: {e}")
+                continue
+            except Exception as e:
+                # 预处理失败的场景由 build_book 重新处理
+                print(f"预处理场景图片时发生错误: {str(e)}")
+                continue
+            if page:
+                pages[image_path] = page
+        executor = self.book_maker.executor
+        try:
+            return executor.submit(self.book_maker.build_book, story, images, pages).result()
+        except BrokenProcessPool as e:
+            logger.warning(f"排版进程异常，改为在当前进程中生成: {e}")
+            self.book_maker._discard_executor(executor)
+            return self.book_maker.build_book(story, images, pages)
@@ -1,12 +1,45 @@
 from models.character import Character
 import requests
-import json
-from typing import Optional
-import re
+from typing import Optional, Tuple
+import time
+from config import CONFIG
+from services.completion_cache import CompletionCache
+from services.llm_pool import get_llm_pool
+from services.metrics import LLM_JSON_OUTCOMES, LLM_JSON_PARSE_FAILURES, LLM_RETRIES, record_llm_usage
+from services.resilience import BackendUnavailable
+from utils.llm_json import (JSONRepairError, combine_followup, followup_payload, loads_tolerant,
+                            looks_truncated, response_format_rejected, with_response_format)
+
+_STRING_LIST = {"type": "array", "items": {"type": "string"}}
+
+CHARACTER_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "name": {"type": "string"},
+        "age": {"type": "integer"},
+        "personality": {"type": "string"},
+        "appearance": {
+            "type": "object",
+            "properties": {
+                "physical_traits": _STRING_LIST,
+                "clothing": _STRING_LIST,
+                "distinctive_features": _STRING_LIST
+            },
+            "required": ["physical_traits", "clothing", "distinctive_features"],
+            "additionalProperties": False
+        },
+        "backstory": {"type": "string"}
+    },
+    "required": ["name", "age", "personality", "appearance", "backstory"],
+    "additionalProperties": False
+}
 
 class CharacterDesigner:
-    def __init__(self):
-        self.api_url = "http://localhost:1234/v1/chat/completions"
+    def __init__(self, completion_cache: Optional[CompletionCache] = None):
+        self.llm = get_llm_pool()
+        self.max_retries = self.llm.resilience.max_retries
+        self.completion_cache = completion_cache
+        self.json_fix_attempts = CONFIG["lm_studio"].get("json_fix_attempts", 1)
         self.required_features = {
             "physical_traits": [
                 "species",  # 物种（人类/动物/魔法生物等）
@@ -33,121 +66,193 @@ class CharacterDesigner:
             ]
         }
     
-    def create_character(self, user_input: str) -> Optional[Character]:
+    def _build_payload(self, user_input: str) -> dict:
+        """构建角色生成的补全请求体"""
+        # 使用 LM Studio 生成角色特征
+        prompt = f"""
+        Create a children's story character based on the following user input:
+        
+        {user_input}
+        
+        Please return the character information in JSON format as follows:
+        {{
+            "name": "Character name",
+            "age": age,
+            "personality": "Detailed personality description",
+            "appearance": {{
+                "physical_traits": [
+                    "Species: [specify if human, animal, magical creature, etc.]",
+                    "Gender: [specify if applicable]",
+                    "Height: [specific height or relative height]",
+                    "Build: [body type description]",
+                    "Skin tone: [specific color]",
+                    "Hair: [color, length, and style]",
+                    "Eyes: [color and shape]",
+                    "Age appearance: [how they look for their age]"
+                ],
+                "clothing": [
+                    "Main outfit: [detailed description of primary clothing]",
+                    "Signature item: [any distinctive clothing or accessory]",
+                    "Accessories: [list of specific accessories]",
+                    "Colors: [specific color scheme]"
+                ],
+                "distinctive_features": [
+                    "Unique markings: [any special marks, scars, or patterns]",
+                    "Special features: [any magical or unusual characteristics]",
+                    "Characteristic pose: [how they typically stand or move]",
+                    "Expression: [typical facial expression or emotion]"
+                ]
+            }},
+            "backstory": "Detailed background story"
+        }}
+        
+        Important: 
+        1. All text must be in English only. Do not use any non-English characters or text.
+        2. The appearance should be extremely detailed and consistent, suitable for illustration.
+        3. Make sure all appearance details are appropriate for the character's age and species.
+        4. If the user input lacks certain appearance details, intelligently fill in appropriate details that match the character's personality and backstory.
+        5. Include distinctive visual features that make the character easily recognizable and consistent across different scenes.
+        6. For physical_traits, clothing, and distinctive_features, provide at least 3-5 specific details each.
+        7. Ensure all details are specific and measurable to maintain consistency across illustrations.
+        8. Include color descriptions for all relevant features.
+        9. Always specify species, gender, hair color and style, eye color, and skin tone even if not mentioned in the input.
+        10. Create a signature look that makes the character instantly recognizable.
+        """
+        
+        return with_response_format({
+            "messages": [
+                {
+                    "role": "system", 
+                    "content": """You are a professional children's story character designer specializing in creating visually distinctive and consistent characters.
+                    Focus on creating memorable visual features that can be maintained across different illustrations.
+                    Always ensure the appearance details are comprehensive and child-friendly.
+                    If any appearance aspects are not specified in the user input, intelligently generate appropriate details that align with the character's nature."""
+                },
+                {"role": "user", "content": prompt}
+            ],
+            "temperature": 0.7,
+            "max_tokens": 1500
+        }, "character", CHARACTER_SCHEMA)
+
+    def _parse_character(self, character_text: str) -> Tuple[Optional[Character], Optional[str], bool]:
+        """从模型输出中提取角色 JSON（容忍常见的格式错误），返回 (角色, 失败原因, 是否经过修复)"""
         try:
-            # 使用 LM Studio 生成角色特征
-            prompt = f"""
-            Create a children's story character based on the following user input:
-            
-            {user_input}
-            
-            Please return the character information in JSON format as follows:
-            {{
-                "name": "Character name",
-                "age": age,
-                "personality": "Detailed personality description",
-                "appearance": {{
-                    "physical_traits": [
-                        "Species: [specify if human, animal, magical creature, etc.]",
-                        "Gender: [specify if applicable]",
-                        "Height: [specific height or relative height]",
-                        "Build: [body type description]",
-                        "Skin tone: [specific color]",
-                        "Hair: [color, length, and style]",
-                        "Eyes: [color and shape]",
-                        "Age appearance: [how they look for their age]"
-                    ],
-                    "clothing": [
-                        "Main outfit: [detailed description of primary clothing]",
-                        "Signature item: [any distinctive clothing or accessory]",
-                        "Accessories: [list of specific accessories]",
-                        "Colors: [specific color scheme]"
-                    ],
-                    "distinctive_features": [
-                        "Unique markings: [any special marks, scars, or patterns]",
-                        "Special features: [any magical or unusual characteristics]",
-                        "Characteristic pose: [how they typically stand or move]",
-                        "Expression: [typical facial expression or emotion]"
-                    ]
-                }},
-                "backstory": "Detailed background story"
-            }}
-            
-            Important: 
-            1. All text must be in English only. Do not use any non-English characters or text.
-            2. The appearance should be extremely detailed and consistent, suitable for illustration.
-            3. Make sure all appearance details are appropriate for the character's age and species.
-            4. If the user input lacks certain appearance details, intelligently fill in appropriate details that match the character's personality and backstory.
-            5. Include distinctive visual features that make the character easily recognizable and consistent across different scenes.
-            6. For physical_traits, clothing, and distinctive_features, provide at least 3-5 specific details each.
-            7. Ensure all details are specific and measurable to maintain consistency across illustrations.
-            8. Include color descriptions for all relevant features.
-            9. Always specify species, gender, hair color and style, eye color, and skin tone even if not mentioned in the input.
-            10. Create a signature look that makes the character instantly recognizable.
-            """
-            
-            # 检查 LM Studio 服务是否可用
+            character_data, repaired = loads_tolerant(character_text)
+        except JSONRepairError as e:
+            LLM_JSON_PARSE_FAILURES.inc(kind="character")
+            return None, f"invalid JSON: {str(e)}", False
+        if repaired:
+            LLM_JSON_PARSE_FAILURES.inc(kind="character")
+        if not isinstance(character_data, dict):
+            return None, "the reply is not a JSON object", repaired
+
+        # 将结构化的外貌信息转换为描述性文本
+        appearance_data = character_data.get("appearance", {})
+        appearance_text = self._format_appearance(appearance_data)
+
+        return Character(
+            name=character_data.get("name", "未知"),
+            age=character_data.get("age", 5),
+            personality=character_data.get("personality", ""),
+            appearance=appearance_text,
+            backstory=character_data.get("backstory", "")
+        ), None, repaired
+
+    def _followup(self, payload: dict, character_text: str, error: str,
+                  result: Optional[dict] = None) -> Tuple[dict, bool]:
+        """构造 continue/fix 请求，返回 (请求体, 是否为续写)"""
+        finish_reason = ((result or {}).get('choices') or [{}])[0].get('finish_reason')
+        truncated = finish_reason == 'length' or looks_truncated(character_text)
+        print(f"警告：角色回复无法使用（{error}），发送{'续写' if truncated else '修正'}请求")
+        return followup_payload(payload, character_text, error, truncated), truncated
+
+    def _request(self, payload: dict) -> Optional[dict]:
+        """
+        发送补全请求：网络错误或 5xx 时按共享策略退避重试；
+        后端不支持 response_format 时去掉后重发
+        """
+        for attempt in range(self.max_retries):
             try:
-                response = requests.get("http://localhost:1234/v1/models")
-                if response.status_code != 200:
-                    print("错误：无法连接到 LM Studio 服务，请确保服务已启动")
+                started = time.monotonic()
+                response = self.llm.post("/v1/chat/completions", json=payload)
+                fallback = response_format_rejected(payload, response.status_code)
+                if fallback:
+                    payload = fallback
+                    continue
+                if response.status_code == 200:
+                    result = response.json()
+                    record_llm_usage(result, time.monotonic() - started)
+                    return result
+                print(f"错误：生成角色失败，状态码：{response.status_code}")
+                if response.status_code < 500:
                     return None
-            except requests.exceptions.ConnectionError:
-                print("错误：无法连接到 LM Studio 服务，请确保服务已启动")
+            except BackendUnavailable as e:
+                print(f"错误：{e}")
                 return None
+            except requests.exceptions.RequestException as e:
+                print(f"警告：角色生成请求异常 (尝试 {attempt + 1}/{self.max_retries}): {str(e)}")
+
+            if not self._wait_before_retry(attempt):
+                break
+        return None
+
+    def _wait_before_retry(self, attempt: int) -> bool:
+        """与 StoryCreator._wait_before_retry 相同：按退避等待，不应再重试时返回 False"""
+        delay = self.llm.resilience.retry_delay(attempt) if attempt < self.max_retries - 1 else None
+        if delay is None:
+            return False
+        LLM_RETRIES.inc()
+        time.sleep(delay)
+        return True
+
+    def _repair_character(self, payload: dict, result: dict) -> Tuple[Optional[Character], str]:
+        """解析角色；失败时发送 continue/fix 请求。返回 (角色, 最终采用的回复文本)，并记录解析结果"""
+        character_text = result['choices'][0]['message']['content']
+        character, error, repaired = self._parse_character(character_text)
+        outcome = "repaired" if repaired else "clean"
+        for _ in range(self.json_fix_attempts if error else 0):
+            followup, truncated = self._followup(payload, character_text, error, result)
+            result = self._request(followup)
+            if not result:
+                break
+            character_text = combine_followup(character_text, result['choices'][0]['message']['content'], truncated)
+            character, error, _ = self._parse_character(character_text)
+            outcome = "fixed"
+            if character:
+                break
+        if error:
+            outcome = "failed"
+            print(f"错误：解析角色JSON失败 - {error}")
+            print(f"原始响应：{character_text}")
+        LLM_JSON_OUTCOMES.inc(kind="character", outcome=outcome)
+        return character, character_text
+
+    def create_character(self, user_input: str, use_cache: bool = True) -> Optional[Character]:
+        try:
+            payload = self._build_payload(user_input)
+            use_cache = use_cache and self.completion_cache is not None
+            result = self.completion_cache.get(payload) if use_cache else None
+            from_cache = result is not None
             
-            # 生成角色
-            response = requests.post(
-                self.api_url,
-                json={
-                    "messages": [
-                        {
-                            "role": "system", 
-                            "content": """You are a professional children's story character designer specializing in creating visually distinctive and consistent characters.
-                            Focus on creating memorable visual features that can be maintained across different illustrations.
-                            Always ensure the appearance details are comprehensive and child-friendly.
-                            If any appearance aspects are not specified in the user input, intelligently generate appropriate details that align with the character's nature."""
-                        },
-                        {"role": "user", "content": prompt}
-                    ],
-                    "temperature": 0.7,
-                    "max_tokens": 1500
-                }
-            )
-            
-            if response.status_code != 200:
-                print(f"错误：生成角色失败，状态码：{response.status_code}")
-                return None
+            if not from_cache:
+                # 检查 LM Studio 服务是否可用（后台探测的缓存结果）
+                if not self.llm.is_healthy():
+                    print("错误：无法连接到 LM Studio 服务，请确保服务已启动")
+                    return None
                 
-            result = response.json()
-            character_text = result['choices'][0]['message']['content']
-            
-            # 尝试从文本中提取JSON
-            try:
-                # 使用正则表达式提取JSON部分
-                json_match = re.search(r'\{.*\}', character_text, re.DOTALL)
-                if json_match:
-                    character_data = json.loads(json_match.group())
-                    
-                    # 将结构化的外貌信息转换为描述性文本
-                    appearance_data = character_data.get("appearance", {})
-                    appearance_text = self._format_appearance(appearance_data)
-                    
-                    return Character(
-                        name=character_data.get("name", "未知"),
-                        age=character_data.get("age", 5),
-                        personality=character_data.get("personality", ""),
-                        appearance=appearance_text,
-                        backstory=character_data.get("backstory", "")
-                    )
-                else:
-                    print("错误：无法从响应中提取JSON数据")
-                    print(f"原始响应：{character_text}")
+                # 生成角色
+                result = self._request(payload)
+                if not result:
                     return None
-            except json.JSONDecodeError as e:
-                print(f"错误：解析角色JSON失败 - {str(e)}")
-                print(f"原始响应：{character_text}")
-                return None
+            else:
+                character, _, _ = self._parse_character(result['choices'][0]['message']['content'])
+                return character
+            
+            character, character_text = self._repair_character(payload, result)
+            # 只缓存能成功解析的响应（修复后的文本）
+            if character and use_cache:
+                self.completion_cache.put(payload, {"choices": [{"message": {"content": character_text}}]})
+            return character
             
         except Exception as e:
             print(f"创建角色时发生错误: {str(e)}")
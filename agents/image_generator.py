@@ -1,13 +1,13 @@
-import requests
 import os
 import base64
 import uuid
 from typing import Optional
 from models.character import Character
+from services.llm_pool import get_llm_pool
 
 class ImageGenerator:
     def __init__(self):
-        self.api_url = "http://localhost:1234/v1/images/generations"
+        self.llm = get_llm_pool()
 
     def generate_image(self, scene_description: str, character: Character) -> Optional[str]:
         try:
@@ -22,19 +22,14 @@ class ImageGenerator:
             # 清理提示词格式
             image_prompt = ' '.join(image_prompt.split())
 
-            # 检查 LM Studio 服务是否可用
-            try:
-                response = requests.get("http://localhost:1234/v1/models")
-                if response.status_code != 200:
-                    print("错误：无法连接到 LM Studio 服务，请确保服务已启动")
-                    return None
-            except requests.exceptions.ConnectionError:
+            # 检查 LM Studio 服务是否可用（后台探测的缓存结果）
+            if not self.llm.is_healthy():
                 print("错误：无法连接到 LM Studio 服务，请确保服务已启动")
                 return None
 
             # 生成图片
-            response = requests.post(
-                self.api_url,
+            response = self.llm.post(
+                "/v1/images/generations",
                 json={
                     "prompt": image_prompt,
                     "n": 1,
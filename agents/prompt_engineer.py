@@ -8,7 +8,6 @@ logger = logging.getLogger(__name__)
 
 class PromptEngineer:
     def __init__(self):
-        self.api_url = "http://localhost:1234/v1/chat/completions"
         self.character_consistency_weights = {
             "physical_traits": {
                 "species": 1.5,      # 最高权重，确保物种特征
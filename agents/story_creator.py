@@ -2,192 +2,402 @@ from models.character import Character
 from models.story import Story, Scene
 import requests
 import json
-from typing import Optional
-import re
+from typing import Any, Iterator, List, Optional, Tuple
 import logging
 import time
+from config import CONFIG
+from services.completion_cache import CompletionCache
+from services.llm_pool import get_llm_pool
+from services.metrics import LLM_JSON_OUTCOMES, LLM_JSON_PARSE_FAILURES, LLM_RETRIES, record_llm_usage
+from services.resilience import BackendUnavailable
+from utils.json_stream import SceneStreamParser
+from utils.llm_json import (JSONRepairError, combine_followup, finish_reason, followup_payload, loads_tolerant,
+                            looks_truncated, response_format_rejected, with_response_format)
 
 logger = logging.getLogger(__name__)
 
+_SCENE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "title": {"type": "string"},
+        "description": {"type": "string"},
+        "image_prompt": {"type": "string"}
+    },
+    "required": ["title", "description", "image_prompt"],
+    "additionalProperties": False
+}
+
+# 属性顺序与提示词中的示例一致，流式生成时场景先于 moral 写出
+STORY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "title": {"type": "string"},
+        "theme": {"type": "string"},
+        "target_age_range": {"type": "string"},
+        "scenes": {"type": "array", "minItems": 1, "items": _SCENE_SCHEMA},
+        "moral": {"type": "string"}
+    },
+    "required": ["title", "theme", "target_age_range", "scenes", "moral"],
+    "additionalProperties": False
+}
+
 class StoryCreator:
-    def __init__(self):
-        self.api_url = "http://localhost:1234/v1/chat/completions"
-        self.max_retries = 3
-        self.retry_delay = 2  # seconds
+    def __init__(self, completion_cache: Optional[CompletionCache] = None):
+        # LLM 端点池（单个端点时即 CONFIG["lm_studio"]["api_url"]）
+        self.llm = get_llm_pool()
+        # 重试次数、退避与重试预算由 LM Studio 的共享策略决定（CONFIG["lm_studio"]["resilience"]）
+        self.max_retries = self.llm.resilience.max_retries
+        self.json_fix_attempts = CONFIG["lm_studio"].get("json_fix_attempts", 1)
+        self.completion_cache = completion_cache
     
     def _check_api_availability(self) -> bool:
-        """检查API服务是否可用"""
-        try:
-            response = requests.get("http://localhost:1234/v1/models", timeout=5)
-            return response.status_code == 200
-        except requests.exceptions.RequestException as e:
-            logger.error(f"API服务不可用: {str(e)}")
-            return False
+        """检查API服务是否可用（读取后台健康探测的缓存结果）"""
+        return self.llm.is_healthy()
 
-    def _make_api_request(self, prompt: str) -> Optional[dict]:
+    def _build_payload(self, prompt: str) -> dict:
+        """构建补全请求体"""
+        return with_response_format({
+            "messages": [
+                {"role": "system", "content": "You are a professional children's story writer. Return data in JSON format only, using English text exclusively."},
+                {"role": "user", "content": prompt}
+            ],
+            "temperature": 0.7,
+            "max_tokens": 2000
+        }, "story", STORY_SCHEMA)
+
+    def _make_api_request(self, payload: dict) -> Optional[dict]:
         """发送API请求并处理重试逻辑"""
         for attempt in range(self.max_retries):
             try:
-                response = requests.post(
-                    self.api_url,
-                    json={
-                        "messages": [
-                            {"role": "system", "content": "You are a professional children's story writer. Return data in JSON format only, using English text exclusively."},
-                            {"role": "user", "content": prompt}
-                        ],
-                        "temperature": 0.7,
-                        "max_tokens": 2000
-                    },
-                    timeout=30  # 设置较长的超时时间
-                )
+                started = time.monotonic()
+                response = self.llm.post("/v1/chat/completions", json=payload)
                 
                 if response.status_code == 200:
-                    return response.json()
+                    result = response.json()
+                    record_llm_usage(result, time.monotonic() - started)
+                    return result
+                fallback = response_format_rejected(payload, response.status_code)
+                if fallback:
+                    payload = fallback
+                    continue
                 else:
                     logger.warning(f"API请求失败 (尝试 {attempt + 1}/{self.max_retries}): 状态码 {response.status_code}")
                     
+            except BackendUnavailable as e:
+                logger.error(str(e))
+                return None
             except requests.exceptions.RequestException as e:
                 logger.warning(f"API请求异常 (尝试 {attempt + 1}/{self.max_retries}): {str(e)}")
             
-            if attempt < self.max_retries - 1:
-                time.sleep(self.retry_delay)
+            if not self._wait_before_retry(attempt):
+                break
         
         return None
+
+    def _wait_before_retry(self, attempt: int) -> bool:
+        """第 attempt 次尝试失败后按退避等待；已是最后一次、预算耗尽或熔断器打开时返回 False"""
+        delay = self.llm.resilience.retry_delay(attempt) if attempt < self.max_retries - 1 else None
+        if delay is None:
+            return False
+        LLM_RETRIES.inc()
+        time.sleep(delay)
+        return True
     
-    def create_story(self, character: Character) -> Optional[Story]:
+    def _build_prompt(self, character: Character) -> str:
+        """根据角色构建故事提示词"""
+        # 构建角色描述
+        character_description = f"""
+        Character Information:
+        Name: {character.name}
+        Age: {character.age}
+        Personality: {character.personality}
+        Appearance: {character.appearance}
+        Backstory: {character.backstory}
+        """
+
+        # 构建提示词
+        prompt = f"""
+        Create a children's story based on the following character:
+        
+        {character_description}
+        
+        Please follow these guidelines in order:
+
+        1. Character Features (Must be consistent throughout the story):
+           - Maintain the character's appearance, personality, and traits
+           - Keep the character's age-appropriate behavior
+           - Ensure the character's actions align with their personality
+           - Preserve the character's unique characteristics in each scene
+
+        2. Scene Development (Create 3-5 engaging scenes):
+           - Each scene should showcase the character's personality
+           - Include clear visual descriptions for image generation
+           - Create a logical progression from beginning to end
+           - Ensure each scene builds upon the previous one
+           - Include meaningful character interactions and development
+
+        3. Story Requirements:
+           - Clear and appropriate theme for children
+           - Age-appropriate content and language
+           - Engaging and educational value
+           - Meaningful moral lesson
+           - Proper story structure (beginning, middle, end)
+
+        Please return the story in JSON format as follows:
+        {{
+            "title": "Story title",
+            "theme": "The main theme of the story (e.g., friendship, courage, kindness)",
+            "target_age_range": "The target age range for the story (e.g., 4-8, 6-10)",
+            "scenes": [
+                {{
+                    "title": "Scene 1 title",
+                    "description": "Detailed description of scene 1",
+                    "image_prompt": "Detailed prompt for generating an image of scene 1"
+                }},
+                {{
+                    "title": "Scene 2 title",
+                    "description": "Detailed description of scene 2",
+                    "image_prompt": "Detailed prompt for generating an image of scene 2"
+                }},
+                {{
+                    "title": "Scene 3 title",
+                    "description": "Detailed description of scene 3",
+                    "image_prompt": "Detailed prompt for generating an image of scene 3"
+                }}
+            ],
+            "moral": "The moral of the story"
+        }}
+        
+        Important:
+        1. All text must be in English only.
+        2. Each scene must include an image_prompt that describes how the scene should look visually.
+        3. Make sure to return valid JSON format with proper quotes and commas.
+        4. Do not include any explanatory text outside the JSON structure.
+        """
+        return prompt
+
+    def _validate_scene(self, scene: dict) -> bool:
+        """验证单个场景的必要字段"""
+        return isinstance(scene, dict) and all(key in scene for key in ['title', 'description', 'image_prompt'])
+
+    def _parse_story(self, story_text: str, character: Character,
+                     result: Optional[dict] = None) -> Tuple[Optional[Story], Optional[str], bool]:
+        """
+        从模型输出中提取并校验故事 JSON（容忍常见的格式错误）。
+        被截断的回复（括号或字符串未闭合，或 result 的 finish_reason 为 "length"）
+        即使补全后能解析也视为不完整，由调用方请求续写。
+        返回 (故事, 失败原因, 是否经过修复)
+        """
         try:
-            # 构建角色描述
-            character_description = f"""
-            Character Information:
-            Name: {character.name}
-            Age: {character.age}
-            Personality: {character.personality}
-            Appearance: {character.appearance}
-            Backstory: {character.backstory}
-            """
-
-            # 构建提示词
-            prompt = f"""
-            Create a children's story based on the following character:
-            
-            {character_description}
-            
-            Please follow these guidelines in order:
-
-            1. Character Features (Must be consistent throughout the story):
-               - Maintain the character's appearance, personality, and traits
-               - Keep the character's age-appropriate behavior
-               - Ensure the character's actions align with their personality
-               - Preserve the character's unique characteristics in each scene
-
-            2. Scene Development (Create 3-5 engaging scenes):
-               - Each scene should showcase the character's personality
-               - Include clear visual descriptions for image generation
-               - Create a logical progression from beginning to end
-               - Ensure each scene builds upon the previous one
-               - Include meaningful character interactions and development
-
-            3. Story Requirements:
-               - Clear and appropriate theme for children
-               - Age-appropriate content and language
-               - Engaging and educational value
-               - Meaningful moral lesson
-               - Proper story structure (beginning, middle, end)
-
-            Please return the story in JSON format as follows:
-            {{
-                "title": "Story title",
-                "theme": "The main theme of the story (e.g., friendship, courage, kindness)",
-                "target_age_range": "The target age range for the story (e.g., 4-8, 6-10)",
-                "scenes": [
-                    {{
-                        "title": "Scene 1 title",
-                        "description": "Detailed description of scene 1",
-                        "image_prompt": "Detailed prompt for generating an image of scene 1"
-                    }},
-                    {{
-                        "title": "Scene 2 title",
-                        "description": "Detailed description of scene 2",
-                        "image_prompt": "Detailed prompt for generating an image of scene 2"
-                    }},
-                    {{
-                        "title": "Scene 3 title",
-                        "description": "Detailed description of scene 3",
-                        "image_prompt": "Detailed prompt for generating an image of scene 3"
-                    }}
-                ],
-                "moral": "The moral of the story"
-            }}
-            
-            Important:
-            1. All text must be in English only.
-            2. Each scene must include an image_prompt that describes how the scene should look visually.
-            3. Make sure to return valid JSON format with proper quotes and commas.
-            4. Do not include any explanatory text outside the JSON structure.
-            """
-
-            # 检查 LM Studio 服务是否可用
-            if not self._check_api_availability():
-                logger.error("无法连接到 LM Studio 服务，请确保服务已启动")
-                return None
+            story_data, repaired = loads_tolerant(story_text)
+        except JSONRepairError as e:
+            LLM_JSON_PARSE_FAILURES.inc(kind="story")
+            return None, f"invalid JSON: {str(e)}", False
+        if repaired:
+            LLM_JSON_PARSE_FAILURES.inc(kind="story")
+
+        # 验证必要的字段
+        if not isinstance(story_data, dict):
+            return None, "the reply is not a JSON object", repaired
+        missing = [key for key in ['title', 'theme', 'target_age_range', 'scenes', 'moral'] if key not in story_data]
+        if missing:
+            return None, f"missing fields: {', '.join(missing)}", repaired
+
+        # 验证场景数据
+        if not isinstance(story_data['scenes'], list) or not story_data['scenes']:
+            return None, "scenes must be a non-empty list", repaired
+
+        # 验证每个场景的必要字段
+        for i, scene in enumerate(story_data['scenes']):
+            if not self._validate_scene(scene):
+                return None, f"scene {i + 1} needs title, description and image_prompt", repaired
+        
+        story = Story(
+            title=story_data['title'],
+            character=character,
+            theme=story_data['theme'],
+            target_age_range=story_data['target_age_range'],
+            scenes=[
+                Scene(
+                    title=scene['title'],
+                    description=scene['description'],
+                    image_prompt=scene['image_prompt']
+                )
+                for scene in story_data['scenes']
+            ],
+            moral=story_data['moral']
+        )
+        if finish_reason(result) == 'length' or looks_truncated(story_text):
+            return None, "the reply was cut off before the story was complete", repaired
+        logger.info(f"故事生成成功：{story.title}")
+        return story, None, repaired
 
-            # 生成故事
-            result = self._make_api_request(prompt)
+    def _followup(self, payload: dict, story_text: str, error: str,
+                  result: Optional[dict] = None) -> Tuple[dict, bool]:
+        """构造 continue/fix 请求，返回 (请求体, 是否为续写)"""
+        truncated = finish_reason(result) == 'length' or looks_truncated(story_text)
+        logger.warning(f"故事回复无法使用（{error}），发送{'续写' if truncated else '修正'}请求")
+        return followup_payload(payload, story_text, error, truncated), truncated
+
+    def _repair_story(self, payload: dict, result: Optional[dict], story_text: str,
+                      character: Character) -> Tuple[Optional[Story], str]:
+        """
+        解析故事；失败时发送最多 json_fix_attempts 次 continue/fix 请求，而不是整篇重新生成。
+        返回 (故事, 最终采用的回复文本)，并记录解析结果
+        """
+        story, error, repaired = self._parse_story(story_text, character, result)
+        outcome = "repaired" if repaired else "clean"
+        for _ in range(self.json_fix_attempts if error else 0):
+            followup, truncated = self._followup(payload, story_text, error, result)
+            result = self._make_api_request(followup)
             if not result:
-                logger.error("多次尝试后仍无法生成故事")
-                return None
+                break
+            story_text = combine_followup(story_text, result['choices'][0]['message']['content'], truncated)
+            story, error, _ = self._parse_story(story_text, character, result)
+            outcome = "fixed"
+            if story:
+                break
+        if error:
+            outcome = "failed"
+            logger.error(f"故事数据无效：{error}")
+            logger.debug(f"原始响应：{story_text}")
+        LLM_JSON_OUTCOMES.inc(kind="story", outcome=outcome)
+        return story, story_text
+
+    @staticmethod
+    def _remaining_scenes(story: Story, emitted: List[Scene]) -> Optional[List[Scene]]:
+        """
+        流式模式下续写/修正得到的完整故事必须以已产出（已提交渲染）的场景开头，
+        否则绘本会混用旧图片和新文字：一致时沿用已产出的场景并返回还需补发的场景，不一致时返回 None
+        """
+        if story.scenes[:len(emitted)] != emitted:
+            logger.error("续写或修正后的故事与已产出的场景不一致")
+            return None
+        story.scenes[:len(emitted)] = emitted
+        return story.scenes[len(emitted):]
+
+    def create_story(self, character: Character, use_cache: bool = True) -> Optional[Story]:
+        try:
+            prompt = self._build_prompt(character)
+            payload = self._build_payload(prompt)
+            use_cache = use_cache and self.completion_cache is not None
+            result = self.completion_cache.get(payload) if use_cache else None
+            from_cache = result is not None
+
+            if not from_cache:
+                # 检查 LM Studio 服务是否可用
+                if not self._check_api_availability():
+                    logger.error("无法连接到 LM Studio 服务，请确保服务已启动")
+                    return None
+
+                # 生成故事
+                result = self._make_api_request(payload)
+                if not result:
+                    logger.error("多次尝试后仍无法生成故事")
+                    return None
 
             story_text = result['choices'][0]['message']['content']
+            if from_cache:
+                story, _, _ = self._parse_story(story_text, character)
+                return story
+            story, story_text = self._repair_story(payload, result, story_text, character)
+            # 只缓存通过校验的响应（修复后的文本）
+            if story and use_cache:
+                self.completion_cache.put(payload, {"choices": [{"message": {"content": story_text}}]})
+            return story
 
-            # 尝试从文本中提取JSON
+        except Exception as e:
+            logger.error(f"故事生成过程中发生错误: {str(e)}")
+            return None
+
+    def _stream_completion(self, payload: dict) -> Iterator[str]:
+        """以流式方式请求补全，逐段产出文本；只在收到首个片段之前重试"""
+        # include_usage：最后一个片段带上 token 用量
+        payload = dict(payload, stream=True, stream_options={"include_usage": True})
+        for attempt in range(self.max_retries):
             try:
-                # 使用正则表达式提取JSON部分
-                json_match = re.search(r'\{[\s\S]*\}', story_text)
-                if json_match:
-                    story_data = json.loads(json_match.group())
-                    
-                    # 验证必要的字段
-                    if not all(key in story_data for key in ['title', 'theme', 'scenes', 'moral', 'target_age_range']):
-                        logger.error("故事数据缺少必要字段")
-                        return None
-                    
-                    # 验证场景数据
-                    if not isinstance(story_data['scenes'], list) or not story_data['scenes']:
-                        logger.error("场景数据格式不正确")
-                        return None
-                    
-                    # 验证每个场景的必要字段
-                    for scene in story_data['scenes']:
-                        if not all(key in scene for key in ['title', 'description', 'image_prompt']):
-                            logger.error("场景数据缺少必要字段")
-                            return None
-                    
-                    story = Story(
-                        title=story_data['title'],
-                        character=character,
-                        theme=story_data['theme'],
-                        target_age_range=story_data['target_age_range'],
-                        scenes=[
-                            Scene(
-                                title=scene['title'],
-                                description=scene['description'],
-                                image_prompt=scene['image_prompt']
-                            )
-                            for scene in story_data['scenes']
-                        ],
-                        moral=story_data['moral']
+                started = time.monotonic()
+                with self.llm.post("/v1/chat/completions", json=payload, stream=True) as response:
+                    fallback = response_format_rejected(payload, response.status_code)
+                    if fallback:
+                        payload = fallback
+                        continue
+                    if response.status_code != 200:
+                        logger.warning(f"API请求失败 (尝试 {attempt + 1}/{self.max_retries}): 状态码 {response.status_code}")
+                    else:
+                        for line in response.iter_lines(decode_unicode=True):
+                            if not line or not line.startswith('data:'):
+                                continue
+                            data = line[len('data:'):].strip()
+                            if data == '[DONE]':
+                                return
+                            chunk = json.loads(data)
+                            if chunk.get('usage'):
+                                record_llm_usage(chunk, time.monotonic() - started)
+                            choices = chunk.get('choices') or [{}]
+                            content = choices[0].get('delta', {}).get('content')
+                            if content:
+                                yield content
+                        return
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"API请求异常 (尝试 {attempt + 1}/{self.max_retries}): {str(e)}")
+
+            if not self._wait_before_retry(attempt):
+                break
+        raise RuntimeError("多次尝试后仍无法生成故事")
+
+    def stream_story(self, character: Character, use_cache: bool = True) -> Iterator[Tuple[str, Any]]:
+        """
+        流式生成故事。每个场景在模型写完后立即产出 ("scene", (index, Scene))，
+        最后产出 ("story", Story)；失败时产出 ("story", None)。
+        """
+        try:
+            prompt = self._build_prompt(character)
+            payload = self._build_payload(prompt)
+            use_cache = use_cache and self.completion_cache is not None
+            cached = self.completion_cache.get(payload) if use_cache else None
+
+            if cached is not None:
+                chunks = iter([cached['choices'][0]['message']['content']])
+            else:
+                if not self._check_api_availability():
+                    logger.error("无法连接到 LM Studio 服务，请确保服务已启动")
+                    yield "story", None
+                    return
+                chunks = self._stream_completion(payload)
+
+            parser = SceneStreamParser()
+            emitted: List[Scene] = []
+            for chunk in chunks:
+                for scene_data in parser.feed(chunk):
+                    # 逐个场景沿用原有的字段校验
+                    if not self._validate_scene(scene_data):
+                        logger.error("场景数据缺少必要字段")
+                        yield "story", None
+                        return
+                    scene = Scene(
+                        title=scene_data['title'],
+                        description=scene_data['description'],
+                        image_prompt=scene_data['image_prompt']
                     )
-                    logger.info(f"故事生成成功：{story.title}")
-                    return story
-                else:
-                    logger.error("无法从响应中提取JSON数据")
-                    logger.debug(f"原始响应：{story_text}")
-                    return None
-            except json.JSONDecodeError as e:
-                logger.error(f"解析故事JSON失败: {str(e)}")
-                logger.debug(f"原始响应：{story_text}")
-                return None
+                    yield "scene", (len(emitted), scene)
+                    emitted.append(scene)
+
+            if cached is not None:
+                story, _, _ = self._parse_story(parser.text, character)
+            else:
+                story, story_text = self._repair_story(payload, None, parser.text, character)
+            remaining = self._remaining_scenes(story, emitted) if story else []
+            if remaining is None:
+                story = None
+            # 续写补上的场景在这里补发
+            for scene in remaining or []:
+                yield "scene", (len(emitted), scene)
+                emitted.append(scene)
+            if story and use_cache and cached is None:
+                self.completion_cache.put(payload, {"choices": [{"message": {"content": story_text}}]})
+            yield "story", story
 
         except Exception as e:
             logger.error(f"故事生成过程中发生错误: {str(e)}")
-            return None
\ No newline at end of file
+            yield "story", None
@@ -1,13 +1,29 @@
-from flask import Flask, render_template, request, jsonify, Response, send_from_directory
+from flask import Flask, render_template, request, jsonify, Response
 from agents.character_designer import CharacterDesigner
 from agents.story_creator import StoryCreator
 from agents.art_designer import ArtDesigner
 from agents.book_maker import BookMaker
 from services.character_service import CharacterService
+from services.render_cache import RenderCache
+from services.image_derivatives import DerivativeStore
+from services.static_files import StaticFiles
+from services.image_transfer import ImageTransfer
+from services.preview_store import get_preview_store
+from services.story_store import StoryStore, load_story, story_record
+from services.workflow_templates import QUALITIES
+from services.completion_cache import CompletionCache
+from services.job_store import FINISHED_STATUSES, JobStore, is_final_event
+from services.job_runner import JobRunner
+from services.metrics import CONTENT_TYPE, COMFYUI_PLANNED, COMFYUI_QUEUE_DEPTH, REGISTRY, STAGE_SECONDS, STORIES_IN_FLIGHT
+from utils.story_events import completed_event, failure_event
+from config import CONFIG
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
+import threading
 import traceback
 import logging
 import json
+import time
 
 # 配置日志
 logging.basicConfig(
@@ -26,39 +42,201 @@ app.config['UPLOAD_FOLDER'] = 'static/images'
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
 # 初始化服务和代理
-character_service = CharacterService()
+# 排版进程池最先启动：fork 时进程内还没有其他线程
+book_maker = BookMaker(
+    image_dpi=CONFIG["book"]["image_dpi"],
+    jpeg_quality=CONFIG["book"]["jpeg_quality"],
+    image_cache_dir=CONFIG["book"]["image_cache_dir"],
+    workers=CONFIG["book"]["workers"]
+)
+book_maker.start_pool()
+# 相似角色索引依赖 NumPy，未安装时 /characters/<id>/similar 不可用，新建角色也不查重
+character_index = None
+if CONFIG["characters"]["similarity"]["enabled"]:
+    try:
+        from services.character_index import CharacterIndex
+        character_index = CharacterIndex(CONFIG["characters"]["similarity"]["dir"],
+                                          dim=CONFIG["characters"]["similarity"]["dim"])
+    except ImportError as e:
+        logger.warning(f"Similar-character search unavailable: {str(e)}")
 logger.info("Loading characters...")
-character_service.load_characters()
-character_designer = CharacterDesigner()
-story_creator = StoryCreator()
-art_designer = ArtDesigner("http://localhost:8188")
-book_maker = BookMaker()
+character_service = CharacterService(CONFIG["characters"]["dir"], CONFIG["characters"]["db_path"],
+                                     index=character_index)
+completion_cache = CompletionCache(
+    CONFIG["llm_cache"]["db_path"],
+    model=CONFIG["lm_studio"]["model"],
+    memory_entries=CONFIG["llm_cache"]["memory_entries"],
+    ttl=CONFIG["llm_cache"]["ttl"],
+    max_bytes=CONFIG["llm_cache"]["max_bytes"],
+    enabled=CONFIG["llm_cache"]["enabled"]
+)
+character_designer = CharacterDesigner(completion_cache=completion_cache)
+story_creator = StoryCreator(completion_cache=completion_cache)
+static_files = StaticFiles(
+    app.config['UPLOAD_FOLDER'],
+    max_age=CONFIG["static_images"]["max_age"],
+    offload=CONFIG["static_images"]["offload"],
+    accel_prefix=CONFIG["static_images"]["accel_prefix"]
+)
+derivatives = None
+if CONFIG["derivatives"]["enabled"]:
+    derivatives = DerivativeStore(
+        app.config['UPLOAD_FOLDER'],
+        CONFIG["derivatives"]["dir"],
+        url_prefix="/" + CONFIG["derivatives"]["dir"],
+        widths=CONFIG["derivatives"]["widths"],
+        formats=CONFIG["derivatives"]["formats"],
+        quality=CONFIG["derivatives"]["quality"],
+        eager=CONFIG["derivatives"]["eager"],
+        workers=CONFIG["derivatives"]["workers"]
+    )
+render_cache = RenderCache(
+    app.config['UPLOAD_FOLDER'],
+    max_bytes=CONFIG["render_cache"]["max_bytes"],
+    enabled=CONFIG["render_cache"]["enabled"],
+    on_evict=derivatives.remove if derivatives else None
+)
+art_designer = ArtDesigner(CONFIG["comfyui"].get("api_urls") or CONFIG["comfyui"]["api_url"],
+                           render_cache=render_cache, derivatives=derivatives)
+preview_store = get_preview_store()
+story_store = StoryStore(CONFIG["stories"]["db_path"], ttl=CONFIG["stories"]["ttl"])
+# 正在升级的故事 id：同一故事同时只允许一个升级请求，避免重复渲染和竞争写入故事记录
+upgrading = set()
+upgrading_lock = threading.Lock()
+# 单节点时为 /ws 广播的队列长度；多节点时为各节点队列长度之和
+COMFYUI_QUEUE_DEPTH.set_function(lambda: art_designer.sd_service.pool.queue_depth())
+COMFYUI_PLANNED.set_function(lambda: art_designer.sd_service.pool.queued())
+
+# asyncio 引擎：网络等待不再占用 Flask 工作线程；未安装 aiohttp 时退回同步实现
+generation_engine = None
+if CONFIG["engine"]["mode"] == "async":
+    try:
+        from services.generation_engine import GenerationEngine
+        generation_engine = GenerationEngine(
+            character_designer, story_creator, art_designer, book_maker,
+            max_in_flight=CONFIG["comfyui"]["max_in_flight"],
+            static_files=static_files,
+            story_store=story_store
+        )
+    except ImportError as e:
+        logger.warning(f"Async engine unavailable, using sync pipeline: {str(e)}")
+
+job_store = JobStore(CONFIG["jobs"]["db_path"], ttl=CONFIG["jobs"]["ttl"])
+interrupted = job_store.fail_unfinished("Job interrupted by server restart")
+if interrupted:
+    logger.warning(f"Marked {interrupted} unfinished job(s) as failed")
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+@app.route('/metrics')
+def metrics():
+    """Prometheus 抓取端点"""
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+@app.route('/llm/endpoints')
+def llm_endpoints():
+    """LLM 端点池状态：各端点是否可用、在途请求数和并发上限"""
+    return jsonify(story_creator.llm.status())
+
+@app.route('/comfyui/nodes')
+def comfyui_nodes():
+    """ComfyUI 节点池状态：各节点是否可用、队列长度、在途任务、空闲显存和当前模型"""
+    return jsonify(art_designer.sd_service.pool.status())
+
+@app.route('/previews/<key>')
+def serve_preview(key):
+    """渲染途中的预览图（scene_preview 事件中的 preview_url）；首遍预览从渲染它的 ComfyUI 节点读取"""
+    preview = preview_store.get(key)
+    if preview is None:
+        return jsonify({"error": "Preview not found"}), 404
+    if "data" in preview:
+        return Response(preview["data"], content_type=preview["content_type"],
+                        headers={"Cache-Control": "private, max-age=3600"})
+    client = art_designer.sd_service.client_for(dict(preview["image"], node=preview["node"]))
+    try:
+        upstream = client.get("/view", params=ImageTransfer.view_params(preview["image"]),
+                              timeout=(client.timeout[0], 10))
+        upstream.raise_for_status()
+    except Exception as e:
+        logger.warning(f"Failed to fetch preview {key}: {str(e)}")
+        return jsonify({"error": "Preview not available"}), 404
+    return Response(upstream.content, content_type=upstream.headers.get("Content-Type", "image/png"),
+                    headers={"Cache-Control": "private, max-age=3600"})
+
 @app.route('/static/images/<path:filename>')
 def serve_image(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    path = static_files.resolve(filename)
+    if not path:
+        return jsonify({"error": "Image not found"}), 404
+    return static_files.send(path)
+
+@app.route('/static/images/derived/<name>')
+def serve_derivative(name):
+    """网页派生图；不存在时按文件名中的宽度和格式即时生成"""
+    variant = derivatives.parse(name) if derivatives else None
+    if not variant:
+        return jsonify({"error": "Image not found"}), 404
+    path = derivatives.ensure(variant["source"], variant["width"], variant["format"])
+    if not path:
+        return jsonify({"error": "Image not found"}), 404
+    # 派生图以原图的内容哈希作为版本号
+    return static_files.send(path, version_path=os.path.join(derivatives.source_dir, variant["source"]))
 
 @app.route('/characters/random', methods=['GET'])
 def get_random_character():
     logger.debug("Getting random character...")
-    character, source_file = character_service.get_random_character()
-    logger.debug(f"Random character data: {character}, from file: {source_file}")
-    if character:
+    selected = character_service.get_random_character()
+    if selected:
+        character, source_file = selected
+        logger.debug(f"Random character data: {character}, from file: {source_file}")
         return jsonify({
             "character": character,
             "source_file": source_file
         })
     return jsonify({"error": "No characters available"}), 404
 
+def _page_args():
+    """解析分页参数 offset / limit；非法时返回 None"""
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args.get('limit', CONFIG["characters"]["page_size"]))
+    except ValueError:
+        return None
+    if offset < 0 or limit < 1:
+        return None
+    return offset, min(limit, CONFIG["characters"]["max_page_size"])
+
+@app.route('/characters', methods=['GET'])
+def list_characters():
+    """分页列出角色；q 非空时按相关度返回全文检索结果"""
+    page = _page_args()
+    if page is None:
+        return jsonify({"error": "Invalid offset or limit"}), 400
+    return jsonify(character_service.list_characters(request.args.get('q'), *page))
+
+@app.route('/characters/search', methods=['GET'])
+def search_characters():
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify({"error": "Missing search query"}), 400
+    page = _page_args()
+    if page is None:
+        return jsonify({"error": "Invalid offset or limit"}), 400
+    return jsonify(character_service.list_characters(q, *page))
+
 @app.route('/characters', methods=['POST'])
 def create_character():
     character_data = request.json
     if not character_data:
         return jsonify({"error": "No character data provided"}), 400
+    # ?allow_duplicate=1 时跳过查重
+    if request.args.get('allow_duplicate') not in ('1', 'true'):
+        duplicate = character_service.find_duplicate(
+            character_data, CONFIG["characters"]["similarity"]["duplicate_threshold"])
+        if duplicate:
+            return jsonify({"error": "A very similar character already exists", "duplicate": duplicate}), 409
     
     try:
         character_id = character_service.create_character(character_data)
@@ -74,7 +252,38 @@ def get_character(character_id):
         return jsonify(character)
     return jsonify({"error": "Character not found"}), 404
 
-def generate_story_stream(user_input, character_data=None):
+@app.route('/characters/<character_id>/similar', methods=['GET'])
+def get_similar_characters(character_id):
+    if character_index is None:
+        return jsonify({"error": "Similar-character search is not available"}), 503
+    try:
+        k = int(request.args.get('k', CONFIG["characters"]["similarity"]["top_k"]))
+    except ValueError:
+        return jsonify({"error": "Invalid k"}), 400
+    similar = character_service.similar_characters(
+        character_id, max(1, min(k, CONFIG["characters"]["max_page_size"])))
+    if similar is None:
+        return jsonify({"error": "Character not found"}), 404
+    return jsonify({"id": character_id, "similar": similar})
+
+def _image_events(events, failures, assembly):
+    """转发场景渲染事件（图片完成后立即开始预处理对应的绘本页）；遇到失败的场景时记录标题并停止"""
+    for event in events:
+        if event["status"] == "image_failed":
+            logger.error(f"Image generation failed for scene: {event['title']}")
+            failures.append(event["title"])
+            return
+        if event["status"] == "image_completed":
+            assembly.add_image(event["image_path"])
+        yield json.dumps(event) + "\n"
+
+def generate_story_stream(user_input, character_data=None, use_cache=True, stream=False, preset=None,
+                          quality=None):
+    with STORIES_IN_FLIGHT.track_inprogress():
+        yield from _generate_story_stream(user_input, character_data, use_cache, stream, preset,
+                                          quality or "final")
+
+def _generate_story_stream(user_input, character_data, use_cache, stream, preset, quality):
     try:
         # Generate or use provided character
         logger.debug("Starting character generation...")
@@ -83,11 +292,13 @@ def generate_story_stream(user_input, character_data=None):
         if character_data:
             character = character_designer.create_character_from_data(character_data)
         else:
-            character = character_designer.create_character(user_input)
+            with STAGE_SECONDS.time(stage="character"):
+                character = character_designer.create_character(user_input, use_cache=use_cache)
             
         if not character:
             logger.error("Character generation failed")
-            yield json.dumps({"error": "Character generation failed"}) + "\n"
+            yield json.dumps(failure_event("Character generation failed",
+                                           None if character_data else character_designer.llm)) + "\n"
             return
         logger.debug(f"Character generated successfully: {character}")
         yield json.dumps({"status": "character_completed"}) + "\n"
@@ -95,59 +306,79 @@ def generate_story_stream(user_input, character_data=None):
         # Generate story
         logger.debug("Starting story generation...")
         yield json.dumps({"status": "generating_story"}) + "\n"
-        story = story_creator.create_story(character)
-        if not story:
-            logger.error("Story generation failed")
-            yield json.dumps({"error": "Story generation failed"}) + "\n"
-            return
-        logger.debug(f"Story generated successfully: {story}")
-        yield json.dumps({"status": "story_completed"}) + "\n"
-        
-        # Generate images
-        logger.debug("Starting image generation...")
-        scene_images = []
-        for i, scene in enumerate(story.scenes):
-            yield json.dumps({"status": "generating_image", "scene": i+1, "total": len(story.scenes)}) + "\n"
-            logger.debug(f"Generating image for scene: {scene.title}")
-            image_path = art_designer.generate_scene_image(scene, character)
-            if not image_path:
-                logger.error(f"Image generation failed for scene: {scene.title}")
-                yield json.dumps({"error": f"Image generation failed for scene: {scene.title}"}) + "\n"
+        story_started = time.monotonic()
+        # Generate images：场景按完成顺序推送进度
+        batch = art_designer.render_scenes(character, max_in_flight=CONFIG["comfyui"]["max_in_flight"],
+                                           preset=preset, quality=quality)
+        assembly = book_maker.start_book()
+        failures = []
+        try:
+            if stream:
+                # 流式模式：模型每写完一个场景就立即提交渲染
+                story = None
+                for kind, value in story_creator.stream_story(character, use_cache=use_cache):
+                    if kind == "scene":
+                        index, scene = value
+                        logger.debug(f"Queueing image for scene: {scene.title}")
+                        batch.submit(index, scene)
+                        yield json.dumps({"status": "scene_ready", "scene": index + 1, "title": scene.title}) + "\n"
+                    else:
+                        story = value
+                    yield from _image_events(batch.poll(), failures, assembly)
+                    if failures:
+                        break
+            else:
+                story = story_creator.create_story(character, use_cache=use_cache)
+
+            if failures:
+                yield json.dumps(failure_event(f"Image generation failed for scene: {failures[0]}",
+                                               art_designer.sd_service.pool)) + "\n"
                 return
-            scene_images.append(image_path)
-        yield json.dumps({"status": "images_completed"}) + "\n"
+            if not story:
+                logger.error("Story generation failed")
+                yield json.dumps(failure_event("Story generation failed", story_creator.llm)) + "\n"
+                return
+            logger.debug(f"Story generated successfully: {story}")
+            STAGE_SECONDS.observe(time.monotonic() - story_started, stage="story")
+            yield json.dumps({"status": "story_completed"}) + "\n"
+
+            if not stream:
+                # 所有场景一次性提交
+                logger.debug("Starting image generation...")
+                for i, scene in enumerate(story.scenes):
+                    logger.debug(f"Queueing image for scene: {scene.title}")
+                    batch.submit(i, scene)
+            batch.close(total=len(story.scenes))
+            yield from _image_events(batch.events(), failures, assembly)
+            if failures:
+                yield json.dumps(failure_event(f"Image generation failed for scene: {failures[0]}",
+                                               art_designer.sd_service.pool)) + "\n"
+                return
+        finally:
+            batch.shutdown()
+        scene_images = batch.ordered_images()
+        yield json.dumps(dict(batch.cache_summary(), status="images_completed")) + "\n"
         
-        # Generate storybook
+        # Generate storybook：场景页已在图片完成时预处理，这里只做拼装
         logger.debug("Starting storybook generation...")
-        book_path = book_maker.create_book(story, scene_images)
-        if not book_path:
+        with STAGE_SECONDS.time(stage="book"):
+            book = assembly.build(story, scene_images)
+        if not book:
             logger.error("Storybook generation failed")
             yield json.dumps({"error": "Storybook generation failed"}) + "\n"
             return
+        book_path = book["book_path"]
         logger.debug(f"Storybook generated successfully: {book_path}")
+        yield json.dumps(dict(book, status="book_completed")) + "\n"
         
+        # 保存故事记录，草稿之后可以通过 /stories/<id>/upgrade 升级
+        story_id = story_store.save(story_record(character, story, scene_images, batch.ordered_latents(),
+                                                 book_path, preset, quality))
+
         # 返回结果
         logger.debug("准备返回结果...")
-        yield json.dumps({
-            "status": "completed",
-            "character": {
-                'name': character.name,
-                'age': character.age,
-                'personality': character.personality,
-                'appearance': character.appearance,
-                'backstory': character.backstory
-            },
-            'story': {
-                'title': story.title,
-                'scenes': [{
-                    'title': scene.title,
-                    'description': scene.description,
-                    'image_path': image_path
-                } for scene, image_path in zip(story.scenes, scene_images)],
-                'moral': story.moral
-            },
-            'book_path': book_path
-        }) + "\n"
+        event = completed_event(character, story, scene_images, book_path, derivatives, static_files)
+        yield json.dumps(dict(event, story_id=story_id, quality=quality)) + "\n"
         
     except Exception as e:
         logger.error(f"发生错误: {str(e)}")
@@ -158,9 +389,176 @@ def generate_story_stream(user_input, character_data=None):
 def generate_story():
     user_input = request.json.get('description', '')
     character_data = request.json.get('character', None)
+    # "cache": "bypass" 时跳过 LLM 补全缓存
+    use_cache = request.json.get('cache') != 'bypass'
+    # "stream": true 时边生成故事边渲染场景
+    stream = bool(request.json.get('stream', False))
+    # "preset": 工作流风格预设名（CONFIG["workflows"]["presets"]）
+    preset = request.json.get('preset')
+    if preset is not None and preset not in CONFIG["workflows"]["presets"]:
+        return jsonify({"error": f"Unknown workflow preset: {preset}"}), 400
+    # "quality": "draft" 单遍低步数快速出图（可稍后升级），"final"（默认）为完整两遍渲染
+    quality = request.json.get('quality', 'final')
+    if quality not in QUALITIES:
+        return jsonify({"error": f"Unknown quality: {quality}"}), 400
     logger.debug(f"收到用户输入: {user_input}")
     logger.debug(f"收到角色数据: {character_data}")
-    return Response(generate_story_stream(user_input, character_data), mimetype='text/event-stream')
+    if generation_engine is not None:
+        events = generation_engine.stream(user_input, character_data, use_cache, stream, preset, quality)
+    else:
+        events = generate_story_stream(user_input, character_data, use_cache, stream, preset, quality)
+    return Response(events, mimetype='text/event-stream')
+
+# job_runner 在 generate_story_stream 定义之后创建（同步模式下由它执行任务）
+job_runner = JobRunner(job_store, engine=generation_engine, pipeline=generate_story_stream,
+                       max_workers=CONFIG["jobs"]["max_workers"])
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    """创建后台生成任务；参数与 /generate 相同"""
+    data = request.json or {}
+    preset = data.get('preset')
+    if preset is not None and preset not in CONFIG["workflows"]["presets"]:
+        return jsonify({"error": f"Unknown workflow preset: {preset}"}), 400
+    quality = data.get('quality', 'final')
+    if quality not in QUALITIES:
+        return jsonify({"error": f"Unknown quality: {quality}"}), 400
+    job_id = job_runner.submit(
+        data,
+        data.get('description', ''),
+        data.get('character', None),
+        use_cache=data.get('cache') != 'bypass',
+        stream=bool(data.get('stream', False)),
+        preset=preset,
+        quality=quality
+    )
+    logger.info(f"Created job {job_id}")
+    return jsonify({"id": job_id}), 202
+
+def upgrade_story_stream(story_id, record):
+    """
+    把草稿故事升级为最终质量：各场景在保存草稿潜在图的节点上只补做高清修复第二遍
+    （潜在图不可用时完整重新渲染），然后用新图片重新拼装绘本并更新故事记录
+    """
+    with STORIES_IN_FLIGHT.track_inprogress():
+        yield from _upgrade_story_stream(story_id, record)
+
+def _upgrade_story_stream(story_id, record):
+    try:
+        character, story = load_story(record)
+        scenes = record["scenes"]
+        total = len(scenes)
+        yield json.dumps({"status": "upgrading", "story_id": story_id, "total": total}) + "\n"
+        assembly = book_maker.start_book()
+        scene_images = [None] * total
+        upgraded = {"latent": 0, "rerender": 0}
+        with ThreadPoolExecutor(max_workers=max(1, min(CONFIG["comfyui"]["max_in_flight"], total)),
+                                thread_name_prefix="upgrade") as pool:
+            futures = {pool.submit(art_designer.upgrade_scene, scene, character, record["preset"],
+                                   item["latent"]): i
+                       for i, (scene, item) in enumerate(zip(story.scenes, scenes))}
+            for future in as_completed(futures):
+                index = futures[future]
+                result = future.result()
+                if not result:
+                    for pending in futures:
+                        pending.cancel()
+                    title = story.scenes[index].title
+                    logger.error(f"Image upgrade failed for scene: {title}")
+                    yield json.dumps(failure_event(f"Image generation failed for scene: {title}",
+                                                   art_designer.sd_service.pool)) + "\n"
+                    return
+                result.pop("latent", None)
+                scene_images[index] = result["image_path"]
+                upgraded[result["upgraded"]] += 1
+                assembly.add_image(result["image_path"])
+                yield json.dumps(dict(result, status="image_completed", scene=index + 1, total=total)) + "\n"
+        yield json.dumps({"status": "images_completed", "upgraded_from_latent": upgraded["latent"],
+                          "rerendered": upgraded["rerender"]}) + "\n"
+
+        with STAGE_SECONDS.time(stage="book"):
+            book = assembly.build(story, scene_images)
+        if not book:
+            logger.error("Storybook generation failed")
+            yield json.dumps({"error": "Storybook generation failed"}) + "\n"
+            return
+        yield json.dumps(dict(book, status="book_completed")) + "\n"
+
+        story_store.update(story_id, story_record(character, story, scene_images, [None] * total,
+                                                  book["book_path"], record["preset"], "final"))
+        event = completed_event(character, story, scene_images, book["book_path"], derivatives, static_files)
+        yield json.dumps(dict(event, story_id=story_id, quality="final")) + "\n"
+
+    except Exception as e:
+        logger.error(f"发生错误: {str(e)}")
+        logger.error(traceback.format_exc())
+        yield json.dumps({"error": str(e)}) + "\n"
+
+@app.route('/stories/<story_id>/upgrade', methods=['POST'])
+def upgrade_story(story_id):
+    """把 quality 为 "draft" 生成的故事升级为最终质量，以 NDJSON 推送进度（事件与 /generate 相同）"""
+    with upgrading_lock:
+        if story_id in upgrading:
+            return jsonify({"error": "Story is already being upgraded"}), 409
+        record = story_store.get(story_id)
+        if not record:
+            return jsonify({"error": "Story not found"}), 404
+        if record["quality"] != "draft":
+            return jsonify({"error": "Story is already final quality"}), 409
+        upgrading.add(story_id)
+
+    def release():
+        with upgrading_lock:
+            upgrading.discard(story_id)
+
+    if generation_engine is not None:
+        events = generation_engine.upgrade_stream(story_id, record)
+    else:
+        events = upgrade_story_stream(story_id, record)
+    response = Response(events, mimetype='text/event-stream')
+    # 响应结束（包括客户端断开、生成器从未开始）时释放
+    response.call_on_close(release)
+    return response
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_store.get_job(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    if not job_store.get_job(job_id):
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify({"id": job_id, "cancelled": job_runner.cancel(job_id)})
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """
+    以 NDJSON 返回任务事件：先补发 seq > after 的历史事件，再持续推送新事件，
+    任务结束后关闭连接。每个事件带 seq，断线后用最后收到的 seq 重新订阅。
+    """
+    if not job_store.get_job(job_id):
+        return jsonify({"error": "Job not found"}), 404
+    after = request.args.get('after', 0, type=int)
+
+    def stream(seq):
+        while True:
+            events = job_store.events_after(job_id, seq)
+            for seq, event in events:
+                yield json.dumps(dict(event, seq=seq)) + "\n"
+                if is_final_event(event):
+                    return
+            if not events:
+                job = job_store.get_job(job_id)
+                if job is None or job["status"] in FINISHED_STATUSES:
+                    return
+                if not job_store.wait_for_events(job_id, seq, timeout=15):
+                    # 空行作为心跳，便于尽早发现已断开的连接
+                    yield "\n"
+
+    return Response(stream(after), mimetype='text/event-stream')
 
 if __name__ == '__main__':
     # Enable Windows color support
@@ -0,0 +1,152 @@
+"""
+并发故事容量基准：同步流水线（每个用户一个线程）对比 asyncio 引擎。
+
+两种模式都对着本地假后端（benchmarks/fake_backends.py）跑同样数量的并发故事，
+统计完成数、总耗时、每分钟故事数、单个故事耗时分位数和峰值线程数。
+
+用法：python -m benchmarks.bench_engine --stories 8,32,64 --sync-workers 16
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_backends import FakeBackends  # noqa: E402
+from config import CONFIG  # noqa: E402
+
+
+class ThreadSampler:
+    """后台采样进程内的线程数"""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak = threading.active_count()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.peak = max(self.peak, threading.active_count())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stopped.set()
+        self._thread.join()
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return round(ordered[index], 2)
+
+
+def summarize(mode: str, stories: int, latencies: List[float], completed: int,
+              elapsed: float, peak_threads: int) -> Dict[str, Any]:
+    return {
+        "mode": mode,
+        "stories": stories,
+        "completed": completed,
+        "elapsed_seconds": round(elapsed, 2),
+        "stories_per_minute": round(completed / elapsed * 60, 1) if elapsed else 0.0,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "peak_threads": peak_threads
+    }
+
+
+def run_sync(app_module, stories: int, workers: int, stream: bool) -> Dict[str, Any]:
+    """同步流水线：每个故事占用一个请求线程（workers 为 0 时不限制）"""
+    def one_story(_):
+        started = time.monotonic()
+        events = [json.loads(line) for line in app_module.generate_story_stream(
+            "a curious cat", use_cache=False, stream=stream)]
+        return time.monotonic() - started, events[-1].get("status") == "completed"
+
+    with ThreadSampler() as sampler:
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=workers or stories) as pool:
+            results = list(pool.map(one_story, range(stories)))
+        elapsed = time.monotonic() - started
+    return summarize("sync", stories, [r[0] for r in results],
+                     sum(1 for r in results if r[1]), elapsed, sampler.peak)
+
+
+def run_async(engine, stories: int, stream: bool) -> Dict[str, Any]:
+    """asyncio 引擎：所有故事在同一个事件循环中并发"""
+    async def one_story():
+        events = []
+        started = time.monotonic()
+        await engine.generate(events.append, "a curious cat", use_cache=False, stream=stream)
+        return time.monotonic() - started, bool(events) and events[-1].get("status") == "completed"
+
+    async def all_stories():
+        return await asyncio.gather(*(one_story() for _ in range(stories)))
+
+    with ThreadSampler() as sampler:
+        started = time.monotonic()
+        results = asyncio.run_coroutine_threadsafe(all_stories(), engine._loop).result()
+        elapsed = time.monotonic() - started
+    return summarize("async", stories, [r[0] for r in results],
+                     sum(1 for r in results if r[1]), elapsed, sampler.peak)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent story capacity: sync vs asyncio engine")
+    parser.add_argument('--stories', default="8,32,64", help="逗号分隔的并发故事数")
+    parser.add_argument('--sync-workers', type=int, default=16,
+                        help="同步模式的请求线程数（模拟 WSGI 线程池），0 表示每个故事一个线程")
+    parser.add_argument('--llm-seconds', type=float, default=1.0)
+    parser.add_argument('--render-seconds', type=float, default=2.0)
+    parser.add_argument('--stream', action='store_true', help="使用流式故事生成")
+    parser.add_argument('--json', dest='json_path', help="把结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    backends = FakeBackends(lm_port=18898, comfy_port=18899,
+                            llm_seconds=args.llm_seconds, render_seconds=args.render_seconds).start()
+    CONFIG["lm_studio"]["api_url"] = backends.lm_url
+    CONFIG["comfyui"]["api_url"] = backends.comfy_url
+    CONFIG["lm_studio"]["pool_size"] = CONFIG["comfyui"]["pool_size"] = 64
+    CONFIG["lm_studio"]["max_concurrency"] = 64
+    CONFIG["render_cache"]["enabled"] = False
+    CONFIG["llm_cache"]["enabled"] = False
+    CONFIG["engine"]["mode"] = "async"
+
+    import app as app_module
+    logging.getLogger().setLevel(logging.WARNING)
+    app_module.book_maker.output_dir = tempfile.mkdtemp(prefix="bench_books_")
+    engine = app_module.generation_engine
+    if engine is None:
+        sys.exit("aiohttp is required for the async engine benchmark")
+
+    results = []
+    for stories in [int(n) for n in args.stories.split(',')]:
+        for result in (run_sync(app_module, stories, args.sync_workers, args.stream),
+                       run_async(engine, stories, args.stream)):
+            results.append(result)
+            print(f"{result['mode']:>5}  stories={result['stories']:<4} completed={result['completed']:<4} "
+                  f"elapsed={result['elapsed_seconds']:>6}s  stories/min={result['stories_per_minute']:>7}  "
+                  f"p50={result['latency_p50']:>6}s  p95={result['latency_p95']:>6}s  "
+                  f"threads={result['peak_threads']}")
+
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump({"llm_seconds": args.llm_seconds, "render_seconds": args.render_seconds,
+                       "sync_workers": args.sync_workers, "results": results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+"""
+端到端负载基准：在子进程中启动服务（benchmarks/serve.py），后端为本地假 LM Studio / ComfyUI，
+N 个并发客户端通过 HTTP 反复请求 /generate。
+
+统计首个事件时间（TTFE）、各阶段耗时分位数、每分钟完成故事数、错误分布，
+以及服务进程（含排版子进程）的 CPU 与 RSS。结果写成 JSON，便于跨提交比较。
+
+用法：python -m benchmarks.bench_load --clients 1,8,32 --stories-per-client 2 \
+    --render-latency lognormal:2.0,0.3 --image-noise 0.3 --json results.json
+
+多个 ComfyUI 节点（节点池的派发与故障转移）：--comfy-nodes 3 --render-slots 1 --kill-node-after 20
+在第一轮开始 20 秒后让最后一个节点宕机，结果中 nodes 为各节点收到的 prompt 数。
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_engine import percentile  # noqa: E402
+from benchmarks.fake_backends import add_backend_arguments, backends_from_args  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 阶段名 -> (开始事件, 结束事件)；图片按场景单独统计
+STAGES = {
+    "character": ("generating_character", "character_completed"),
+    "story": ("generating_story", "story_completed"),
+    "images": ("story_completed", "images_completed"),
+    "book": ("images_completed", "book_completed"),
+    "result": ("book_completed", "completed"),
+}
+
+
+class ProcessSampler:
+    """按固定间隔读取 /proc，统计进程及其子进程的 CPU 占用和 RSS（仅 Linux）"""
+
+    def __init__(self, pid: int, interval: float = 0.25):
+        self.pid = pid
+        self.interval = interval
+        self.cpu_percent: List[float] = []
+        self.rss_bytes: List[int] = []
+        self.cpu_seconds = 0.0
+        self._page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+        self._ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _tree(self) -> List[int]:
+        children: Dict[int, List[int]] = {}
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                stat = self._stat(int(entry))
+                if stat:
+                    children.setdefault(int(stat[1]), []).append(int(entry))
+        pids, queue = [], [self.pid]
+        while queue:
+            pid = queue.pop()
+            pids.append(pid)
+            queue.extend(children.get(pid, []))
+        return pids
+
+    @staticmethod
+    def _stat(pid: int) -> Optional[List[str]]:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                # comm 字段可能含空格，从最后一个 ')' 之后开始解析
+                return f.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            return None
+
+    def _sample(self):
+        cpu_ticks, rss_pages = 0, 0
+        for pid in self._tree():
+            stat = self._stat(pid)
+            if stat:
+                cpu_ticks += int(stat[11]) + int(stat[12])  # utime + stime
+                rss_pages += int(stat[21])
+        return cpu_ticks / self._ticks, rss_pages * self._page_size
+
+    def _run(self):
+        last_cpu, _ = self._sample()
+        first_cpu, last_time = last_cpu, time.monotonic()
+        while not self._stopped.wait(self.interval):
+            cpu, rss = self._sample()
+            now = time.monotonic()
+            self.cpu_percent.append((cpu - last_cpu) / (now - last_time) * 100)
+            self.rss_bytes.append(rss)
+            last_cpu, last_time = cpu, now
+        self.cpu_seconds = last_cpu - first_cpu
+
+    def __enter__(self):
+        if os.path.isdir("/proc"):
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def summary(self) -> Dict[str, Any]:
+        if not self.rss_bytes:
+            return {"cpu_seconds": None, "cpu_percent_avg": None, "cpu_percent_peak": None,
+                    "rss_mb_peak": None, "rss_mb_end": None}
+        return {
+            "cpu_seconds": round(self.cpu_seconds, 2),
+            "cpu_percent_avg": round(sum(self.cpu_percent) / len(self.cpu_percent), 1),
+            "cpu_percent_peak": round(max(self.cpu_percent), 1),
+            "rss_mb_peak": round(max(self.rss_bytes) / 1024 ** 2, 1),
+            "rss_mb_end": round(self.rss_bytes[-1] / 1024 ** 2, 1)
+        }
+
+
+def run_story(base_url: str, stream: bool) -> Dict[str, Any]:
+    """请求一次 /generate，记录每个事件相对请求开始的时间"""
+    started = time.monotonic()
+    timings: Dict[str, float] = {}
+    image_starts: Dict[int, float] = {}
+    image_seconds: List[float] = []
+    error = None
+    try:
+        with requests.post(f"{base_url}/generate", json={"description": "a curious cat", "stream": stream},
+                           stream=True, timeout=(5, 600)) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                now = time.monotonic() - started
+                event = json.loads(line)
+                timings.setdefault("first_event", now)
+                if "error" in event:
+                    error = event["error"]
+                    break
+                status = event.get("status")
+                if status == "generating_image":
+                    image_starts[event["scene"]] = now
+                elif status == "image_completed" and event["scene"] in image_starts:
+                    image_seconds.append(now - image_starts[event["scene"]])
+                timings.setdefault(status, now)
+    except requests.RequestException as e:
+        error = f"{type(e).__name__}: {str(e)}"
+    return {"timings": timings, "image_seconds": image_seconds,
+            "completed": "completed" in timings, "error": error}
+
+
+def distribution(values: List[float]) -> Dict[str, float]:
+    return {"p50": percentile(values, 50), "p90": percentile(values, 90),
+            "p99": percentile(values, 99), "max": round(max(values), 2) if values else 0.0}
+
+
+def summarize(clients: int, results: List[Dict[str, Any]], elapsed: float,
+              sampler: ProcessSampler) -> Dict[str, Any]:
+    completed = [r for r in results if r["completed"]]
+    stages = {}
+    for name, (start, end) in STAGES.items():
+        stages[name] = distribution([r["timings"][end] - r["timings"][start]
+                                     for r in completed if start in r["timings"]])
+    stages["image"] = distribution([s for r in completed for s in r["image_seconds"]])
+    return dict({
+        "clients": clients,
+        "stories": len(results),
+        "completed": len(completed),
+        "errors": dict(Counter(r["error"] for r in results if r["error"])),
+        "elapsed_seconds": round(elapsed, 2),
+        "stories_per_minute": round(len(completed) / elapsed * 60, 1) if elapsed else 0.0,
+        "ttfe": distribution([r["timings"]["first_event"] for r in results if "first_event" in r["timings"]]),
+        "total": distribution([r["timings"]["completed"] for r in completed]),
+        "stages": stages
+    }, **sampler.summary())
+
+
+def run_level(base_url: str, server_pid: int, clients: int, stories_per_client: int,
+              stream: bool) -> Dict[str, Any]:
+    def client(_):
+        return [run_story(base_url, stream) for _ in range(stories_per_client)]
+
+    with ProcessSampler(server_pid) as sampler:
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            results = [r for batch in pool.map(client, range(clients)) for r in batch]
+        elapsed = time.monotonic() - started
+    return summarize(clients, results, elapsed, sampler)
+
+
+def wait_until_ready(base_url: str, process: subprocess.Popen, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            sys.exit(f"Server exited with code {process.returncode}")
+        try:
+            if requests.get(base_url + "/", timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    sys.exit("Server did not start in time")
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end /generate load test against fake backends")
+    parser.add_argument('--clients', default="1,8,32", help="逗号分隔的并发客户端数，依次测试")
+    parser.add_argument('--stories-per-client', type=int, default=2, help="每个客户端连续生成的故事数")
+    parser.add_argument('--engine', choices=["async", "sync"], default="async")
+    parser.add_argument('--stream', action='store_true', help="使用流式故事生成")
+    parser.add_argument('--port', type=int, default=18901)
+    parser.add_argument('--lm-port', type=int, default=18898)
+    parser.add_argument('--comfy-port', type=int, default=18910, help="第一个 ComfyUI 节点的端口，其余节点依次递增")
+    parser.add_argument('--kill-node-after', type=float, default=None,
+                        help="第一轮开始多少秒后让最后一个 ComfyUI 节点宕机（测试故障转移）")
+    parser.add_argument('--json', dest='json_path', help="把结果写入 JSON 文件")
+    add_backend_arguments(parser)
+    args = parser.parse_args()
+    if args.comfy_port <= args.port < args.comfy_port + args.comfy_nodes:
+        sys.exit(f"--port {args.port} overlaps the ComfyUI node ports")
+
+    backends = backends_from_args(args, args.lm_port, args.comfy_port).start()
+    base_url = f"http://127.0.0.1:{args.port}"
+    server = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.serve", "--port", str(args.port), "--engine", args.engine,
+         "--lm-url", backends.lm_url, "--comfy-url", ",".join(backends.comfy_urls)],
+        cwd=ROOT, stdout=subprocess.DEVNULL)
+    results = []
+    try:
+        wait_until_ready(base_url, server)
+        if args.kill_node_after is not None:
+            killer = threading.Timer(args.kill_node_after, backends.stop_comfy_node, (len(backends.comfy_nodes) - 1,))
+            killer.daemon = True
+            killer.start()
+        for clients in [int(n) for n in args.clients.split(',')]:
+            result = run_level(base_url, server.pid, clients, args.stories_per_client, args.stream)
+            results.append(result)
+            print(f"clients={clients:<4} completed={result['completed']}/{result['stories']:<4} "
+                  f"stories/min={result['stories_per_minute']:>7}  ttfe_p50={result['ttfe']['p50']}s  "
+                  f"total_p50={result['total']['p50']}s  total_p99={result['total']['p99']}s  "
+                  f"cpu_avg={result['cpu_percent_avg']}%  rss_peak={result['rss_mb_peak']}MB  "
+                  f"errors={sum(result['errors'].values())}")
+        if len(backends.comfy_nodes) > 1:
+            print("prompts per node: " + "  ".join(f"{node.url}={node.prompts}" for node in backends.comfy_nodes))
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                "commit": git_commit(),
+                "timestamp": datetime.now().isoformat(timespec="seconds"),
+                "engine": args.engine,
+                "stream": args.stream,
+                "stories_per_client": args.stories_per_client,
+                "backends": {
+                    "llm_latency": args.llm_latency,
+                    "chunk_seconds": args.chunk_seconds,
+                    "render_latency": args.render_latency,
+                    "llm_failure_rate": args.llm_failure_rate,
+                    "render_failure_rate": args.render_failure_rate,
+                    "image_size": args.image_size,
+                    "image_noise": args.image_noise,
+                    "comfy_nodes": args.comfy_nodes,
+                    "render_slots": args.render_slots,
+                    "kill_node_after": args.kill_node_after
+                },
+                "nodes": [{"url": node.url, "prompts": node.prompts, "render_failures": node.render_failures}
+                          for node in backends.comfy_nodes],
+                "results": results
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
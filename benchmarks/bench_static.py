@@ -0,0 +1,205 @@
+"""
+/static/images 重复访问基准：原来的 send_from_directory 对比 StaticFiles。
+
+用一个临时目录中的若干张场景大小的 PNG 启动本地 Flask 服务，
+N 个模拟浏览器（各自带一个遵守 Cache-Control / ETag 的简易 HTTP 缓存）
+先冷加载一次页面的全部图片，再重复访问若干次，统计重复访问阶段的
+每秒页面浏览数、到达服务器的请求数、304 数和传输字节数。
+浏览器缓存命中时请求根本不到服务器，所以另外直接测服务器的吞吐：
+没有缓存的客户端重复获取全部图片（uncached），以及每次都带 If-None-Match
+重新验证、得到 304 的客户端（revalidate）。
+
+用法：python -m benchmarks.bench_static --clients 8 --views 20 --images 6
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import requests
+from flask import Flask, abort, send_from_directory
+from werkzeug.serving import make_server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.static_files import StaticFiles  # noqa: E402
+
+
+class BrowserCache:
+    """按 Cache-Control 的 max-age / immutable 和 ETag 工作的最小浏览器缓存"""
+
+    def __init__(self):
+        self.session = requests.Session()
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.requests = 0
+        self.not_modified = 0
+        self.bytes = 0
+
+    def get(self, url: str) -> bytes:
+        entry = self.entries.get(url)
+        if entry and entry["expires"] > time.monotonic():
+            return entry["body"]
+        headers = {"If-None-Match": entry["etag"]} if entry and entry["etag"] else {}
+        response = self.session.get(url, headers=headers)
+        self.requests += 1
+        self.bytes += len(response.content)
+        if response.status_code == 304:
+            self.not_modified += 1
+            entry["expires"] = self._expires(response)
+            return entry["body"]
+        response.raise_for_status()
+        self.entries[url] = {"body": response.content, "etag": response.headers.get("ETag"),
+                             "expires": self._expires(response)}
+        return response.content
+
+    @staticmethod
+    def _expires(response) -> float:
+        cache_control = response.headers.get("Cache-Control", "")
+        for directive in cache_control.split(","):
+            name, _, value = directive.strip().partition("=")
+            if name == "max-age" and "no-cache" not in cache_control:
+                return time.monotonic() + int(value)
+        return 0.0
+
+
+def make_images(directory: str, count: int, width: int, height: int) -> List[str]:
+    """生成与场景图大小相近、不可压缩的 PNG"""
+    from PIL import Image
+    names = []
+    for i in range(count):
+        name = f"scene_{i:032x}.png"
+        Image.frombytes("RGB", (width, height), os.urandom(width * height * 3)).save(
+            os.path.join(directory, name))
+        names.append(name)
+    return names
+
+
+def make_app(directory: str) -> Flask:
+    app = Flask(__name__)
+    static_files = StaticFiles(directory)
+
+    @app.route('/before/<path:filename>')
+    def before(filename):
+        return send_from_directory(directory, filename)
+
+    @app.route('/static/images/<path:filename>')
+    def after(filename):
+        path = static_files.resolve(filename)
+        if not path:
+            abort(404)
+        return static_files.send(path)
+
+    app.static_files = static_files
+    return app
+
+
+def server_throughput(base_url: str, urls: List[str], clients: int, views: int) -> Dict[str, Any]:
+    """不经过浏览器缓存，直接测服务器每秒处理的完整获取请求数和 If-None-Match 重新验证请求数"""
+    sessions = [requests.Session() for _ in range(clients)]
+    etags = {url: sessions[0].get(base_url + url).headers.get("ETag") for url in urls}
+    statuses: Dict[int, int] = {}
+    lock = threading.Lock()
+
+    def fetch(session: requests.Session, revalidate: bool) -> int:
+        received = 0
+        for _ in range(views):
+            for url in urls:
+                headers = {"If-None-Match": etags[url]} if revalidate and etags[url] else {}
+                response = session.get(base_url + url, headers=headers)
+                received += len(response.content)
+                with lock:
+                    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        return received
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        for phase, revalidate in (("uncached", False), ("revalidate", True)):
+            statuses.clear()
+            started = time.monotonic()
+            received = sum(pool.map(lambda session: fetch(session, revalidate), sessions))
+            seconds = time.monotonic() - started
+            requests_sent = clients * views * len(urls)
+            results[f"{phase}_requests_per_second"] = round(requests_sent / seconds, 1)
+            results[f"{phase}_bytes"] = received
+            results[f"{phase}_not_modified"] = statuses.get(304, 0)
+    return results
+
+
+def run(base_url: str, urls: List[str], clients: int, views: int) -> Dict[str, Any]:
+    browsers = [BrowserCache() for _ in range(clients)]
+
+    def view(browser: BrowserCache):
+        for url in urls:
+            browser.get(base_url + url)
+
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        started = time.monotonic()
+        list(pool.map(view, browsers))
+        cold_seconds = time.monotonic() - started
+        cold_requests = sum(b.requests for b in browsers)
+        cold_bytes = sum(b.bytes for b in browsers)
+
+        started = time.monotonic()
+        list(pool.map(lambda b: [view(b) for _ in range(views)], browsers))
+        repeat_seconds = time.monotonic() - started
+
+    repeat_requests = sum(b.requests for b in browsers) - cold_requests
+    return {
+        "cold_page_views_per_second": round(clients / cold_seconds, 1),
+        "cold_bytes": cold_bytes,
+        "repeat_page_views": clients * views,
+        "repeat_page_views_per_second": round(clients * views / repeat_seconds, 1),
+        "repeat_requests": repeat_requests,
+        "repeat_not_modified": sum(b.not_modified for b in browsers),
+        "repeat_bytes": sum(b.bytes for b in browsers) - cold_bytes
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Repeat-view throughput of /static/images: before vs after")
+    parser.add_argument('--clients', type=int, default=8, help="并发模拟浏览器数")
+    parser.add_argument('--views', type=int, default=20, help="每个浏览器的重复访问次数")
+    parser.add_argument('--images', type=int, default=6, help="每个页面的图片数")
+    parser.add_argument('--size', default="1000x600", help="图片尺寸")
+    parser.add_argument('--port', type=int, default=18900)
+    parser.add_argument('--json', dest='json_path', help="把结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    width, height = (int(v) for v in args.size.split('x'))
+    directory = tempfile.mkdtemp(prefix="bench_static_")
+    server = None
+    try:
+        names = make_images(directory, args.images, width, height)
+        app = make_app(directory)
+        server = make_server("127.0.0.1", args.port, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{args.port}"
+
+        versioned = [app.static_files.url(os.path.join(directory, name)) for name in names]
+        # 浏览器缓存下的页面浏览（after 模式重复访问基本不发请求）与服务器本身的吞吐分开报告
+        results = {}
+        for mode, urls in (("before", [f"/before/{name}" for name in names]), ("after", versioned)):
+            results[mode] = {"browser_cache": run(base_url, urls, args.clients, args.views),
+                             "server": server_throughput(base_url, urls, args.clients, args.views)}
+        for mode, result in results.items():
+            print(mode, json.dumps(result))
+        if args.json_path:
+            with open(args.json_path, 'w', encoding='utf-8') as f:
+                json.dump({"clients": args.clients, "views": args.views, "images": args.images,
+                           "results": results}, f, indent=2)
+    finally:
+        if server is not None:
+            server.shutdown()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,441 @@
+"""
+本地假 LM Studio / ComfyUI 后端，用于基准测试。
+
+只实现本项目用到的接口：/v1/models、/v1/chat/completions（含 SSE 流式）、
+/system_stats、/queue、/object_info、/prompt、/ws、/history、/view。
+延迟分布、失败率和图片大小可配置，不占用 GPU。ComfyUI 可以有多个节点（端口依次递增），
+用于测试节点池的派发和故障转移。
+
+单独运行：python -m benchmarks.fake_backends --lm-port 8898 --comfy-port 8899 \
+    --render-latency lognormal:2.0,0.3 --render-failure-rate 0.05 --comfy-nodes 2
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import sys
+import threading
+import uuid
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
+
+from aiohttp import web
+from PIL import Image
+
+STORY = {
+    "title": "The Brave Little Cat",
+    "theme": "courage",
+    "target_age_range": "4-8",
+    "scenes": [
+        {"title": f"Scene {i + 1}", "description": f"The cat explores place {i + 1}.",
+         "image_prompt": f"a small cat in place {i + 1}, watercolor"}
+        for i in range(4)
+    ],
+    "moral": "Be brave."
+}
+
+CHARACTER = {
+    "name": "Mimi",
+    "age": 5,
+    "personality": "curious and kind",
+    "appearance": {"physical_traits": ["Species: cat", "Eyes: green"]},
+    "backstory": "Mimi lives in a quiet village."
+}
+
+
+class Latency:
+    """
+    延迟分布（秒）："2.0" 固定值，"uniform:1,3"，"normal:2,0.5"（截断到 0 以上），
+    "lognormal:2,0.3"（中位数与对数标准差，适合有长尾的推理耗时）
+    """
+
+    KINDS = ("fixed", "uniform", "normal", "lognormal")
+
+    def __init__(self, kind: str = "fixed", a: float = 0.0, b: float = 0.0):
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown latency distribution: {kind}")
+        self.kind = kind
+        self.a = a
+        self.b = b
+
+    @classmethod
+    def parse(cls, spec: Union[str, float, "Latency"]) -> "Latency":
+        if isinstance(spec, Latency):
+            return spec
+        if isinstance(spec, (int, float)):
+            return cls("fixed", float(spec))
+        kind, _, params = spec.partition(':')
+        if not params:
+            return cls("fixed", float(kind))
+        values = [float(v) for v in params.split(',')]
+        return cls(kind, *values)
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "uniform":
+            return rng.uniform(self.a, self.b)
+        if self.kind == "normal":
+            return max(0.0, rng.gauss(self.a, self.b))
+        if self.kind == "lognormal":
+            return self.a * rng.lognormvariate(0.0, self.b)
+        return self.a
+
+    def __str__(self) -> str:
+        return str(self.a) if self.kind == "fixed" else f"{self.kind}:{self.a},{self.b}"
+
+
+def make_pngs(size: Tuple[int, int], variants: int = 1, noise: float = 0.0, seed: int = 0) -> List[bytes]:
+    """生成若干张 PNG；noise（0–1）越大越难压缩，用来模拟真实插画的文件大小"""
+    rng = random.Random(seed)
+    images = []
+    for _ in range(max(1, variants)):
+        color = tuple(rng.randrange(256) for _ in range(3))
+        image = Image.new('RGB', size, color)
+        if noise > 0:
+            image = Image.blend(image, Image.frombytes('RGB', size, os.urandom(size[0] * size[1] * 3)), noise)
+        buffer = io.BytesIO()
+        image.save(buffer, 'PNG')
+        images.append(buffer.getvalue())
+    return images
+
+
+# /object_info 中列出的节点类型（项目工作流用到的）
+NODE_CLASSES = ("CheckpointLoaderSimple", "LoraLoader", "CLIPTextEncode", "EmptyLatentImage", "KSampler",
+                "LatentUpscale", "VAEDecode", "SaveImage", "PreviewImage", "SaveLatent", "LoadLatent")
+
+# 假 GPU 的显存（字节）；每个运行中的任务占用 VRAM_PER_RENDER
+VRAM_TOTAL = 24 * 1024 ** 3
+VRAM_PER_RENDER = 6 * 1024 ** 3
+
+
+class FakeComfyUI:
+    """
+    一个假 ComfyUI 节点。同时最多执行 render_slots 个 prompt（0 为不限；真实 ComfyUI 为 1），
+    其余在队列中等待；/queue 和 /ws 的 status 消息报告运行中与等待中的任务。
+    SaveLatent 节点输出保存的潜在图，LoadLatent 只接受本节点保存过的潜在图（与真实 ComfyUI 一样
+    在 /prompt 校验，否则返回 400），用于测试草稿升级
+    """
+
+    def __init__(self, backends: "FakeBackends", port: int, render_slots: int = 0):
+        self.backends = backends
+        self.port = port
+        self.prompts = 0
+        self.render_failures = 0
+        self._slots = asyncio.Semaphore(render_slots if render_slots > 0 else sys.maxsize)
+        self._clients: Dict[str, web.WebSocketResponse] = {}
+        self._history: Dict[str, dict] = {}
+        self._latents: Set[str] = set()  # 已保存的潜在图（LoadLatent 的 "subfolder/filename [output]"）
+        self.latents_loaded = 0
+        # prompt_id -> /queue 条目 [number, prompt_id, prompt, extra_data, outputs]
+        self._running: Dict[str, List[Any]] = {}
+        self._pending: Dict[str, List[Any]] = {}
+        self._tasks: Set[asyncio.Future] = set()
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def _status_message(self) -> str:
+        remaining = len(self._running) + len(self._pending)
+        return json.dumps({"type": "status", "data": {"status": {"exec_info": {"queue_remaining": remaining}}}})
+
+    async def _broadcast_status(self):
+        message = self._status_message()
+        for ws in list(self._clients.values()):
+            if not ws.closed:
+                await ws.send_str(message)
+
+    async def _system_stats(self, request):
+        vram_free = max(0, VRAM_TOTAL - VRAM_PER_RENDER * len(self._running))
+        return web.json_response({"system": {}, "devices": [
+            {"name": "fake", "type": "cuda", "index": 0, "vram_total": VRAM_TOTAL, "vram_free": vram_free}]})
+
+    async def _queue(self, request):
+        return web.json_response({"queue_running": list(self._running.values()),
+                                  "queue_pending": list(self._pending.values())})
+
+    async def _object_info(self, request):
+        return web.json_response({name: {"name": name, "input": {"required": {}}, "output": []}
+                                  for name in NODE_CLASSES})
+
+    async def _ws(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        client_id = request.query.get('clientId', '')
+        self._clients[client_id] = ws
+        await ws.send_str(self._status_message())
+        async for _ in ws:
+            pass
+        self._clients.pop(client_id, None)
+        return ws
+
+    def _invalid_latents(self, graph: Dict[str, Any]) -> Dict[str, Any]:
+        """LoadLatent 引用了本节点没有的潜在图时的 node_errors"""
+        errors = {}
+        for node_id, node in graph.items():
+            if node.get("class_type") == "LoadLatent" and node["inputs"].get("latent") not in self._latents:
+                errors[node_id] = {"errors": [{"type": "value_not_in_list", "message": "Value not in list",
+                                               "details": f"latent: '{node['inputs'].get('latent')}'"}],
+                                   "class_type": "LoadLatent"}
+        return errors
+
+    async def _prompt(self, request):
+        body = await request.json()
+        graph = body.get('prompt') or {}
+        node_errors = self._invalid_latents(graph)
+        if node_errors:
+            return web.json_response({"error": {"type": "prompt_outputs_failed_validation",
+                                                "message": "Prompt outputs failed validation"},
+                                      "node_errors": node_errors}, status=400)
+        self.latents_loaded += sum(1 for node in graph.values() if node.get("class_type") == "LoadLatent")
+        prompt_id = uuid.uuid4().hex
+        self.prompts += 1
+        self._pending[prompt_id] = [self.prompts, prompt_id, graph,
+                                    {"client_id": body.get('client_id')}, []]
+        task = asyncio.ensure_future(self._execute(prompt_id, body.get('client_id')))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        await self._broadcast_status()
+        return web.json_response({"prompt_id": prompt_id, "number": self.prompts})
+
+    async def _execute(self, prompt_id: str, client_id: Optional[str]):
+        backends = self.backends
+        async with self._slots:
+            self._running[prompt_id] = entry = self._pending.pop(prompt_id)
+            try:
+                await asyncio.sleep(backends.render_latency.sample(backends._rng))
+                if backends._rng.random() < backends.render_failure_rate:
+                    self.render_failures += 1
+                    self._history[prompt_id] = {"outputs": {},
+                                                "status": {"status_str": "error", "completed": False}}
+                    messages = [("execution_error", {"exception_message": "simulated failure"})]
+                else:
+                    outputs = self._outputs(prompt_id, entry[2])
+                    self._history[prompt_id] = {"outputs": outputs}
+                    messages = [("executed", {"node": node_id, "output": output})
+                                for node_id, output in outputs.items()] + [("executing", {"node": None})]
+            finally:
+                self._running.pop(prompt_id, None)
+        ws = self._clients.get(client_id)
+        if ws is not None and not ws.closed:
+            for msg_type, data in messages:
+                await ws.send_str(json.dumps({"type": msg_type, "data": dict(data, prompt_id=prompt_id)}))
+        await self._broadcast_status()
+
+    def _outputs(self, prompt_id: str, graph: Dict[str, Any]) -> Dict[str, Any]:
+        """工作流各输出节点的结果：SaveImage 的图片和 SaveLatent 的潜在图（图中没有 SaveImage 时用节点 12）"""
+        outputs = {}
+        for node_id, node in graph.items():
+            class_type = node.get("class_type")
+            if class_type == "SaveImage":
+                outputs[node_id] = {"images": [{"filename": f"{prompt_id}_{node_id}.png", "subfolder": "",
+                                                "type": "output"}]}
+            elif class_type == "SaveLatent":
+                prefix = node["inputs"].get("filename_prefix", "latents/ComfyUI")
+                subfolder, _, name = prefix.rpartition('/')
+                latent = {"filename": f"{name}_{prompt_id}.latent", "subfolder": subfolder, "type": "output"}
+                self._latents.add(f"{subfolder}/{latent['filename']} [output]" if subfolder
+                                  else f"{latent['filename']} [output]")
+                outputs[node_id] = {"latents": [latent]}
+        if not any("images" in output for output in outputs.values()):
+            outputs["12"] = {"images": [{"filename": f"{prompt_id}.png", "subfolder": "", "type": "output"}]}
+        return outputs
+
+    async def _get_history(self, request):
+        prompt_id = request.match_info['prompt_id']
+        entry = self._history.get(prompt_id)
+        return web.json_response({prompt_id: entry} if entry else {})
+
+    async def _post_history(self, request):
+        body = await request.json()
+        for prompt_id in body.get('delete', []):
+            self._history.pop(prompt_id, None)
+        return web.json_response({})
+
+    async def _view(self, request):
+        # 同一个输出文件总是返回同一张图
+        pngs = self.backends._pngs
+        png = pngs[hash(request.query.get('filename', '')) % len(pngs)]
+        return web.Response(body=png, content_type='image/png')
+
+    async def start(self):
+        app = web.Application()
+        app.add_routes([web.get('/system_stats', self._system_stats),
+                        web.get('/queue', self._queue),
+                        web.get('/object_info', self._object_info),
+                        web.get('/ws', self._ws),
+                        web.post('/prompt', self._prompt),
+                        web.get('/history/{prompt_id}', self._get_history),
+                        web.post('/history', self._post_history),
+                        web.get('/view', self._view)])
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', self.port).start()
+
+    async def stop(self):
+        """模拟节点宕机：断开 /ws、放弃执行中的任务并停止监听"""
+        if self._runner is None:
+            return
+        runner, self._runner = self._runner, None
+        for ws in list(self._clients.values()):
+            await ws.close()
+        for task in list(self._tasks):
+            task.cancel()
+        await runner.cleanup()
+
+
+class FakeBackends:
+    """在后台线程的事件循环中同时运行两个假后端"""
+
+    def __init__(self,
+                 lm_port: int = 8898,
+                 comfy_port: int = 8899,
+                 llm_seconds: Union[str, float, Latency] = 1.0,
+                 chunk_seconds: float = 0.02,
+                 render_seconds: Union[str, float, Latency] = 2.0,
+                 image_size=(1000, 600),
+                 image_variants: int = 1,
+                 image_noise: float = 0.0,
+                 llm_failure_rate: float = 0.0,
+                 render_failure_rate: float = 0.0,
+                 seed: Optional[int] = None,
+                 comfy_nodes: int = 1,
+                 render_slots: int = 0):
+        self.lm_port = lm_port
+        self.comfy_port = comfy_port
+        self.llm_latency = Latency.parse(llm_seconds)
+        self.chunk_seconds = chunk_seconds
+        self.render_latency = Latency.parse(render_seconds)
+        self.llm_failure_rate = llm_failure_rate
+        self.render_failure_rate = render_failure_rate
+        self.llm_failures = 0
+        self._rng = random.Random(seed)
+        self.comfy_nodes = [FakeComfyUI(self, comfy_port + i, render_slots) for i in range(max(1, comfy_nodes))]
+        self._pngs = make_pngs(image_size, image_variants, image_noise, seed or 0)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._runners = []
+
+    @property
+    def lm_url(self) -> str:
+        return f"http://127.0.0.1:{self.lm_port}"
+
+    @property
+    def comfy_url(self) -> str:
+        return self.comfy_nodes[0].url
+
+    @property
+    def comfy_urls(self) -> List[str]:
+        return [node.url for node in self.comfy_nodes]
+
+    @property
+    def prompts(self) -> int:
+        return sum(node.prompts for node in self.comfy_nodes)
+
+    @property
+    def render_failures(self) -> int:
+        return sum(node.render_failures for node in self.comfy_nodes)
+
+    # LM Studio
+
+    async def _models(self, request):
+        return web.json_response({"data": [{"id": "fake"}]})
+
+    async def _chat(self, request):
+        body = await request.json()
+        if self._rng.random() < self.llm_failure_rate:
+            self.llm_failures += 1
+            await asyncio.sleep(self.llm_latency.sample(self._rng) / 4)
+            return web.json_response({"error": "simulated failure"}, status=500)
+        is_story = 'story' in body['messages'][0]['content']
+        text = json.dumps(STORY if is_story else CHARACTER)
+        if body.get('stream'):
+            response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+            await response.prepare(request)
+            for i in range(0, len(text), 24):
+                chunk = {"choices": [{"delta": {"content": text[i:i + 24]}}]}
+                await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                await asyncio.sleep(self.chunk_seconds)
+            await response.write(b"data: [DONE]\n\n")
+            return response
+        await asyncio.sleep(self.llm_latency.sample(self._rng))
+        return web.json_response({"choices": [{"message": {"content": text}}],
+                                  "usage": {"completion_tokens": len(text) // 4}})
+
+    # 运行
+
+    async def _serve(self):
+        lm = web.Application()
+        lm.add_routes([web.get('/v1/models', self._models),
+                       web.post('/v1/chat/completions', self._chat)])
+        runner = web.AppRunner(lm)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', self.lm_port).start()
+        self._runners.append(runner)
+        for node in self.comfy_nodes:
+            await node.start()
+
+    def start(self):
+        """在后台线程中启动，返回时所有端口都已在监听"""
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name="fake-backends", daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self._serve(), self._loop).result()
+        return self
+
+    def stop_comfy_node(self, index: int):
+        """让第 index 个 ComfyUI 节点宕机（测试故障转移）"""
+        asyncio.run_coroutine_threadsafe(self.comfy_nodes[index].stop(), self._loop).result()
+
+    def stop(self):
+        async def cleanup():
+            for runner in self._runners:
+                await runner.cleanup()
+            for node in self.comfy_nodes:
+                await node.stop()
+        asyncio.run_coroutine_threadsafe(cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+def add_backend_arguments(parser: argparse.ArgumentParser):
+    """假后端的命令行参数（各基准脚本共用）"""
+    parser.add_argument('--llm-latency', default="1.0", help="LLM 非流式响应延迟分布，例如 lognormal:1.0,0.3")
+    parser.add_argument('--chunk-seconds', type=float, default=0.02, help="流式响应每个片段的间隔")
+    parser.add_argument('--render-latency', default="2.0", help="ComfyUI 渲染耗时分布，例如 uniform:1,3")
+    parser.add_argument('--llm-failure-rate', type=float, default=0.0, help="LLM 请求返回 500 的比例")
+    parser.add_argument('--render-failure-rate', type=float, default=0.0, help="渲染以 execution_error 结束的比例")
+    parser.add_argument('--image-size', default="1000x600")
+    parser.add_argument('--image-noise', type=float, default=0.0,
+                        help="0–1，越大 PNG 越大（0.3 时 1000x600 约 1.5 MB）")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--comfy-nodes', type=int, default=1, help="ComfyUI 节点数，端口从 comfy-port 起依次递增")
+    parser.add_argument('--render-slots', type=int, default=0,
+                        help="每个节点同时执行的渲染数，0 为不限（真实 ComfyUI 为 1）")
+
+
+def backends_from_args(args: argparse.Namespace, lm_port: int, comfy_port: int) -> FakeBackends:
+    width, height = (int(v) for v in args.image_size.split('x'))
+    return FakeBackends(lm_port, comfy_port,
+                        llm_seconds=args.llm_latency, chunk_seconds=args.chunk_seconds,
+                        render_seconds=args.render_latency, image_size=(width, height),
+                        image_variants=8 if args.image_noise else 1, image_noise=args.image_noise,
+                        llm_failure_rate=args.llm_failure_rate,
+                        render_failure_rate=args.render_failure_rate, seed=args.seed,
+                        comfy_nodes=args.comfy_nodes, render_slots=args.render_slots)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake LM Studio and ComfyUI backends")
+    parser.add_argument('--lm-port', type=int, default=8898)
+    parser.add_argument('--comfy-port', type=int, default=8899)
+    add_backend_arguments(parser)
+    args = parser.parse_args()
+    backends = backends_from_args(args, args.lm_port, args.comfy_port).start()
+    print(f"LM Studio: {backends.lm_url}  ComfyUI: {', '.join(backends.comfy_urls)}  (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        backends.stop()
+
+
+if __name__ == '__main__':
+    main()
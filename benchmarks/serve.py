@@ -0,0 +1,53 @@
+"""
+以独立进程运行 app.py，后端指向假 LM Studio / ComfyUI（供 bench_load 启动，
+这样测得的 CPU 和内存只属于服务本身）。
+
+用法：python -m benchmarks.serve --port 18901 --lm-url http://127.0.0.1:18898 \
+    --comfy-url http://127.0.0.1:18899
+"""
+import argparse
+import logging
+import os
+import signal
+import sys
+import tempfile
+
+from werkzeug.serving import make_server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import CONFIG  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the app against fake backends")
+    parser.add_argument('--port', type=int, default=18901)
+    parser.add_argument('--lm-url', required=True)
+    parser.add_argument('--comfy-url', required=True, help="ComfyUI 地址，多个节点时以逗号分隔")
+    parser.add_argument('--engine', choices=["async", "sync"], default="async")
+    parser.add_argument('--render-cache', action='store_true', help="启用渲染缓存（默认关闭，每个场景都真正渲染）")
+    args = parser.parse_args()
+
+    CONFIG["lm_studio"]["api_url"] = args.lm_url
+    comfy_urls = args.comfy_url.split(',')
+    CONFIG["comfyui"]["api_url"] = comfy_urls[0]
+    CONFIG["comfyui"]["api_urls"] = comfy_urls if len(comfy_urls) > 1 else []
+    CONFIG["lm_studio"]["pool_size"] = CONFIG["comfyui"]["pool_size"] = 64
+    CONFIG["lm_studio"]["max_concurrency"] = 64
+    CONFIG["render_cache"]["enabled"] = args.render_cache
+    CONFIG["llm_cache"]["enabled"] = False
+    CONFIG["engine"]["mode"] = args.engine
+    CONFIG["jobs"]["db_path"] = os.path.join(tempfile.mkdtemp(prefix="bench_jobs_"), "jobs.db")
+
+    import app as app_module
+    logging.getLogger().setLevel(logging.WARNING)
+    app_module.book_maker.output_dir = tempfile.mkdtemp(prefix="bench_books_")
+
+    server = make_server("127.0.0.1", args.port, app_module.app, threaded=True)
+    # SIGTERM 时正常退出，排版进程池随之关闭
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,130 @@
 CONFIG = {
     "lm_studio": {
         "api_url": "http://localhost:1234",
-        "model": "default"
+        # 多个 OpenAI 兼容端点：地址或 {"api_url": ..., "max_concurrency": n}；为空时只使用 api_url
+        "api_urls": [],
+        "max_concurrency": 8,  # 每个端点同时进行的补全请求上限，全部占满时排队等待
+        "hedge": False,  # 首个 token 迟迟未到时向另一个端点发出同样的请求，采用先到的一方
+        "hedge_percentile": 95,  # 对冲阈值：近期首 token 延迟的该分位数
+        "hedge_min_samples": 20,  # 样本数达到后才开始对冲
+        "model": "default",
+        "pool_size": 8,  # keep-alive 连接池大小
+        "connect_timeout": 3.05,  # 秒
+        "read_timeout": 120,  # 秒，故事生成较慢
+        "health_path": "/v1/models",
+        "health_ttl": 10,  # 后台健康探测间隔（秒）
+        "response_format": True,  # 发送 JSON Schema 约束；后端返回 400 时自动关闭
+        "json_fix_attempts": 1,  # 回复无法解析或校验时，发送 continue/fix 请求的次数上限
+        # 重试与熔断（services/resilience.py）
+        "resilience": {
+            "max_retries": 3,  # 每个补全请求的最多尝试次数
+            "backoff_base": 1.0,  # 指数退避（完全抖动）：第 n 次重试前等待 0~min(cap, base*2^n) 秒
+            "backoff_cap": 15,
+            "budget_ratio": 0.2,  # 重试预算：重试数不超过请求数的 20%（另按 per_second 缓慢补充）
+            "budget_per_second": 0.1,
+            "budget_burst": 10,
+            "failure_threshold": 5,  # 连续失败次数达到后打开熔断器
+            "open_seconds": 15  # 打开后经过该时间放行一个试探请求（或由健康探测试探）
+        }
     },
     "comfyui": {
-        "api_url": "http://localhost:8188"
+        "api_url": "http://localhost:8188",
+        "api_urls": [],  # 多个 ComfyUI 节点的地址；为空时只使用 api_url
+        "status_interval": 2,  # 多节点时读取各节点 /queue 和 /system_stats 的间隔（秒）
+        "model_switch_cost": 2,  # 节点需要切换 checkpoint / LoRA 时额外计入的排队任务数
+        "submit_window": 2,  # 每个节点最多同时提交的 prompt 数，其余在本地排队并按模型分组派发（0 为不限）
+        "max_group_wait": 30,  # 排队任务最多为同组模型的任务让路多少秒
+        "previews": True,  # 渲染途中推送 scene_preview 事件（首遍预览 + 逐步预览，后者需 ComfyUI 以 --preview-method 启动）
+        "preview_interval": 1.0,  # 每个场景逐步预览的最短推送间隔（秒）
+        "preview_store_size": 256,  # 内存中保留的预览图数量
+        "max_in_flight": 8,  # 每个故事同时提交到 ComfyUI 的场景数上限
+        "pool_size": 16,
+        "connect_timeout": 3.05,
+        "read_timeout": 30,
+        "health_path": "/system_stats",
+        "health_ttl": 10,
+        "output_dir": None,  # ComfyUI 输出目录；与本服务在同一文件系统时填写，直接链接输出文件而不走 HTTP
+        "transfer_chunk_size": 256 * 1024,  # /view 流式下载的分块大小（字节）
+        "render_timeout": 250,  # 单张图片从提交到完成的最长等待（秒）；熔断器打开时提前放弃
+        "resilience": {
+            "max_retries": 2,  # 提交 /prompt 时连接失败的最多尝试次数
+            "backoff_base": 0.5,
+            "backoff_cap": 5,
+            "budget_ratio": 0.2,
+            "budget_per_second": 0.1,
+            "budget_burst": 10,
+            "failure_threshold": 5,
+            "open_seconds": 15
+        }
+    },
+    "render_cache": {
+        "enabled": True,
+        "max_bytes": 2 * 1024 ** 3  # static/images 中缓存渲染结果的总大小上限
+    },
+    "book": {
+        "image_dpi": 150,  # 图片按版面尺寸在该分辨率下缩放后再嵌入 PDF
+        "jpeg_quality": 85,
+        "image_cache_dir": "output/cache/book_images",  # 预处理后的图片，按原图内容哈希缓存
+        "workers": 2  # 排版进程数；场景图片一完成就在这些进程中预处理
+    },
+    "static_images": {
+        "max_age": 365 * 24 * 3600,  # 带内容哈希版本号的地址按 immutable 长期缓存
+        "offload": None,  # 反向代理发送文件："x-sendfile"（Apache、lighttpd）或 "x-accel-redirect"（nginx）
+        "accel_prefix": "/_images/"  # nginx 中指向 static/images 的 internal location
+    },
+    "derivatives": {
+        "enabled": True,
+        "eager": True,  # True：渲染完成后在后台线程池生成；False：首次请求时生成
+        "dir": "static/images/derived",
+        "widths": [320, 800],
+        "formats": ["avif", "webp", "jpeg"],  # Pillow 不支持的格式会被跳过
+        "quality": {"avif": 50, "webp": 80, "jpeg": 82},
+        "workers": 2
+    },
+    "llm_cache": {
+        "enabled": False,  # 默认关闭，开启后缓存通过校验的 LLM 补全结果
+        "db_path": "output/cache/llm_completions.db",
+        "memory_entries": 128,
+        "ttl": 7 * 24 * 3600,  # 秒
+        "max_bytes": 256 * 1024 ** 2
+    },
+    "workflows": {
+        "dir": "workflows",  # ComfyUI API 格式的工作流模板 (*.json)
+        "default_preset": "default",
+        # 风格预设：模板名 + 参数默认值，请求中显式给出的参数优先
+        "presets": {
+            "default": {"workflow": "default_workflow", "params": {"steps": 20}},
+            "fast": {"workflow": "default_workflow", "params": {"steps": 10, "hires_steps": 12}}
+        },
+        # quality="draft"：只做首遍采样（首遍分辨率），步数不超过 steps；
+        # 首遍潜在图以 latent_prefix 保存在 ComfyUI 输出目录，升级时只补做高清修复第二遍
+        "draft": {"steps": 12, "latent_prefix": "storybook/draft"}
+    },
+    "characters": {
+        "dir": "characters",  # 角色 YAML 文件，启动时增量导入索引
+        "db_path": "output/cache/characters.db",  # SQLite 索引（含 FTS5 全文检索）
+        "page_size": 20,  # /characters 默认每页条数
+        "max_page_size": 100,
+        # 相似角色索引（需要 NumPy）：哈希 TF-IDF 向量，内存映射 .npy
+        "similarity": {
+            "enabled": True,
+            "dir": "output/cache/character_index",
+            "dim": 1024,
+            "duplicate_threshold": 0.9,  # 新建角色与已有角色的余弦相似度达到此值视为重复
+            "top_k": 5
+        }
+    },
+    "stories": {
+        "db_path": "output/stories/stories.db",  # 已生成故事的记录（草稿升级用）
+        "ttl": 30 * 24 * 3600  # 秒，超过后清理
+    },
+    "jobs": {
+        "db_path": "output/jobs/jobs.db",  # 任务与事件持久化存储
+        "ttl": 7 * 24 * 3600,  # 秒，超过后清理任务记录
+        "max_workers": 4  # 同步模式下同时运行的任务数
+    },
+    "engine": {
+        "mode": "async"  # "async"：asyncio 引擎（需要 aiohttp）；"sync"：每个请求占用一个线程
     },
     "output_dir": "output"
 }
\ No newline at end of file
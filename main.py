@@ -6,7 +6,7 @@ from agents.book_maker import BookMaker
 class StoryWorldSystem:
     def __init__(self):
         self.character_designer = CharacterDesigner()
-        self.art_designer = ArtDesigner("http://localhost:8188")  # ComfyUI默认端口
+        self.art_designer = ArtDesigner()  # 使用 config.py 中的 ComfyUI 地址
         self.story_creator = StoryCreator()
         self.book_maker = BookMaker()
     
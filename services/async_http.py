@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+
+import aiohttp
+
+from config import CONFIG
+from services.metrics import BACKEND_ERRORS, BACKEND_REQUEST_SECONDS
+from services.resilience import backend_unavailable_event, get_resilience
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncBackendClient:
+    """
+    BackendClient 的 asyncio 版本：每个事件循环共享一个 aiohttp 连接池。
+
+    健康状态按 TTL 缓存，过期后在后台任务中刷新，调用方不会因探测而等待
+    （首次调用除外）。熔断器与同步客户端共用（同一后端地址一个）。
+    """
+
+    def __init__(self,
+                 name: str,
+                 base_url: str,
+                 pool_size: int = 10,
+                 connect_timeout: float = 3.05,
+                 read_timeout: float = 60,
+                 health_path: str = "/",
+                 health_ttl: float = 10):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.health_path = health_path
+        self.health_ttl = health_ttl
+        self.resilience = get_resilience(name, self.base_url)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._healthy: Optional[bool] = None
+        self._checked_at = 0.0
+        self._probe_task: Optional[asyncio.Task] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """在当前事件循环中惰性创建会话"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=self.timeout,
+                trace_configs=[self._trace_config()]
+            )
+        return self._session
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        """按后端记录请求耗时（到响应头为止）和失败次数"""
+        async def on_start(session, context, params):
+            context.started = time.monotonic()
+
+        async def on_end(session, context, params):
+            BACKEND_REQUEST_SECONDS.observe(time.monotonic() - context.started, backend=self.name)
+            if params.response.status >= 500:
+                BACKEND_ERRORS.inc(backend=self.name)
+
+        async def on_exception(session, context, params):
+            BACKEND_ERRORS.inc(backend=self.name)
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_start)
+        trace_config.on_request_end.append(on_end)
+        trace_config.on_request_exception.append(on_exception)
+        return trace_config
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}{path}"
+
+    @asynccontextmanager
+    async def request(self, method: str, path: str, **kwargs) -> AsyncIterator[aiohttp.ClientResponse]:
+        """
+        请求上下文，用法：async with client.request(...) as response。
+        熔断器打开时不发送请求，直接抛出 BackendUnavailable；
+        读取响应体时的网络错误同样计入该后端的失败
+        """
+        trial = self.resilience.before_request()
+        recorded = False
+        try:
+            async with self.session.request(method, self.url(path), **kwargs) as response:
+                ok = response.status < 500
+                self.resilience.record(ok, "" if ok else f"HTTP {response.status}")
+                recorded = True
+                yield response
+        except aiohttp.ClientResponseError:
+            raise  # raise_for_status() 抛出的状态码错误，已按状态码记录过
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.resilience.record(False, type(e).__name__)
+            recorded = True
+            raise
+        finally:
+            if trial and not recorded:
+                self.resilience.breaker.release()
+
+    def get(self, path: str, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path: str, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    async def probe(self) -> bool:
+        try:
+            async with self.session.get(self.url(self.health_path),
+                                        timeout=aiohttp.ClientTimeout(total=5)) as response:
+                healthy = response.status == 200
+            error = f"HTTP {response.status}"
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            healthy = False
+            error = type(e).__name__
+        self.resilience.breaker.record_probe(healthy, error)
+        if healthy != self._healthy:
+            logger.info(f"Backend {self.name} ({self.base_url}) is {'up' if healthy else 'down'}")
+        self._healthy = healthy
+        self._checked_at = time.monotonic()
+        return healthy
+
+    @property
+    def down(self) -> bool:
+        """最近一次请求或健康探测表明后端不可达"""
+        return self._healthy is False
+
+    def unavailable_event(self) -> Optional[Dict[str, Any]]:
+        return backend_unavailable_event(self)
+
+    async def is_healthy(self) -> bool:
+        """返回缓存的健康状态；过期时在后台刷新"""
+        if self._healthy is None:
+            return await self.probe()
+        expired = time.monotonic() - self._checked_at > self.health_ttl
+        if expired and (self._probe_task is None or self._probe_task.done()):
+            self._probe_task = asyncio.ensure_future(self.probe())
+        return self._healthy
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+_backends: Dict[Tuple[int, str, str], AsyncBackendClient] = {}
+
+
+def get_async_backend(name: str, base_url: Optional[str] = None) -> AsyncBackendClient:
+    """按 CONFIG[name] 获取当前事件循环共享的异步后端客户端"""
+    settings = CONFIG[name]
+    base_url = (base_url or settings["api_url"]).rstrip('/')
+    key = (id(asyncio.get_running_loop()), name, base_url)
+    client = _backends.get(key)
+    if client is None:
+        client = AsyncBackendClient(
+            name,
+            base_url,
+            pool_size=settings.get("pool_size", 10),
+            connect_timeout=settings.get("connect_timeout", 3.05),
+            read_timeout=settings.get("read_timeout", 60),
+            health_path=settings.get("health_path", "/"),
+            health_ttl=settings.get("health_ttl", 10)
+        )
+        _backends[key] = client
+    return client
@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import sys
+import time
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Union
+
+import aiohttp
+
+from services.async_http import AsyncBackendClient, get_async_backend
+from services.llm_pool import LLMEndpoint, LLMPool
+from services.metrics import LLM_HEDGES
+from services.resilience import Resilience, pool_unavailable_event
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncStreamResponse:
+    """已读到第一行的流式响应：content 先产出缓存的第一行，再继续读取原响应"""
+
+    def __init__(self, response: aiohttp.ClientResponse, first: Optional[bytes]):
+        self.response = response
+        self.status = response.status
+        self._first = first
+
+    async def text(self) -> str:
+        return await self.response.text()
+
+    @property
+    def content(self) -> AsyncIterator[bytes]:
+        return self._iter_content()
+
+    async def _iter_content(self) -> AsyncIterator[bytes]:
+        if self._first is not None:
+            yield self._first
+        async for raw in self.response.content:
+            yield raw
+
+
+class _Attempt:
+    """一个已收到首个 token 的请求：持有响应上下文和端点名额，close() 时一并释放"""
+
+    def __init__(self, response: Union[aiohttp.ClientResponse, AsyncStreamResponse], stack: AsyncExitStack,
+                 release: Callable[[], None]):
+        self.response = response
+        self.stack = stack
+        self.release = release
+
+    @property
+    def status(self) -> int:
+        return self.response.status
+
+    async def close(self):
+        try:
+            await self.stack.aclose()
+        finally:
+            self.release()
+
+
+class AsyncLLMPool:
+    """
+    LLMPool 的 asyncio 版本：路由、并发名额与首 token 统计共用同步池，
+    请求走当前事件循环的 aiohttp 客户端。流式与非流式请求都会对冲，
+    落败的一方被取消，连接随之关闭，后端停止生成。
+    """
+
+    def __init__(self, pool: LLMPool):
+        self.pool = pool
+        self.name = pool.name
+        self._clients: Dict[str, AsyncBackendClient] = {
+            endpoint.api_url: get_async_backend("lm_studio", endpoint.api_url) for endpoint in pool.endpoints}
+
+    @property
+    def resilience(self) -> Resilience:
+        return self.pool.resilience
+
+    @asynccontextmanager
+    async def post(self, path: str, **kwargs) -> AsyncIterator[Union[aiohttp.ClientResponse, AsyncStreamResponse]]:
+        """
+        用法同 AsyncBackendClient.post：async with pool.post(...) as response。
+        请求体带 "stream": true 时 response 为 AsyncStreamResponse
+        """
+        stream = bool((kwargs.get("json") or {}).get("stream"))
+        delay = self.pool.hedge_delay(path, stream)
+        endpoint = await self.pool.acquire_async()
+        if delay is None:
+            attempt = await self._attempt(endpoint, path, kwargs, stream)
+        else:
+            attempt = await self._hedged(endpoint, path, kwargs, stream, delay)
+        try:
+            yield attempt.response
+        finally:
+            await attempt.close()
+
+    async def _attempt(self, endpoint: LLMEndpoint, path: str, kwargs: Dict[str, Any], stream: bool) -> _Attempt:
+        """在指定端点上发送请求并等到首个 token；失败或被取消时关闭连接并归还名额"""
+        stack = AsyncExitStack()
+        started = time.monotonic()
+        try:
+            response = await stack.enter_async_context(self._clients[endpoint.api_url].post(path, **kwargs))
+            first = None
+            if response.status == 200:
+                if stream:
+                    async for raw in response.content:
+                        if raw.strip():
+                            first = raw
+                            break
+                else:
+                    await response.read()
+                self.pool.observe_first_token(path, stream, time.monotonic() - started)
+        except BaseException:
+            try:
+                await stack.__aexit__(*sys.exc_info())
+            finally:
+                self.pool.release(endpoint)
+            raise
+        return _Attempt(AsyncStreamResponse(response, first) if stream else response, stack,
+                        lambda: self.pool.release(endpoint))
+
+    async def _hedged(self, endpoint: LLMEndpoint, path: str, kwargs: Dict[str, Any], stream: bool,
+                      delay: float) -> _Attempt:
+        first = asyncio.ensure_future(self._attempt(endpoint, path, kwargs, stream))
+        tasks = [first]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            backup = None if done else self.pool.try_acquire(exclude=[endpoint.api_url])
+            if backup is None:
+                return await first
+            logger.info(f"No first token from {endpoint.api_url} after {delay:.2f}s, hedging to {backup.api_url}")
+            tasks.append(asyncio.ensure_future(self._attempt(backup, path, kwargs, stream)))
+            winner = await _first_success(tasks)
+        except BaseException:
+            for task in tasks:
+                _discard(task)
+            raise
+        LLM_HEDGES.inc(winner="primary" if winner is first else "hedge")
+        for task in tasks:
+            if task is not winner:
+                _discard(task)
+        return winner.result()
+
+    async def is_healthy(self) -> bool:
+        """任一端点健康即可"""
+        results = await asyncio.gather(*(client.is_healthy() for client in self._clients.values()))
+        return any(results)
+
+    def unavailable_event(self) -> Optional[Dict[str, Any]]:
+        """所有端点都不可用时的流式错误事件"""
+        return pool_unavailable_event(self.name, self._clients.values(), "endpoint")
+
+
+async def _first_success(tasks: List[asyncio.Future]) -> asyncio.Future:
+    """先返回 200 响应的一方；都失败时为先完成的一方（由调用方按原逻辑处理错误）"""
+    pending = set(tasks)
+    finished: List[asyncio.Future] = []
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in sorted(done, key=tasks.index):
+            finished.append(task)
+            if task.exception() is None and task.result().status == 200:
+                return task
+    return next((t for t in finished if t.exception() is None), finished[0])
+
+
+def _discard(task: asyncio.Future):
+    """取消对冲中落败的一方；已经收到首个 token 的一方关闭连接并归还名额"""
+    def close(done: asyncio.Future):
+        if not done.cancelled() and done.exception() is None:
+            asyncio.ensure_future(done.result().close())
+    task.cancel()
+    task.add_done_callback(close)
@@ -0,0 +1,291 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import aiohttp
+
+from services.async_http import AsyncBackendClient, get_async_backend
+from services.comfyui_pool import ComfyUINode, NodeFailed
+from services.comfyui_tracker import ComfyUITracker, PromptState
+from services.metrics import COMFYUI_REQUEUES, COMFYUI_TIMEOUTS
+from services.resilience import BackendUnavailable
+from services.sd_service import PreviewCallback, SDService, cached_nodes, preview_listener
+from services.workflow_templates import find_output_node
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncComfyUITracker(ComfyUITracker):
+    """
+    ComfyUITracker 的 asyncio 版本：/ws 连接作为事件循环中的任务运行，
+    输出节点完成时唤醒 asyncio.Event，而不是占用一个接收线程。
+    """
+
+    def __init__(self, api_url: str, session: aiohttp.ClientSession, **kwargs):
+        super().__init__(api_url, **kwargs)
+        self.session = session
+        self._task: Optional[asyncio.Task] = None
+        self._async_events: Dict[str, asyncio.Event] = {}
+
+    @property
+    def available(self) -> bool:
+        return True
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._stopped.clear()
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        delay = 1.0
+        while not self._stopped.is_set():
+            try:
+                async with self.session.ws_connect(self.ws_url, heartbeat=self.recv_timeout) as ws:
+                    self._connected.set()
+                    delay = 1.0
+                    logger.info(f"Connected to ComfyUI websocket: {self.ws_url}")
+                    async for message in ws:
+                        if message.type == aiohttp.WSMsgType.TEXT:
+                            self._handle_message(message.data)
+                        elif message.type == aiohttp.WSMsgType.BINARY:
+                            self._handle_binary(message.data)
+                        elif message.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                            break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"ComfyUI websocket disconnected: {str(e)}")
+            finally:
+                self._connected.clear()
+                self._wake_waiters()
+            # 断线后指数退避重连
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    def _event(self, prompt_id: str) -> asyncio.Event:
+        event = self._async_events.get(prompt_id)
+        if event is None:
+            event = asyncio.Event()
+            self._async_events[prompt_id] = event
+        return event
+
+    def _notify(self, state: PromptState):
+        state.event.set()
+        # 只唤醒已有等待者；尚未 watch 的 prompt 由 wait_async 登记时检查
+        event = self._async_events.get(state.prompt_id)
+        if event is not None:
+            event.set()
+
+    async def wait_async(self, prompt_id: str, output_node: str, timeout: float) -> Optional[PromptState]:
+        """等待输出节点完成；超时返回 None"""
+        event = self._event(prompt_id)
+        state = self.watch(prompt_id, output_node)
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        if state.is_ready():
+            return state
+        event.clear()
+        return None
+
+    def discard(self, prompt_id: str) -> Optional[PromptState]:
+        self._async_events.pop(prompt_id, None)
+        return super().discard(prompt_id)
+
+
+_trackers: Dict[Tuple[int, str], AsyncComfyUITracker] = {}
+
+
+def get_async_tracker(api_url: str, session: aiohttp.ClientSession) -> AsyncComfyUITracker:
+    """每个事件循环对每个 ComfyUI 地址共享一个 tracker"""
+    key = (id(asyncio.get_running_loop()), api_url.rstrip('/'))
+    tracker = _trackers.get(key)
+    if tracker is None:
+        tracker = AsyncComfyUITracker(key[1], session)
+        _trackers[key] = tracker
+    tracker.start()
+    return tracker
+
+
+class AsyncSDService:
+    """
+    SDService 的 asyncio 版本。
+
+    工作流加载与参数绑定复用同步的 SDService，节点选择复用它的节点池，
+    这里只替换网络等待：提交、等待完成（websocket + /history 兜底）、下载和清理 history。
+    """
+
+    def __init__(self, sd_service: SDService):
+        self.sd_service = sd_service
+        self.pool = sd_service.pool
+        # 节点地址 -> (异步客户端, 异步 tracker)
+        self._nodes: Dict[str, Tuple[AsyncBackendClient, AsyncComfyUITracker]] = {}
+        for node in self.pool.nodes:
+            client = get_async_backend("comfyui", node.api_url)
+            self._nodes[node.api_url] = (client, get_async_tracker(node.api_url, client.session))
+        self.client, self.tracker = self._nodes[self.pool.primary.api_url]
+        self.output_node = sd_service.output_node
+        self.timeout = sd_service.timeout
+        self.poll_interval = sd_service.poll_interval
+        self.history_check_interval = sd_service.history_check_interval
+
+    def build_workflow(self, *args, **kwargs) -> Dict[str, Any]:
+        return self.sd_service.build_workflow(*args, **kwargs)
+
+    def client_for(self, image: Dict[str, Any]) -> AsyncBackendClient:
+        """渲染该图片的节点的客户端（下载输出用）"""
+        return self._nodes[self.pool.node(image.get("node")).api_url][0]
+
+    async def render(self, graph: Dict[str, Any]) -> Optional[str]:
+        """提交已绑定的工作流图并等待结果，返回 ComfyUI 输出文件名"""
+        image = await self.render_image(graph)
+        return image['filename'] if image else None
+
+    async def render_image(self, graph: Dict[str, Any], on_preview: Optional[PreviewCallback] = None,
+                           node: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """与 SDService.render_image 相同：返回输出图片信息，节点宕机时换一个节点重新排队，预览经 on_preview 推送"""
+        output_node = find_output_node(graph) or self.output_node
+        graph, preview_node = self.sd_service.with_preview(graph, on_preview)
+        failed = self.sd_service.pinned_exclusions(node)
+        while True:
+            node = await self.pool.acquire_async(graph, exclude=failed)
+            if node is None:
+                logger.error(f"Generation failed on all {len(failed)} ComfyUI node(s)")
+                return None
+            try:
+                return await self._render_on(node, graph, output_node, on_preview, preview_node)
+            except NodeFailed as e:
+                failed.append(node.api_url)
+                logger.warning(f"ComfyUI node {node.api_url} failed: {str(e)}")
+                if len(failed) < len(self.pool.nodes):
+                    COMFYUI_REQUEUES.inc()
+            finally:
+                self.pool.release(node)
+
+    async def _render_on(self, node: ComfyUINode, graph: Dict[str, Any], output_node: str,
+                         on_preview: Optional[PreviewCallback] = None,
+                         preview_node: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        client, tracker = self._nodes[node.api_url]
+        try:
+            workflow = {"prompt": graph, "client_id": tracker.client_id}
+            logger.info(f"Sending request to ComfyUI ({node.api_url})...")
+            try:
+                prompt_id = await self._submit(client, workflow)
+            except (aiohttp.ClientConnectionError, BackendUnavailable) as e:
+                raise NodeFailed(str(e)) from e
+            if prompt_id is None:
+                return None
+            logger.info(f"Generation started with prompt_id: {prompt_id}")
+            if on_preview is not None:
+                tracker.listen(prompt_id, preview_listener(node.api_url, on_preview), preview_node)
+
+            latent_node = find_output_node(graph, "SaveLatent")
+            state = None
+            try:
+                outputs = await self._wait_for_outputs(node, client, tracker, prompt_id, output_node)
+                if outputs and latent_node and latent_node not in outputs:
+                    outputs = dict(outputs, **(await self._wait_for_outputs(
+                        node, client, tracker, prompt_id, latent_node) or {}))
+            finally:
+                state = tracker.discard(prompt_id)
+            if not outputs or output_node not in outputs:
+                return None
+
+            image_data = dict(outputs[output_node]['images'][0], node=node.api_url,
+                              cached_nodes=cached_nodes(state))
+            latents = (outputs.get(latent_node) or {}).get('latents') if latent_node else None
+            if latents:
+                image_data['latent'] = dict(latents[0], node=node.api_url)
+            await self._delete_history(client, prompt_id)
+            return image_data
+
+        except (asyncio.CancelledError, NodeFailed):
+            raise
+        except BackendUnavailable as e:
+            raise NodeFailed(str(e)) from e
+        except Exception as e:
+            logger.error(f"Error generating image: {str(e)}")
+            return None
+
+    async def _submit(self, client: AsyncBackendClient, workflow: Dict[str, Any]) -> Optional[str]:
+        """提交 /prompt 并返回 prompt_id；与 SDService._submit 相同，连接失败时退避重试"""
+        resilience = client.resilience
+        attempt = 0
+        while True:
+            try:
+                async with client.post("/prompt", json=workflow) as response:
+                    if response.status != 200:
+                        logger.error(f"Error queuing prompt: {await response.text()}")
+                        return None
+                    return (await response.json())['prompt_id']
+            except aiohttp.ClientConnectionError as e:
+                delay = resilience.retry_delay(attempt) if attempt < resilience.max_retries - 1 else None
+                if delay is None:
+                    raise
+                logger.warning(f"Error queuing prompt, retrying in {delay:.1f}s: {str(e)}")
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def _wait_for_outputs(self, node: ComfyUINode, client: AsyncBackendClient, tracker: AsyncComfyUITracker,
+                                prompt_id: str, output_node: str) -> Optional[Dict[str, Any]]:
+        """与 SDService._wait_for_outputs 相同的等待策略，等待期间不占用线程"""
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            if client.resilience.breaker.is_open():
+                raise NodeFailed(f"gave up on prompt {prompt_id}: {client.resilience.unavailable()}")
+            if node.healthy is False and not tracker.connected():
+                raise NodeFailed(f"gave up on prompt {prompt_id}: node is not reachable")
+            remaining = deadline - time.monotonic()
+            if tracker.connected():
+                state = await tracker.wait_async(prompt_id, output_node,
+                                                 timeout=min(self.history_check_interval, remaining))
+                if state is not None:
+                    if state.error:
+                        logger.error(f"Generation failed: {state.error}")
+                        return None
+                    if output_node in state.outputs:
+                        return state.outputs
+                    # prompt 已结束但未收到输出（例如输出被缓存），从 history 读取
+                    outputs = await self._get_history_outputs(client, prompt_id)
+                    if not outputs:
+                        logger.error(f"Generation finished without output for prompt_id: {prompt_id}")
+                    return outputs
+            else:
+                await asyncio.sleep(min(self.poll_interval, remaining))
+
+            outputs = await self._get_history_outputs(client, prompt_id)
+            if outputs:
+                return outputs
+
+        COMFYUI_TIMEOUTS.inc()
+        logger.error("Generation timed out")
+        return None
+
+    async def _get_history_outputs(self, client: AsyncBackendClient, prompt_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            async with client.get(f"/history/{prompt_id}") as history:
+                if history.status == 200:
+                    history_data = json.loads(await history.text())
+                    if prompt_id in history_data:
+                        return history_data[prompt_id].get('outputs') or None
+                    logger.debug(f"Generation in progress... ({prompt_id})")
+                else:
+                    logger.error(f"Error checking history: {history.status} - {await history.text()}")
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logger.error(f"Error while checking history: {str(e)}")
+        return None
+
+    async def _delete_history(self, client: AsyncBackendClient, prompt_id: str):
+        try:
+            async with client.post("/history", json={"delete": [prompt_id]}):
+                pass
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Error deleting history for {prompt_id}: {str(e)}")
@@ -0,0 +1,232 @@
+import json
+import math
+import os
+import re
+import threading
+import zlib
+import logging
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from services.character_service import field_text
+
+logger = logging.getLogger(__name__)
+
+# 参与相似度计算的字段；名字不算在内，换个名字的同一角色仍视为重复
+SIMILARITY_FIELDS = ("personality", "appearance", "backstory")
+
+_STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have he her his in is it its of on or she "
+    "that the their they this to was were with".split())
+
+
+def character_text(character_data: dict) -> str:
+    """拼接参与相似度计算的字段文本（嵌套的字典和列表会被展平）"""
+    return " ".join(field_text(character_data.get(field)) for field in SIMILARITY_FIELDS)
+
+
+class CharacterIndex:
+    """
+    角色相似度索引：哈希 TF-IDF 向量存成一个连续的 float32 矩阵（内存映射 .npy）。
+
+    - 特征为小写词和相邻词对，用 crc32 哈希到 dim 维（跨进程稳定）
+    - tf.npy 保存次线性词频，vectors.npy 保存按 IDF 加权并 L2 归一化后的行；
+      查询是一次矩阵–向量乘法加 argpartition 取 top-k
+    - 新角色追加一行并更新文档频率；角色数比上次加权时增长超过 reweight_growth
+      时按新的 IDF 重算全部行（同时压缩已删除的行）
+    - 启动时直接映射已有文件，只为索引中缺少的角色计算向量
+    """
+
+    def __init__(self, index_dir: str = "output/cache/character_index", dim: int = 1024,
+                 reweight_growth: float = 0.25):
+        self.index_dir = index_dir
+        self.dim = dim
+        self.reweight_growth = reweight_growth
+        self._lock = threading.Lock()
+        os.makedirs(index_dir, exist_ok=True)
+        if not self._load():
+            self._reset()
+
+    # ---- 持久化 ----
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.index_dir, name)
+
+    def _reset(self):
+        self.ids: List[Optional[str]] = []  # 行号 -> 角色 id，已删除的行为 None
+        self.rows: Dict[str, int] = {}
+        self.dead_rows: Set[int] = set()
+        self.weighted_count = 0  # 上次加权时的有效角色数
+        self.df = np.zeros(self.dim, dtype=np.int64)
+        self.idf = np.ones(self.dim, dtype=np.float32)
+        self.tf = self._open_matrix("tf.npy", 0)
+        self.vectors = self._open_matrix("vectors.npy", 0)
+
+    def _load(self) -> bool:
+        try:
+            with open(self._path("index.json"), encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta["dim"] != self.dim:
+                logger.info("Character index dimension changed, rebuilding")
+                return False
+            tf = np.load(self._path("tf.npy"), mmap_mode="r+")
+            vectors = np.load(self._path("vectors.npy"), mmap_mode="r+")
+            df = np.load(self._path("df.npy"))
+            idf = np.load(self._path("idf.npy"))
+        except (OSError, ValueError, KeyError) as e:
+            if os.path.exists(self._path("index.json")):
+                logger.warning(f"Character index unreadable, rebuilding: {e}")
+            return False
+        ids = meta["ids"]
+        if len(ids) > min(len(tf), len(vectors)) or tf.shape[1:] != (self.dim,) or vectors.shape != tf.shape:
+            logger.warning("Character index files are inconsistent, rebuilding")
+            return False
+        self.ids = ids
+        self.rows = {cid: row for row, cid in enumerate(ids) if cid is not None}
+        self.dead_rows = {row for row, cid in enumerate(ids) if cid is None}
+        self.weighted_count = meta["weighted_count"]
+        self.df, self.idf, self.tf, self.vectors = df, idf, tf, vectors
+        return True
+
+    def _open_matrix(self, name: str, capacity: int) -> np.memmap:
+        return np.lib.format.open_memmap(self._path(name), mode="w+", dtype=np.float32,
+                                         shape=(capacity, self.dim))
+
+    def _grow(self, needed: int):
+        """按倍数扩容两个矩阵（写入新文件后原子替换）"""
+        capacity = len(self.tf)
+        if needed <= capacity:
+            return
+        capacity = max(needed, 2 * capacity, 256)
+        for name in ("tf", "vectors"):
+            old = getattr(self, name)
+            tmp = self._path(f".{name}.tmp.npy")
+            new = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float32, shape=(capacity, self.dim))
+            new[:len(self.ids)] = old[:len(self.ids)]
+            new.flush()
+            del new
+            os.replace(tmp, self._path(f"{name}.npy"))
+            setattr(self, name, np.load(self._path(f"{name}.npy"), mmap_mode="r+"))
+
+    def _save(self):
+        """先刷新矩阵，再原子地写入元数据；中途崩溃时启动会补上缺少的行"""
+        self.tf.flush()
+        self.vectors.flush()
+        for name, array in (("df", self.df), ("idf", self.idf)):
+            tmp = self._path(f".{name}.tmp.npy")
+            np.save(tmp, array)
+            os.replace(tmp, self._path(f"{name}.npy"))
+        tmp = self._path(".index.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"dim": self.dim, "weighted_count": self.weighted_count, "ids": self.ids}, f)
+        os.replace(tmp, self._path("index.json"))
+
+    # ---- 向量化 ----
+
+    def _term_frequencies(self, text: str) -> np.ndarray:
+        words = [w for w in re.findall(r"\w+", text.lower()) if w not in _STOPWORDS]
+        features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+        tf = np.zeros(self.dim, dtype=np.float32)
+        if features:
+            buckets = [zlib.crc32(feature.encode("utf-8")) % self.dim for feature in features]
+            tf += np.bincount(buckets, minlength=self.dim).astype(np.float32)
+            np.log1p(tf, out=tf)
+        return tf
+
+    def _weight(self, tf: np.ndarray) -> np.ndarray:
+        """按当前 IDF 加权并逐行 L2 归一化（tf 可以是一行或多行）"""
+        weighted = tf * self.idf
+        norms = np.linalg.norm(weighted, axis=-1, keepdims=True)
+        np.divide(weighted, norms, out=weighted, where=norms > 0)
+        return weighted
+
+    def _reweight(self):
+        """按当前文档频率重算 IDF 和全部向量，顺带压缩已删除的行"""
+        alive = np.array([row for row, cid in enumerate(self.ids) if cid is not None], dtype=np.int64)
+        count = len(alive)
+        self.idf = (np.log((1 + count) / (1 + self.df)) + 1).astype(np.float32)
+        chunk = 4096
+        # alive 升序且目标行号不大于源行号，按块顺序搬移不会覆盖未读的行
+        for start in range(0, count, chunk):
+            rows = alive[start:start + chunk]
+            tf = np.array(self.tf[rows])
+            self.tf[start:start + len(rows)] = tf
+            self.vectors[start:start + len(rows)] = self._weight(tf)
+        self.ids = [self.ids[row] for row in alive]
+        self.rows = {cid: row for row, cid in enumerate(self.ids)}
+        self.dead_rows = set()
+        self.weighted_count = count
+
+    # ---- 更新 ----
+
+    def sync(self, character_ids: Iterable[str], fetch: Callable[[str], Optional[dict]]):
+        """与角色库对齐：移除已不存在的角色，为缺少的角色计算向量"""
+        wanted = set(character_ids)
+        with self._lock:
+            removed = [cid for cid in self.rows if cid not in wanted]
+            missing = sorted(wanted - self.rows.keys())
+        added = []
+        for character_id in missing:
+            character_data = fetch(character_id)
+            if character_data is not None:
+                added.append((character_id, character_data))
+        if removed or added:
+            self.update(added, removed)
+            logger.info(f"Similarity index updated: {len(added)} embedded, {len(removed)} removed")
+
+    def update(self, added: List[Tuple[str, dict]], removed: Iterable[str] = ()):
+        """增量更新：added 中已存在的 id 视为修改"""
+        added_tf = [(cid, self._term_frequencies(character_text(data))) for cid, data in added]
+        with self._lock:
+            for character_id in list(removed) + [cid for cid, _ in added_tf]:
+                row = self.rows.pop(character_id, None)
+                if row is not None:
+                    self.df -= self.tf[row] > 0
+                    self.tf[row] = 0
+                    self.vectors[row] = 0
+                    self.ids[row] = None
+                    self.dead_rows.add(row)
+            self._grow(len(self.ids) + len(added_tf))
+            for character_id, tf in added_tf:
+                row = len(self.ids)
+                self.ids.append(character_id)
+                self.rows[character_id] = row
+                self.df += tf > 0
+                self.tf[row] = tf
+                self.vectors[row] = self._weight(tf)
+            if len(self.rows) > math.ceil(self.weighted_count * (1 + self.reweight_growth)) \
+                    or len(self.ids) > 2 * max(len(self.rows), 1):
+                self._reweight()
+            self._save()
+
+    # ---- 查询 ----
+
+    def _top_k(self, query: np.ndarray, k: int, exclude: Optional[str] = None) -> List[Tuple[str, float]]:
+        count = len(self.ids)
+        if count == 0 or k <= 0:
+            return []
+        scores = self.vectors[:count] @ query
+        if self.dead_rows:
+            scores[list(self.dead_rows)] = -np.inf
+        if exclude in self.rows:
+            scores[self.rows[exclude]] = -np.inf
+        k = min(k, count)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[row], float(scores[row])) for row in top if np.isfinite(scores[row])]
+
+    def similar(self, character_id: str, k: int = 5) -> Optional[List[Tuple[str, float]]]:
+        """与指定角色最相似的 k 个角色 [(id, 余弦相似度)]；角色不在索引中时返回 None"""
+        with self._lock:
+            row = self.rows.get(character_id)
+            if row is None:
+                return None
+            return self._top_k(np.array(self.vectors[row]), k, exclude=character_id)
+
+    def most_similar(self, character_data: dict) -> Optional[Tuple[str, float]]:
+        """与一个（尚未入库的）角色最相似的已有角色"""
+        tf = self._term_frequencies(character_text(character_data))
+        with self._lock:
+            matches = self._top_k(self._weight(tf), 1)
+        return matches[0] if matches else None
@@ -1,16 +1,80 @@
+import json
 import os
-import yaml
 import random
+import re
+import sqlite3
+import threading
+import uuid
 import logging
-from typing import Dict, List, Optional
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import yaml
 
 logger = logging.getLogger(__name__)
 
+# 有 libyaml 时用 C 实现解析，导入大量角色文件时快一个数量级
+_YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# 参与全文检索的字段（FTS5 列顺序）
+SEARCH_FIELDS = ("name", "personality", "appearance", "backstory")
+
+
+def field_text(value: Any) -> str:
+    """把 YAML 中的字段（字符串、列表或嵌套字典）展平成检索用文本"""
+    if value is None:
+        return ""
+    if isinstance(value, dict):
+        return " ".join(field_text(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return " ".join(field_text(v) for v in value)
+    return str(value)
+
+
+def _match_query(q: str) -> Optional[str]:
+    """把用户输入转成 FTS5 查询：每个词按前缀匹配，词之间为 AND；不解析 FTS5 语法"""
+    terms = re.findall(r"\w+", q)
+    if not terms:
+        return None
+    return " ".join(f'"{term}"*' for term in terms)
+
+
 class CharacterService:
-    def __init__(self, characters_dir: str = "characters"):
+    """
+    角色库。characters/*.yaml 仍是数据源，启动时按 (mtime, size) 增量导入
+    SQLite（WAL）索引：只解析新增或修改过的文件，删除的文件从索引移除。
+
+    - FTS5 索引 name、personality、appearance、backstory，支持分页搜索
+    - slot 列保持 0..n-1 连续，随机选取只需一次索引查找
+    - 新角色 id 为 uuid4，不会与已有文件冲突
+    """
+
+    def __init__(self, characters_dir: str = "characters",
+                 db_path: str = "output/cache/characters.db",
+                 index=None):
         self.characters_dir = characters_dir
+        self.db_path = db_path
+        self.index = index  # 可选的 CharacterIndex（相似角色与查重，需要 NumPy）
         self._ensure_characters_dir()
-        self.characters: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS characters (
+                id TEXT PRIMARY KEY,
+                slot INTEGER NOT NULL UNIQUE,
+                data TEXT NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL
+            )
+        """)
+        # 独立的 FTS5 表，rowid 与 characters 的 rowid 一致
+        self._conn.execute(f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS characters_fts
+            USING fts5({", ".join(SEARCH_FIELDS)})
+        """)
+        self._conn.commit()
         self.load_characters()
 
     def _ensure_characters_dir(self):
@@ -19,59 +83,183 @@ class CharacterService:
             os.makedirs(self.characters_dir)
 
     def load_characters(self):
-        """Load all character YAML files from the characters directory"""
-        self.characters.clear()
-        if not os.path.exists(self.characters_dir):
-            return
+        """增量同步 characters 目录：解析新增/修改的 YAML，移除已删除的文件"""
+        files: Dict[str, Tuple[int, int]] = {}
+        with os.scandir(self.characters_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith('.yaml') and entry.is_file():
+                    stat = entry.stat()
+                    files[entry.name[:-5]] = (stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            known = {row[0]: (row[1], row[2]) for row in
+                     self._conn.execute("SELECT id, mtime_ns, size FROM characters")}
+        changed = [cid for cid, stamp in files.items() if known.get(cid) != stamp]
+        removed = [cid for cid in known if cid not in files]
+
+        # 解析放在锁外，导入大量文件时不阻塞查询
+        parsed = []
+        for character_id in changed:
+            file_path = os.path.join(self.characters_dir, f"{character_id}.yaml")
+            try:
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    character_data = yaml.load(f, Loader=_YamlLoader)
+            except Exception as e:
+                logger.error(f"Error loading character file {character_id}.yaml: {e}")
+                continue
+            if not isinstance(character_data, dict):
+                logger.error(f"Error loading character file {character_id}.yaml: not a mapping")
+                continue
+            parsed.append((character_id, character_data, files[character_id]))
 
-        loaded_count = 0
-        for filename in os.listdir(self.characters_dir):
-            if filename.endswith('.yaml'):
-                file_path = os.path.join(self.characters_dir, filename)
-                try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        character_data = yaml.safe_load(f)
-                        self.characters[filename[:-5]] = character_data
-                        loaded_count += 1
-                except Exception as e:
-                    logger.error(f"Error loading character file {filename}: {e}")
-        
-        if loaded_count > 0:
-            logger.info(f"Successfully loaded {loaded_count} characters")
+        with self._lock:
+            for character_id in removed:
+                self._delete(character_id)
+            for character_id, character_data, (mtime_ns, size) in parsed:
+                self._upsert(character_id, character_data, mtime_ns, size)
+            self._conn.commit()
+            total = self._count()
+
+        if self.index is not None:
+            if parsed or removed:
+                self.index.update([(cid, data) for cid, data, _ in parsed], removed)
+            # 补上索引中缺少的角色（例如索引文件被删除或上次保存前中断）
+            with self._lock:
+                character_ids = [row[0] for row in self._conn.execute("SELECT id FROM characters")]
+            self.index.sync(character_ids, self.get_character)
+
+        if parsed or removed:
+            logger.info(f"Character index updated: {len(parsed)} imported, {len(removed)} removed")
+        if total > 0:
+            logger.info(f"Successfully loaded {total} characters")
         else:
             logger.warning("No character files found")
 
+    def _count(self) -> int:
+        # slot 连续，最大 slot + 1 即角色数（走索引，不需要全表 COUNT）
+        row = self._conn.execute("SELECT MAX(slot) FROM characters").fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    def _upsert(self, character_id: str, character_data: dict, mtime_ns: int, size: int):
+        data = json.dumps(character_data, ensure_ascii=False)
+        row = self._conn.execute("SELECT rowid FROM characters WHERE id = ?", (character_id,)).fetchone()
+        if row:
+            rowid = row[0]
+            self._conn.execute("UPDATE characters SET data = ?, mtime_ns = ?, size = ? WHERE rowid = ?",
+                               (data, mtime_ns, size, rowid))
+            self._conn.execute("DELETE FROM characters_fts WHERE rowid = ?", (rowid,))
+        else:
+            rowid = self._conn.execute(
+                "INSERT INTO characters (id, slot, data, mtime_ns, size) VALUES (?, ?, ?, ?, ?)",
+                (character_id, self._count(), data, mtime_ns, size)).lastrowid
+        self._conn.execute(
+            f"INSERT INTO characters_fts (rowid, {', '.join(SEARCH_FIELDS)}) VALUES (?, ?, ?, ?, ?)",
+            (rowid, *(field_text(character_data.get(field)) for field in SEARCH_FIELDS)))
+
+    def _delete(self, character_id: str):
+        row = self._conn.execute("SELECT rowid, slot FROM characters WHERE id = ?", (character_id,)).fetchone()
+        if not row:
+            return
+        rowid, slot = row
+        self._conn.execute("DELETE FROM characters WHERE rowid = ?", (rowid,))
+        self._conn.execute("DELETE FROM characters_fts WHERE rowid = ?", (rowid,))
+        # 把最后一个 slot 移进空位，保持 slot 连续
+        self._conn.execute("UPDATE characters SET slot = ? WHERE slot = (SELECT MAX(slot) FROM characters) "
+                           "AND slot > ?", (slot, slot))
+
     def get_random_character(self) -> Optional[tuple]:
         """Get a random character from the library"""
-        if not self.characters:
+        with self._lock:
+            total = self._count()
+            row = self._conn.execute("SELECT id, data FROM characters WHERE slot = ?",
+                                     (random.randrange(total),)).fetchone() if total else None
+        if not row:
             logger.warning("No characters available")
             return None
-        character_id = random.choice(list(self.characters.keys()))
-        character = self.characters[character_id]
-        source_file = f"{character_id}.yaml"
+        source_file = f"{row[0]}.yaml"
         logger.debug(f"Selected character from {source_file}")
-        return character, source_file
+        return json.loads(row[1]), source_file
 
     def get_character(self, character_id: str) -> Optional[dict]:
         """Get a specific character by ID"""
-        return self.characters.get(character_id)
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM characters WHERE id = ?", (character_id,)).fetchone()
+        return json.loads(row[0]) if row else None
 
     def create_character(self, character_data: dict) -> str:
         """Create a new character and save it to a YAML file"""
-        # Generate a unique ID for the new character
-        character_id = f"{random.randint(0, 9999):04d}g"
-        while character_id in self.characters:
-            character_id = f"{random.randint(0, 9999):04d}g"
-
-        # Save the character to a YAML file
+        character_id = uuid.uuid4().hex
         file_path = os.path.join(self.characters_dir, f"{character_id}.yaml")
-        with open(file_path, 'w', encoding='utf-8') as f:
+        tmp_path = f"{file_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
             yaml.dump(character_data, f, allow_unicode=True)
+        os.replace(tmp_path, file_path)
 
-        # Add to in-memory storage
-        self.characters[character_id] = character_data
+        # 记录文件的 mtime，下次同步时不会重复解析
+        stat = os.stat(file_path)
+        with self._lock:
+            self._upsert(character_id, character_data, stat.st_mtime_ns, stat.st_size)
+            self._conn.commit()
+        if self.index is not None:
+            self.index.update([(character_id, character_data)])
         return character_id
 
+    def similar_characters(self, character_id: str, k: int = 5) -> Optional[List[Dict[str, Any]]]:
+        """最相似的 k 个角色 [{"id", "score", "character"}]；角色不存在或没有索引时返回 None"""
+        if self.index is None:
+            return None
+        matches = self.index.similar(character_id, k)
+        if matches is None:
+            return None
+        return [{"id": cid, "score": round(score, 4), "character": self.get_character(cid)}
+                for cid, score in matches]
+
+    def find_duplicate(self, character_data: dict, threshold: float) -> Optional[Dict[str, Any]]:
+        """与已有角色的相似度不低于 threshold 时返回 {"id", "score"}"""
+        if self.index is None:
+            return None
+        match = self.index.most_similar(character_data)
+        if match and match[1] >= threshold:
+            return {"id": match[0], "score": round(match[1], 4)}
+        return None
+
+    def list_characters(self, q: Optional[str] = None, offset: int = 0,
+                        limit: int = 20) -> Dict[str, Any]:
+        """
+        分页列出角色；给出 q 时按 FTS5 相关度（bm25）排序，否则按 id 排序。
+        返回 {"total", "offset", "limit", "items": [{"id", "character"}]}
+        """
+        match = _match_query(q) if q else None
+        with self._lock:
+            if q and not match:
+                total, rows = 0, []
+            elif match:
+                total = self._conn.execute(
+                    "SELECT COUNT(*) FROM characters_fts WHERE characters_fts MATCH ?", (match,)).fetchone()[0]
+                rows = self._conn.execute("""
+                    SELECT c.id, c.data FROM characters_fts f JOIN characters c ON c.rowid = f.rowid
+                    WHERE characters_fts MATCH ? ORDER BY bm25(characters_fts) LIMIT ? OFFSET ?
+                """, (match, limit, offset)).fetchall()
+            else:
+                total = self._count()
+                rows = self._conn.execute("SELECT id, data FROM characters ORDER BY id LIMIT ? OFFSET ?",
+                                          (limit, offset)).fetchall()
+        return {"total": total, "offset": offset, "limit": limit,
+                "items": [{"id": cid, "character": json.loads(data)} for cid, data in rows]}
+
+    def iter_characters(self, batch_size: int = 500) -> Iterator[Tuple[str, dict]]:
+        """按 id 顺序分批遍历全部角色，不一次性载入内存"""
+        last_id = ""
+        while True:
+            with self._lock:
+                rows = self._conn.execute("SELECT id, data FROM characters WHERE id > ? ORDER BY id LIMIT ?",
+                                          (last_id, batch_size)).fetchall()
+            if not rows:
+                return
+            for character_id, data in rows:
+                yield character_id, json.loads(data)
+            last_id = rows[-1][0]
+
     def get_all_characters(self) -> List[dict]:
         """Get all characters from the library"""
-        return list(self.characters.values()) 
\ No newline at end of file
+        return [character for _, character in self.iter_characters()]
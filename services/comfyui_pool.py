@@ -0,0 +1,231 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Sequence, Tuple
+
+import requests
+
+from config import CONFIG
+from services.comfyui_tracker import get_tracker
+from services.http_client import get_backend
+from services.metrics import COMFYUI_DISPATCHES, COMFYUI_MODEL_SWITCHES
+from services.resilience import BackendUnavailable, pool_unavailable_event
+from services.submission_planner import PlannedJob, SubmissionPlanner
+from services.workflow_templates import graph_models
+
+logger = logging.getLogger(__name__)
+
+
+class NodeFailed(Exception):
+    """节点在提交或渲染途中不可用，任务应转到其他节点重新排队"""
+
+
+def _entry_models(entry: Sequence[Any]) -> FrozenSet[str]:
+    """/queue 条目 [number, prompt_id, prompt, extra_data, outputs] 中工作流加载的模型"""
+    prompt = entry[2] if len(entry) > 2 and isinstance(entry[2], dict) else {}
+    return graph_models(prompt)
+
+
+class ComfyUINode:
+    """池中的一个 ComfyUI 实例：HTTP 客户端、/ws tracker，以及最近一次读取的 /queue 与 /system_stats 状态"""
+
+    def __init__(self, api_url: str):
+        self.client = get_backend("comfyui", api_url)
+        self.api_url = self.client.base_url
+        self.tracker = get_tracker(self.api_url)
+        self.queue_total: Optional[int] = None  # /queue 中运行和等待的 prompt 数
+        self.models: FrozenSet[str] = frozenset()  # 队尾（队列为空时为最近一次）任务加载的模型
+        self.vram_free: Optional[int] = None
+        self.healthy: Optional[bool] = None  # 最近一次读取状态是否成功
+        self.in_flight = 0  # 本进程派发到该节点、尚未结束的任务数
+        self.refreshed_at = 0.0
+
+    def queue_depth(self) -> int:
+        """队列长度：/ws 推送的实时值优先，其次是最近一次 /queue 读数；不低于本进程的在途任务数"""
+        depth = self.tracker.queue_remaining if self.tracker.connected() else None
+        if depth is None:
+            depth = self.queue_total or 0
+        return max(depth, self.in_flight)
+
+    def available(self) -> bool:
+        return self.healthy is not False and not self.client.resilience.breaker.is_open()
+
+    def refresh(self, read_timeout: float = 5):
+        """读取 /queue 和 /system_stats"""
+        timeout = (self.client.timeout[0], read_timeout)
+        try:
+            queue = self.client.get("/queue", timeout=timeout)
+            stats = self.client.get("/system_stats", timeout=timeout)
+            queue.raise_for_status()
+            stats.raise_for_status()
+            queue_data, stats_data = queue.json(), stats.json()
+        except (requests.exceptions.RequestException, BackendUnavailable, ValueError) as e:
+            if self.healthy is not False:
+                logger.warning(f"ComfyUI node {self.api_url} is unavailable: {str(e)}")
+            self.healthy = False
+            return
+        entries = list(queue_data.get("queue_running") or []) + list(queue_data.get("queue_pending") or [])
+        self.queue_total = len(entries)
+        if entries:
+            # 新任务开始执行时，节点上加载的是队尾任务的模型
+            self.models = _entry_models(max(entries, key=lambda entry: entry[0]))
+        devices = stats_data.get("devices") or []
+        self.vram_free = sum(device.get("vram_free") or 0 for device in devices) if devices else None
+        if self.healthy is False:
+            logger.info(f"ComfyUI node {self.api_url} is available again")
+        self.healthy = True
+        self.refreshed_at = time.monotonic()
+
+    def status(self) -> Dict[str, Any]:
+        return {"api_url": self.api_url, "available": self.available(), "queue_depth": self.queue_depth(),
+                "in_flight": self.in_flight, "vram_free": self.vram_free, "models": sorted(self.models)}
+
+
+class ComfyUIPool:
+    """
+    一组 ComfyUI 节点。每个任务派发给负载最低的可用节点：
+    负载为节点队列长度，任务所需模型（checkpoint、LoRA）与节点当前模型不同时
+    额外计 model_switch_cost 个排队任务；同分时选显存空闲更多的节点。
+    多于一个节点时，后台线程每 status_interval 秒读取各节点的 /queue 和 /system_stats。
+    提交顺序由 SubmissionPlanner 决定：每个节点最多 submit_window 个已提交的 prompt，
+    其余任务在本地排队，按 checkpoint / LoRA 分组派发。
+    """
+
+    def __init__(self, api_urls: Iterable[str], status_interval: float = 2.0,
+                 model_switch_cost: float = 2.0, submit_window: int = 2, max_group_wait: float = 30):
+        urls = list(dict.fromkeys(url.rstrip('/') for url in api_urls))
+        if not urls:
+            raise ValueError("ComfyUI pool needs at least one node")
+        self.nodes = [ComfyUINode(url) for url in urls]
+        self.status_interval = status_interval
+        self.model_switch_cost = model_switch_cost
+        self.planner = SubmissionPlanner(submit_window, max_group_wait)
+        self._lock = threading.Lock()
+        if len(self.nodes) > 1:
+            threading.Thread(target=self._refresh_loop, name="comfyui-pool", daemon=True).start()
+
+    @property
+    def primary(self) -> ComfyUINode:
+        return self.nodes[0]
+
+    def node(self, api_url: Optional[str]) -> ComfyUINode:
+        """按地址查找节点；地址为空或未知时返回第一个节点"""
+        for node in self.nodes:
+            if node.api_url == api_url:
+                return node
+        return self.primary
+
+    def _refresh_loop(self):
+        while True:
+            for node in self.nodes:
+                node.refresh()
+            time.sleep(self.status_interval)
+
+    def _score(self, node: ComfyUINode, models: FrozenSet[str]) -> Tuple[float, int]:
+        switch = self.model_switch_cost if models - node.models else 0
+        return node.queue_depth() + switch, -(node.vram_free or 0)
+
+    def _enqueue(self, graph: Dict[str, Any], exclude: Iterable[str],
+                 loop: Optional[asyncio.AbstractEventLoop] = None) -> Optional[PlannedJob]:
+        job = PlannedJob(graph_models(graph), exclude, loop)
+        with self._lock:
+            if all(node.api_url in job.exclude for node in self.nodes):
+                return None
+            self.planner.pending.append(job)
+            self._dispatch()
+        return job
+
+    def _dispatch(self):
+        """（持有锁时调用）把能派发的排队任务分配给节点并唤醒等待方"""
+        while True:
+            choice = self.planner.next(self.nodes, self._score)
+            if choice is None:
+                return
+            job, node = choice
+            self.planner.pending.remove(job)
+            node.in_flight += 1
+            if job.models:
+                if node.models and job.models != node.models:
+                    COMFYUI_MODEL_SWITCHES.inc(node=node.api_url)
+                node.models = job.models
+            job.node = node
+            COMFYUI_DISPATCHES.inc(node=node.api_url)
+            job.wake()
+
+    def acquire(self, graph: Dict[str, Any], exclude: Iterable[str] = ()) -> Optional[ComfyUINode]:
+        """
+        为一个工作流选择节点并计入在途任务（用完后调用 release）。节点都已占满时
+        在本地排队，直到 SubmissionPlanner 派发。
+        exclude 为本任务已经失败过的节点；没有可用节点时退回其余节点，
+        全部排除后返回 None
+        """
+        job = self._enqueue(graph, exclude)
+        if job is None:
+            return None
+        job.event.wait()
+        return job.node
+
+    async def acquire_async(self, graph: Dict[str, Any], exclude: Iterable[str] = ()) -> Optional[ComfyUINode]:
+        """acquire 的 asyncio 版本：排队时不阻塞事件循环"""
+        job = self._enqueue(graph, exclude, asyncio.get_running_loop())
+        if job is None:
+            return None
+        try:
+            await job.async_event.wait()
+        except asyncio.CancelledError:
+            with self._lock:
+                dispatched = job not in self.planner.pending
+                if not dispatched:
+                    self.planner.pending.remove(job)
+            if dispatched:
+                self.release(job.node)
+            raise
+        return job.node
+
+    def release(self, node: ComfyUINode):
+        with self._lock:
+            node.in_flight -= 1
+            self._dispatch()
+
+    def queued(self) -> int:
+        """本地排队、尚未提交给 ComfyUI 的任务数"""
+        return len(self.planner.pending)
+
+    def queue_depth(self) -> Optional[int]:
+        """全部节点的队列长度之和；单节点时为 /ws 上报的值（未知时为 None）"""
+        if len(self.nodes) == 1:
+            return self.primary.tracker.queue_remaining
+        return sum(node.queue_depth() for node in self.nodes)
+
+    def unavailable_event(self) -> Optional[Dict[str, Any]]:
+        """所有节点都不可用时的流式错误事件"""
+        return pool_unavailable_event("comfyui", (node.client for node in self.nodes), "node")
+
+    def status(self) -> List[Dict[str, Any]]:
+        return [node.status() for node in self.nodes]
+
+
+_pools: Dict[Tuple[str, ...], ComfyUIPool] = {}
+_pools_lock = threading.Lock()
+
+
+def comfyui_urls() -> List[str]:
+    """配置中的 ComfyUI 节点：CONFIG["comfyui"]["api_urls"]，为空时只用 api_url"""
+    settings = CONFIG["comfyui"]
+    return list(settings.get("api_urls") or [settings["api_url"]])
+
+
+def get_pool(api_urls: Optional[Sequence[str]] = None) -> ComfyUIPool:
+    """按节点地址列表获取进程内共享的节点池；为空时使用配置中的节点"""
+    urls = tuple(url.rstrip('/') for url in (api_urls or comfyui_urls()))
+    with _pools_lock:
+        pool = _pools.get(urls)
+        if pool is None:
+            settings = CONFIG["comfyui"]
+            pool = ComfyUIPool(urls, status_interval=settings.get("status_interval", 2),
+                               model_switch_cost=settings.get("model_switch_cost", 2),
+                               submit_window=settings.get("submit_window", 2),
+                               max_group_wait=settings.get("max_group_wait", 30))
+            _pools[urls] = pool
+    return pool
@@ -0,0 +1,319 @@
+import json
+import logging
+import struct
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    import websocket  # websocket-client
+except ImportError:  # 未安装时退回 /history 轮询
+    websocket = None
+
+logger = logging.getLogger(__name__)
+
+# /ws 二进制消息的事件类型（前 4 字节，大端）
+PREVIEW_IMAGE = 1
+PREVIEW_IMAGE_WITH_METADATA = 4
+_IMAGE_TYPES = {1: "image/jpeg", 2: "image/png"}
+
+
+class PromptState:
+    """单个 prompt 在 ComfyUI 中的执行状态"""
+
+    def __init__(self, prompt_id: str):
+        self.prompt_id = prompt_id
+        self.output_node: Optional[str] = None
+        self.outputs: Dict[str, Any] = {}
+        self.current_node: Optional[str] = None
+        self.progress = (0, 0)
+        self.cached_nodes: List[str] = []
+        self.error: Optional[str] = None
+        self.finished = False
+        self.created_at = time.monotonic()
+        self.event = threading.Event()
+        # 预览回调：收到逐步预览或首遍预览节点（preview_node）的输出时调用
+        self.listener: Optional[Callable[[Dict[str, Any]], None]] = None
+        self.preview_node: Optional[str] = None
+
+    def is_ready(self) -> bool:
+        """输出节点已完成、整个 prompt 已结束或执行出错"""
+        if self.error or self.finished:
+            return True
+        return self.output_node is not None and self.output_node in self.outputs
+
+
+class ComfyUITracker:
+    """
+    通过 ComfyUI 的 /ws 长连接跟踪 prompt 的执行进度。
+
+    每个进程对每个 ComfyUI 地址只保持一条连接（见 get_tracker），
+    按 prompt_id 分发 executing / progress / executed 消息，
+    输出节点完成后立即唤醒等待的调用方。
+    """
+
+    def __init__(self,
+                 api_url: str,
+                 client_id: Optional[str] = None,
+                 recv_timeout: float = 30,
+                 max_reconnect_delay: float = 30,
+                 state_ttl: float = 3600):
+        self.api_url = api_url.rstrip('/')
+        self.client_id = client_id or uuid.uuid4().hex
+        self.ws_url = self._to_ws_url(self.api_url) + f"/ws?clientId={self.client_id}"
+        self.recv_timeout = recv_timeout
+        self.max_reconnect_delay = max_reconnect_delay
+        self.state_ttl = state_ttl
+        self.queue_remaining: Optional[int] = None
+        self._executing: Optional[str] = None  # 正在执行的 prompt（逐步预览的二进制消息不带 prompt_id）
+        self._states: Dict[str, PromptState] = {}
+        self._lock = threading.Lock()
+        self._connected = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._ws = None
+
+    @staticmethod
+    def _to_ws_url(api_url: str) -> str:
+        if api_url.startswith('https://'):
+            return 'wss://' + api_url[len('https://'):]
+        if api_url.startswith('http://'):
+            return 'ws://' + api_url[len('http://'):]
+        return api_url
+
+    @property
+    def available(self) -> bool:
+        """是否安装了 websocket-client"""
+        return websocket is not None
+
+    def connected(self) -> bool:
+        return self._connected.is_set()
+
+    def start(self):
+        """启动后台接收线程（重复调用无副作用）"""
+        if not self.available:
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="comfyui-ws", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def wait_connected(self, timeout: float) -> bool:
+        return self._connected.wait(timeout)
+
+    def _run(self):
+        delay = 1.0
+        while not self._stopped.is_set():
+            try:
+                self._ws = websocket.create_connection(self.ws_url, timeout=self.recv_timeout)
+                self._connected.set()
+                delay = 1.0
+                logger.info(f"Connected to ComfyUI websocket: {self.ws_url}")
+                while not self._stopped.is_set():
+                    try:
+                        message = self._ws.recv()
+                    except websocket.WebSocketTimeoutException:
+                        continue
+                    if isinstance(message, str):
+                        self._handle_message(message)
+                    elif message:
+                        self._handle_binary(message)
+            except Exception as e:
+                if not self._stopped.is_set():
+                    logger.warning(f"ComfyUI websocket disconnected: {str(e)}")
+            finally:
+                self._connected.clear()
+                self._wake_waiters()
+                if self._ws is not None:
+                    try:
+                        self._ws.close()
+                    except Exception:
+                        pass
+                    self._ws = None
+            # 断线后指数退避重连
+            self._stopped.wait(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    def _state(self, prompt_id: str) -> PromptState:
+        """获取或创建状态；消息可能早于 watch() 到达，需先缓存"""
+        state = self._states.get(prompt_id)
+        if state is None:
+            self._prune()
+            state = PromptState(prompt_id)
+            self._states[prompt_id] = state
+        return state
+
+    def _prune(self):
+        """清理长时间无人认领的状态，避免内存无限增长"""
+        now = time.monotonic()
+        expired = [pid for pid, s in self._states.items() if now - s.created_at > self.state_ttl]
+        for pid in expired:
+            del self._states[pid]
+
+    def _handle_message(self, raw: str):
+        try:
+            message = json.loads(raw)
+        except json.JSONDecodeError:
+            return
+        msg_type = message.get('type')
+        data = message.get('data') or {}
+
+        if msg_type == 'status':
+            exec_info = data.get('status', {}).get('exec_info', {})
+            self.queue_remaining = exec_info.get('queue_remaining', self.queue_remaining)
+            return
+
+        prompt_id = data.get('prompt_id')
+        if not prompt_id:
+            return
+
+        preview = None
+        with self._lock:
+            state = self._state(prompt_id)
+            if msg_type == 'execution_start':
+                self._executing = prompt_id
+                return
+            if msg_type == 'executing':
+                state.current_node = data.get('node')
+                if state.current_node is None:
+                    # node 为 None 表示整个 prompt 执行结束
+                    state.finished = True
+                self._executing = prompt_id if state.current_node is not None else None
+            elif msg_type == 'progress':
+                state.progress = (data.get('value', 0), data.get('max', 0))
+            elif msg_type == 'executed':
+                node = str(data.get('node'))
+                state.outputs[node] = data.get('output') or {}
+                images = state.outputs[node].get('images') or []
+                if node == state.preview_node and images and state.listener is not None:
+                    preview = (state.listener, {"kind": "first_pass", "image": images[0]})
+            elif msg_type == 'execution_cached':
+                state.cached_nodes = [str(n) for n in data.get('nodes', [])]
+            elif msg_type == 'execution_success':
+                state.finished = True
+            elif msg_type in ('execution_error', 'execution_interrupted'):
+                state.error = data.get('exception_message') or msg_type
+            else:
+                return
+            if state.is_ready():
+                self._notify(state)
+        if preview is not None:
+            self._deliver(*preview)
+
+    def _handle_binary(self, raw: bytes):
+        """
+        逐步预览（ComfyUI 以 --preview-method 启动时每个采样步推送）：
+        4 字节事件类型 + 4 字节图片格式 + 图片；带元数据的版本为 4 字节长度 + JSON 元数据 + 图片
+        """
+        if len(raw) < 8:
+            return
+        event_type = struct.unpack('>I', raw[:4])[0]
+        prompt_id = self._executing
+        if event_type == PREVIEW_IMAGE:
+            content_type = _IMAGE_TYPES.get(struct.unpack('>I', raw[4:8])[0], "image/jpeg")
+            image = raw[8:]
+        elif event_type == PREVIEW_IMAGE_WITH_METADATA:
+            size = struct.unpack('>I', raw[4:8])[0]
+            try:
+                metadata = json.loads(raw[8:8 + size])
+            except ValueError:
+                return
+            prompt_id = metadata.get('prompt_id') or prompt_id
+            content_type = metadata.get('image_type') or "image/jpeg"
+            image = raw[8 + size:]
+        else:
+            return
+        with self._lock:
+            state = self._states.get(prompt_id) if prompt_id else None
+            if state is None or state.listener is None:
+                return
+            listener, progress = state.listener, state.progress
+        self._deliver(listener, {"kind": "step", "data": image, "content_type": content_type,
+                                 "step": progress[0], "steps": progress[1]})
+
+    @staticmethod
+    def _deliver(listener: Callable[[Dict[str, Any]], None], preview: Dict[str, Any]):
+        """在接收线程（或事件循环）中调用预览回调；回调出错不影响消息接收"""
+        try:
+            listener(preview)
+        except Exception as e:
+            logger.warning(f"Preview listener failed: {str(e)}")
+
+    def _notify(self, state: PromptState):
+        """唤醒等待该 prompt 的调用方"""
+        state.event.set()
+
+    def _wake_waiters(self):
+        """连接断开时唤醒所有等待者，让它们改为轮询 /history（并尽早发现节点已宕机）"""
+        with self._lock:
+            for state in self._states.values():
+                if state.output_node is not None:
+                    self._notify(state)
+
+    def _take(self, state: PromptState) -> Optional[PromptState]:
+        """被唤醒后：prompt 已就绪时返回状态，否则（断线唤醒）复位事件并返回 None"""
+        with self._lock:
+            if state.is_ready():
+                return state
+            state.event.clear()
+            return None
+
+    def watch(self, prompt_id: str, output_node: str) -> PromptState:
+        """登记需要等待的 prompt 及其输出节点"""
+        with self._lock:
+            state = self._state(prompt_id)
+            state.output_node = str(output_node)
+            if state.is_ready():
+                self._notify(state)
+            return state
+
+    def listen(self, prompt_id: str, listener: Callable[[Dict[str, Any]], None],
+               preview_node: Optional[str] = None):
+        """登记该 prompt 的预览回调；preview_node 为首遍预览（PreviewImage）节点"""
+        with self._lock:
+            state = self._state(prompt_id)
+            state.listener = listener
+            state.preview_node = str(preview_node) if preview_node is not None else None
+
+    def wait(self, prompt_id: str, output_node: str, timeout: float) -> Optional[PromptState]:
+        """等待输出节点完成；超时返回 None"""
+        state = self.watch(prompt_id, output_node)
+        if state.event.wait(timeout):
+            return self._take(state)
+        return None
+
+    def discard(self, prompt_id: str) -> Optional[PromptState]:
+        """不再跟踪该 prompt，返回它最后的状态（未收到任何消息时为 None）"""
+        with self._lock:
+            return self._states.pop(prompt_id, None)
+
+
+_trackers: Dict[str, ComfyUITracker] = {}
+_trackers_lock = threading.Lock()
+
+
+def get_tracker(api_url: str) -> ComfyUITracker:
+    """每个 ComfyUI 地址在进程内共享一个 tracker"""
+    key = api_url.rstrip('/')
+    with _trackers_lock:
+        tracker = _trackers.get(key)
+        if tracker is None:
+            tracker = ComfyUITracker(key)
+            _trackers[key] = tracker
+    tracker.start()
+    return tracker
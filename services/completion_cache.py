@@ -0,0 +1,136 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class CompletionCache:
+    """
+    LLM 补全结果缓存：内存 LRU + SQLite 两级。
+
+    键由 model、messages、temperature、max_tokens 组成；
+    调用方只应在响应通过 JSON 校验后再 put()，避免缓存坏结果。
+    """
+
+    def __init__(self,
+                 db_path: str,
+                 model: str = "default",
+                 memory_entries: int = 128,
+                 ttl: float = 7 * 24 * 3600,
+                 max_bytes: int = 256 * 1024 ** 2,
+                 enabled: bool = True):
+        self.db_path = db_path
+        self.model = model
+        self.memory_entries = memory_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        if enabled:
+            self._conn = self._connect()
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS completions (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_completions_last_used ON completions(last_used)")
+        conn.commit()
+        return conn
+
+    def key_for(self, payload: Dict[str, Any]) -> str:
+        """根据请求体计算缓存键"""
+        key_data = {
+            "model": payload.get("model", self.model),
+            "messages": payload.get("messages"),
+            "temperature": payload.get("temperature"),
+            "max_tokens": payload.get("max_tokens")
+        }
+        canonical = json.dumps(key_data, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def get(self, payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """命中且未过期时返回缓存的响应"""
+        if not self.enabled:
+            return None
+        key = self.key_for(payload)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                response, created = entry
+                if now - created <= self.ttl:
+                    self._memory.move_to_end(key)
+                    return response
+                del self._memory[key]
+
+            row = self._conn.execute(
+                "SELECT response, created FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            response_text, created = row
+            if now - created > self.ttl:
+                self._conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE completions SET last_used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            response = json.loads(response_text)
+            self._remember(key, response, created)
+            return response
+
+    def put(self, payload: Dict[str, Any], response: Dict[str, Any]):
+        """保存已通过校验的响应"""
+        if not self.enabled:
+            return
+        key = self.key_for(payload)
+        response_text = json.dumps(response, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO completions (key, response, size, created, last_used) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, response_text, len(response_text.encode('utf-8')), now, now))
+                self._evict(now)
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"Error writing completion cache: {str(e)}")
+            self._remember(key, response, now)
+
+    def _remember(self, key: str, response: Dict[str, Any], created: float):
+        self._memory[key] = (response, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict(self, now: float):
+        """删除过期条目，并在超出容量时按最近使用时间淘汰"""
+        self._conn.execute("DELETE FROM completions WHERE created < ?", (now - self.ttl,))
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute("SELECT key, size FROM completions ORDER BY last_used").fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+            self._memory.pop(key, None)
+            total -= size
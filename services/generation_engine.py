@@ -0,0 +1,328 @@
+import asyncio
+import concurrent.futures
+import json
+import logging
+import queue
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from agents.art_designer import ArtDesigner
+from agents.async_agents import AsyncArtDesigner, AsyncCharacterDesigner, AsyncStoryCreator
+from agents.book_maker import BookAssembly, BookMaker
+from agents.character_designer import CharacterDesigner
+from agents.story_creator import StoryCreator
+from models.character import Character
+from models.story import Scene
+from services.metrics import STAGE_SECONDS, STORIES_IN_FLIGHT
+from services.story_store import load_story, story_record
+from utils.story_events import completed_event, failure_event
+
+logger = logging.getLogger(__name__)
+
+
+class _SceneFailed(Exception):
+    """某个场景渲染失败，终止整个故事"""
+
+
+class GenerationEngine:
+    """
+    基于 asyncio 的故事生成引擎。
+
+    所有故事共用一个后台事件循环线程，LLM 调用、ComfyUI 提交/等待和图片下载
+    都是协程，等待期间不占用线程；stream() / upgrade_stream() 把事件转换成与
+    app.generate_story_stream / app.upgrade_story_stream 相同的 NDJSON 行，供 Flask 直接返回。
+    """
+
+    _DONE = object()
+
+    def __init__(self,
+                 character_designer: CharacterDesigner,
+                 story_creator: StoryCreator,
+                 art_designer: ArtDesigner,
+                 book_maker: BookMaker,
+                 max_in_flight: int = 8,
+                 static_files=None,
+                 story_store=None):
+        self.book_maker = book_maker
+        self.max_in_flight = max_in_flight
+        self.derivatives = art_designer.derivatives
+        self.static_files = static_files
+        self.story_store = story_store
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever,
+                                        name="generation-engine", daemon=True)
+        self._thread.start()
+        # 异步代理的连接池绑定在引擎的事件循环上，需在循环内创建
+        asyncio.run_coroutine_threadsafe(
+            self._setup(character_designer, story_creator, art_designer), self._loop).result()
+
+    async def _setup(self, character_designer, story_creator, art_designer):
+        self.character_designer = AsyncCharacterDesigner(character_designer)
+        self.story_creator = AsyncStoryCreator(story_creator)
+        self.art_designer = AsyncArtDesigner(art_designer)
+
+    def submit(self, emit: Callable[[Dict[str, Any]], None], user_input: str,
+               character_data: Optional[dict] = None, use_cache: bool = True,
+               stream: bool = False, preset: Optional[str] = None,
+               quality: Optional[str] = None) -> "concurrent.futures.Future":
+        """在引擎的事件循环中启动一个故事，返回可取消的 Future"""
+        return asyncio.run_coroutine_threadsafe(
+            self.generate(emit, user_input, character_data, use_cache, stream, preset, quality), self._loop)
+
+    def stream(self, user_input: str, character_data: Optional[dict] = None,
+               use_cache: bool = True, stream: bool = False,
+               preset: Optional[str] = None, quality: Optional[str] = None) -> Iterator[str]:
+        """在调用线程中逐行产出 NDJSON；客户端断开时取消对应的协程"""
+        return self._lines(lambda emit: self.submit(emit, user_input, character_data, use_cache,
+                                                    stream, preset, quality))
+
+    def upgrade_stream(self, story_id: str, record: Dict[str, Any]) -> Iterator[str]:
+        """把草稿故事升级为最终质量，在调用线程中逐行产出 NDJSON（同 stream()）"""
+        return self._lines(lambda emit: asyncio.run_coroutine_threadsafe(
+            self.upgrade(emit, story_id, record), self._loop))
+
+    def _lines(self, start: Callable[[Callable[[Dict[str, Any]], None]], "concurrent.futures.Future"]
+               ) -> Iterator[str]:
+        """start(emit) 在事件循环中启动协程并返回其 Future；这里把 emit 推送的事件逐行产出"""
+        lines: "queue.Queue" = queue.Queue()
+        future = start(lambda event: lines.put(json.dumps(event) + "\n"))
+        future.add_done_callback(lambda _: lines.put(self._DONE))
+        try:
+            while True:
+                line = lines.get()
+                if line is self._DONE:
+                    return
+                yield line
+        finally:
+            future.cancel()
+
+    async def generate(self, emit: Callable[[Dict[str, Any]], None], user_input: str,
+                       character_data: Optional[dict] = None,
+                       use_cache: bool = True, stream: bool = False,
+                       preset: Optional[str] = None, quality: Optional[str] = None):
+        """生成一个故事，按 generate_story_stream 的顺序通过 emit 推送事件"""
+        with STORIES_IN_FLIGHT.track_inprogress():
+            await self._generate(emit, user_input, character_data, use_cache, stream, preset, quality or "final")
+
+    async def _generate(self, emit: Callable[[Dict[str, Any]], None], user_input: str,
+                        character_data: Optional[dict], use_cache: bool, stream: bool,
+                        preset: Optional[str], quality: str):
+        try:
+            emit({"status": "generating_character"})
+            if character_data:
+                character = self.character_designer.create_character_from_data(character_data)
+            else:
+                with STAGE_SECONDS.time(stage="character"):
+                    character = await self.character_designer.create_character(user_input, use_cache=use_cache)
+            if not character:
+                logger.error("Character generation failed")
+                emit(failure_event("Character generation failed",
+                                   None if character_data else self.character_designer.llm))
+                return
+            emit({"status": "character_completed"})
+
+            emit({"status": "generating_story"})
+            story_started = time.monotonic()
+            assembly = self.book_maker.start_book()
+            scenes = _SceneRenders(self, character, emit, preset, assembly, quality)
+            try:
+                if stream:
+                    # 流式模式：模型每写完一个场景就立即开始渲染
+                    story = None
+                    async for kind, value in self.story_creator.stream_story(character, use_cache=use_cache):
+                        if kind == "scene":
+                            index, scene = value
+                            scenes.submit(index, scene)
+                            emit({"status": "scene_ready", "scene": index + 1, "title": scene.title})
+                            if scenes.failed():
+                                break
+                        else:
+                            story = value
+                else:
+                    story = await self.story_creator.create_story(character, use_cache=use_cache)
+
+                if not scenes.failed():
+                    if not story:
+                        logger.error("Story generation failed")
+                        emit(failure_event("Story generation failed", self.story_creator.llm))
+                        return
+                    STAGE_SECONDS.observe(time.monotonic() - story_started, stage="story")
+                    emit({"status": "story_completed"})
+                    if not stream:
+                        for i, scene in enumerate(story.scenes):
+                            scenes.submit(i, scene)
+                    scenes.total = len(story.scenes)
+                await scenes.wait()
+            except _SceneFailed as e:
+                emit(failure_event(f"Image generation failed for scene: {e}",
+                                   self.art_designer.sd_service.pool))
+                return
+            finally:
+                scenes.cancel()
+            scene_images = scenes.ordered_images()
+            emit(dict(scenes.cache_summary(), status="images_completed"))
+
+            # 场景页已在图片完成时于排版进程中预处理，这里只等待拼装结果
+            with STAGE_SECONDS.time(stage="book"):
+                book = await asyncio.to_thread(assembly.build, story, scene_images)
+            if not book:
+                logger.error("Storybook generation failed")
+                emit({"error": "Storybook generation failed"})
+                return
+            emit(dict(book, status="book_completed"))
+            story_id = None
+            if self.story_store is not None:
+                story_id = await asyncio.to_thread(self.story_store.save, story_record(
+                    character, story, scene_images, scenes.ordered_latents(), book["book_path"], preset, quality))
+            event = await asyncio.to_thread(completed_event, character, story, scene_images, book["book_path"],
+                                            self.derivatives, self.static_files)
+            emit(dict(event, story_id=story_id, quality=quality))
+
+        except asyncio.CancelledError:
+            logger.info("Story generation cancelled")
+            raise
+        except Exception as e:
+            logger.error(f"发生错误: {str(e)}")
+            logger.error(traceback.format_exc())
+            emit({"error": str(e)})
+
+
+    async def upgrade(self, emit: Callable[[Dict[str, Any]], None], story_id: str, record: Dict[str, Any]):
+        """把草稿故事升级为最终质量，按 upgrade_story_stream 的顺序通过 emit 推送事件"""
+        with STORIES_IN_FLIGHT.track_inprogress():
+            await self._upgrade(emit, story_id, record)
+
+    async def _upgrade(self, emit: Callable[[Dict[str, Any]], None], story_id: str, record: Dict[str, Any]):
+        tasks: List[asyncio.Task] = []
+        try:
+            character, story = load_story(record)
+            total = len(record["scenes"])
+            emit({"status": "upgrading", "story_id": story_id, "total": total})
+            assembly = self.book_maker.start_book()
+            scene_images: List[Optional[str]] = [None] * total
+            upgraded = {"latent": 0, "rerender": 0}
+            semaphore = asyncio.Semaphore(max(1, self.max_in_flight))
+
+            async def upgrade_scene(index: int, scene: Scene, latent: Optional[Dict[str, Any]]):
+                async with semaphore:
+                    return index, await self.art_designer.upgrade_scene(scene, character, record["preset"], latent)
+
+            tasks = [asyncio.ensure_future(upgrade_scene(i, scene, item["latent"]))
+                     for i, (scene, item) in enumerate(zip(story.scenes, record["scenes"]))]
+            for next_done in asyncio.as_completed(tasks):
+                index, result = await next_done
+                if not result:
+                    title = story.scenes[index].title
+                    logger.error(f"Image upgrade failed for scene: {title}")
+                    emit(failure_event(f"Image generation failed for scene: {title}",
+                                       self.art_designer.sd_service.pool))
+                    return
+                result.pop("latent", None)
+                scene_images[index] = result["image_path"]
+                upgraded[result["upgraded"]] += 1
+                assembly.add_image(result["image_path"])
+                emit(dict(result, status="image_completed", scene=index + 1, total=total))
+            emit({"status": "images_completed", "upgraded_from_latent": upgraded["latent"],
+                  "rerendered": upgraded["rerender"]})
+
+            with STAGE_SECONDS.time(stage="book"):
+                book = await asyncio.to_thread(assembly.build, story, scene_images)
+            if not book:
+                logger.error("Storybook generation failed")
+                emit({"error": "Storybook generation failed"})
+                return
+            emit(dict(book, status="book_completed"))
+            if self.story_store is not None:
+                await asyncio.to_thread(self.story_store.update, story_id, story_record(
+                    character, story, scene_images, [None] * total, book["book_path"], record["preset"], "final"))
+            event = await asyncio.to_thread(completed_event, character, story, scene_images, book["book_path"],
+                                            self.derivatives, self.static_files)
+            emit(dict(event, story_id=story_id, quality="final"))
+
+        except asyncio.CancelledError:
+            logger.info("Story upgrade cancelled")
+            raise
+        except Exception as e:
+            logger.error(f"发生错误: {str(e)}")
+            logger.error(traceback.format_exc())
+            emit({"error": str(e)})
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+class _SceneRenders:
+    """一个故事内的场景渲染任务，每个故事最多 max_in_flight 个场景同时在途"""
+
+    def __init__(self, engine: GenerationEngine, character: Character,
+                 emit: Callable[[Dict[str, Any]], None], preset: Optional[str] = None,
+                 assembly: Optional[BookAssembly] = None, quality: Optional[str] = None):
+        self.engine = engine
+        self.assembly = assembly
+        self.character = character
+        self.preset = preset
+        self.quality = quality
+        self.emit = emit
+        self.total: Optional[int] = None
+        self.image_paths: Dict[int, Optional[str]] = {}
+        self.latents: Dict[int, Optional[Dict[str, Any]]] = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.gpu_seconds_saved = 0.0
+        self._semaphore = asyncio.Semaphore(max(1, engine.max_in_flight))
+        self._tasks: List[asyncio.Task] = []
+
+    def submit(self, index: int, scene: Scene):
+        self._tasks.append(asyncio.ensure_future(self._render(index, scene)))
+
+    async def _render(self, index: int, scene: Scene):
+        submitted = time.monotonic()
+        async with self._semaphore:
+            STAGE_SECONDS.observe(time.monotonic() - submitted, stage="image_queue_wait")
+            self.emit({"status": "generating_image", "scene": index + 1, "total": self.total})
+            result = await self.engine.art_designer.render_scene(
+                scene, self.character, self.preset,
+                on_preview=lambda preview: self.emit(
+                    dict(preview, status="scene_preview", scene=index + 1, total=self.total)),
+                quality=self.quality)
+        if not result:
+            logger.error(f"Image generation failed for scene: {scene.title}")
+            raise _SceneFailed(scene.title)
+        self.image_paths[index] = result["image_path"]
+        self.latents[index] = result.pop("latent", None)
+        if result["cache"] == "hit":
+            self.cache_hits += 1
+            self.gpu_seconds_saved += result["render_seconds"] or 0
+        else:
+            self.cache_misses += 1
+        if self.assembly is not None:
+            self.assembly.add_image(result["image_path"])
+        self.emit(dict(result, status="image_completed", scene=index + 1, total=self.total))
+
+    def failed(self) -> bool:
+        return any(t.done() and not t.cancelled() and t.exception() for t in self._tasks)
+
+    async def wait(self):
+        """等待全部场景完成；任一场景失败时抛出 _SceneFailed"""
+        if not self._tasks:
+            return
+        done, _ = await asyncio.wait(self._tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            if task.exception():
+                raise task.exception()
+
+    def cancel(self):
+        for task in self._tasks:
+            task.cancel()
+
+    def ordered_images(self) -> List[Optional[str]]:
+        return [self.image_paths.get(i) for i in range(self.total or 0)]
+
+    def ordered_latents(self) -> List[Optional[Dict[str, Any]]]:
+        return [self.latents.get(i) for i in range(self.total or 0)]
+
+    def cache_summary(self) -> Dict[str, Any]:
+        return {"cache_hits": self.cache_hits, "cache_misses": self.cache_misses,
+                "gpu_seconds_saved": round(self.gpu_seconds_saved, 2)}
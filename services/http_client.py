@@ -0,0 +1,159 @@
+import logging
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import CONFIG
+from services.metrics import BACKEND_ERRORS, BACKEND_REQUEST_SECONDS
+from services.resilience import backend_unavailable_event, get_resilience
+
+logger = logging.getLogger(__name__)
+
+
+class BackendClient:
+    """
+    单个后端（LM Studio / ComfyUI）的共享 HTTP 客户端。
+
+    所有代理复用同一个 keep-alive 连接池；健康状态由后台线程按 TTL 探测，
+    调用方通过 is_healthy() 读取缓存结果，不再每次请求前额外探测一次。
+    请求经过该后端的熔断器（见 services/resilience.py），后端宕机时快速失败。
+    """
+
+    def __init__(self,
+                 name: str,
+                 base_url: str,
+                 pool_size: int = 10,
+                 connect_timeout: float = 3.05,
+                 read_timeout: float = 60,
+                 health_path: str = "/",
+                 health_ttl: float = 10):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.timeout: Tuple[float, float] = (connect_timeout, read_timeout)
+        self.health_path = health_path
+        self.health_ttl = health_ttl
+        self.resilience = get_resilience(name, self.base_url)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._healthy: Optional[bool] = None
+        self._checked_at = 0.0
+        self._prober: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}{path}"
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        """
+        发送请求；未指定 timeout 时使用 (connect, read) 默认超时。
+        熔断器打开时不发送请求，直接抛出 BackendUnavailable
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        trial = self.resilience.before_request()
+        started = time.monotonic()
+        try:
+            response = self.session.request(method, self.url(path), **kwargs)
+        except requests.exceptions.RequestException as e:
+            BACKEND_ERRORS.inc(backend=self.name)
+            self.resilience.record(False, type(e).__name__)
+            if isinstance(e, requests.exceptions.ConnectionError):
+                self._set_health(False)
+            raise
+        except BaseException:
+            if trial:
+                self.resilience.breaker.release()
+            raise
+        BACKEND_REQUEST_SECONDS.observe(time.monotonic() - started, backend=self.name)
+        if response.status_code >= 500:
+            BACKEND_ERRORS.inc(backend=self.name)
+            self.resilience.record(False, f"HTTP {response.status_code}")
+        else:
+            self.resilience.record(True)
+        self._set_health(True)
+        return response
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request('POST', path, **kwargs)
+
+    def _set_health(self, healthy: bool):
+        if healthy != self._healthy:
+            logger.info(f"Backend {self.name} ({self.base_url}) is {'up' if healthy else 'down'}")
+        self._healthy = healthy
+        self._checked_at = time.monotonic()
+
+    def probe(self) -> bool:
+        """立即探测一次后端"""
+        try:
+            response = self.session.get(self.url(self.health_path), timeout=(self.timeout[0], 5))
+            healthy = response.status_code == 200
+            error = f"HTTP {response.status_code}"
+        except requests.exceptions.RequestException as e:
+            healthy = False
+            error = type(e).__name__
+        self._set_health(healthy)
+        # 熔断器打开期间由健康探测充当半开试探
+        self.resilience.breaker.record_probe(healthy, error)
+        return healthy
+
+    def _probe_loop(self):
+        while True:
+            time.sleep(self.health_ttl)
+            self.probe()
+
+    @property
+    def down(self) -> bool:
+        """最近一次请求或健康探测表明后端不可达"""
+        return self._healthy is False
+
+    def unavailable_event(self) -> Optional[Dict[str, Any]]:
+        return backend_unavailable_event(self)
+
+    def is_healthy(self) -> bool:
+        """返回缓存的健康状态；首次调用时同步探测并启动后台探测线程"""
+        with self._lock:
+            if self._prober is None:
+                self._prober = threading.Thread(
+                    target=self._probe_loop, name=f"health-{self.name}", daemon=True)
+                self._prober.start()
+            if self._healthy is None:
+                # 并发的首批调用方等待同一次探测结果，而不是直接读到 None
+                self.probe()
+        return bool(self._healthy)
+
+
+_backends: Dict[Tuple[str, str], BackendClient] = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(name: str, base_url: Optional[str] = None) -> BackendClient:
+    """
+    按 CONFIG[name] 获取进程内共享的后端客户端。
+    base_url 可覆盖配置中的 api_url。
+    """
+    settings = CONFIG[name]
+    base_url = (base_url or settings["api_url"]).rstrip('/')
+    key = (name, base_url)
+    with _backends_lock:
+        client = _backends.get(key)
+        if client is None:
+            client = BackendClient(
+                name,
+                base_url,
+                pool_size=settings.get("pool_size", 10),
+                connect_timeout=settings.get("connect_timeout", 3.05),
+                read_timeout=settings.get("read_timeout", 60),
+                health_path=settings.get("health_path", "/"),
+                health_ttl=settings.get("health_ttl", 10)
+            )
+            _backends[key] = client
+    return client
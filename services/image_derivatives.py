@@ -0,0 +1,148 @@
+import logging
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Optional
+
+from PIL import Image, features
+
+from utils.image_utils import ImageUtils
+
+logger = logging.getLogger(__name__)
+
+# Pillow 中检查编码器是否可用的特性名
+_FEATURES = {"avif": "avif", "webp": "webp", "jpeg": "jpg"}
+_EXTENSIONS = {"avif": "avif", "webp": "webp", "jpeg": "jpg"}
+
+
+class DerivativeStore:
+    """
+    场景原图（约 2–3 MB 的 PNG）的网页派生图：多种格式 × 多个宽度，缓存在磁盘上。
+
+    派生图文件名为 <原图名>_<宽度>w.<扩展名>，可以在首次请求时惰性生成（ensure），
+    也可以在场景渲染完成后交给后台线程池提前生成（schedule）。
+    """
+
+    def __init__(self,
+                 source_dir: str = "static/images",
+                 output_dir: str = "static/images/derived",
+                 url_prefix: str = "/static/images/derived",
+                 widths: Iterable[int] = (320, 800),
+                 formats: Iterable[str] = ("avif", "webp", "jpeg"),
+                 quality: Optional[Dict[str, int]] = None,
+                 eager: bool = True,
+                 workers: int = 2):
+        self.source_dir = source_dir
+        self.output_dir = output_dir
+        self.url_prefix = url_prefix.rstrip('/')
+        self.widths = sorted(widths)
+        # 跳过当前 Pillow 不支持的编码器（例如没有 AVIF 插件）
+        self.formats = [f for f in formats if features.check(_FEATURES[f])]
+        if not self.formats:
+            self.formats = ["jpeg"]
+        self.quality = quality or {}
+        self.eager = eager
+        self.image_utils = ImageUtils()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="derivatives")
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+        extensions = "|".join(re.escape(_EXTENSIONS[f]) for f in self.formats)
+        self._name_re = re.compile(rf"^(?P<stem>[\w.-]+)_(?P<width>\d+)w\.(?P<ext>{extensions})$")
+        os.makedirs(output_dir, exist_ok=True)
+
+    @property
+    def fallback_format(self) -> str:
+        """所有浏览器都支持的格式，用作 <img src>"""
+        return "jpeg" if "jpeg" in self.formats else self.formats[-1]
+
+    def filename_for(self, source_name: str, width: int, image_format: str) -> str:
+        stem = os.path.splitext(source_name)[0]
+        return f"{stem}_{width}w.{_EXTENSIONS[image_format]}"
+
+    def parse(self, name: str) -> Optional[Dict[str, Any]]:
+        """解析派生图文件名；不合法或未配置的宽度/格式返回 None"""
+        match = self._name_re.match(name)
+        if not match or int(match.group("width")) not in self.widths:
+            return None
+        image_format = next(f for f in self.formats if _EXTENSIONS[f] == match.group("ext"))
+        return {"source": f"{match.group('stem')}.png", "width": int(match.group("width")),
+                "format": image_format}
+
+    def ensure(self, source_name: str, width: int, image_format: str) -> Optional[str]:
+        """返回派生图路径，不存在时立即生成；原图不存在时返回 None"""
+        name = self.filename_for(source_name, width, image_format)
+        path = os.path.join(self.output_dir, name)
+        if os.path.exists(path):
+            return path
+        source = os.path.join(self.source_dir, source_name)
+        if not os.path.exists(source):
+            return None
+        with self._lock_for(name):
+            if os.path.exists(path):
+                return path
+            with Image.open(source) as image:
+                resized = self.image_utils.resize_to_width(image, width)
+            fd, tmp_path = tempfile.mkstemp(dir=self.output_dir, prefix=".tmp_")
+            os.close(fd)
+            try:
+                self.image_utils.save_web_image(resized, tmp_path, image_format,
+                                                quality=self.quality.get(image_format, 80))
+                os.replace(tmp_path, path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        with self._locks_lock:
+            self._locks.pop(name, None)
+        return path
+
+    def _lock_for(self, name: str) -> threading.Lock:
+        with self._locks_lock:
+            return self._locks.setdefault(name, threading.Lock())
+
+    def schedule(self, image_path: Optional[str]):
+        """eager 模式下在后台生成该原图的全部派生图"""
+        if not self.eager or not image_path:
+            return
+        source_name = os.path.basename(image_path)
+        for width in self.widths:
+            for image_format in self.formats:
+                self._executor.submit(self._generate_quietly, source_name, width, image_format)
+
+    def _generate_quietly(self, source_name: str, width: int, image_format: str):
+        try:
+            self.ensure(source_name, width, image_format)
+        except Exception as e:
+            logger.warning(f"Error creating {image_format} derivative of {source_name}: {str(e)}")
+
+    def remove(self, image_path: str):
+        """删除某张原图的全部派生图（原图被缓存淘汰时调用）"""
+        source_name = os.path.basename(image_path)
+        for width in self.widths:
+            for image_format in self.formats:
+                try:
+                    os.remove(os.path.join(self.output_dir, self.filename_for(source_name, width, image_format)))
+                except FileNotFoundError:
+                    pass
+
+    def sources(self, image_path: Optional[str], version: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        页面引用的派生图地址：src 为最大宽度的通用格式，
+        srcset 按格式给出 "url 320w, url 800w"，供 <picture> 使用；
+        version（原图内容哈希）会作为 ?v= 附在地址后
+        """
+        if not image_path:
+            return None
+        source_name = os.path.basename(image_path)
+        query = f"?v={version}" if version else ""
+
+        def url(width: int, image_format: str) -> str:
+            return f"{self.url_prefix}/{self.filename_for(source_name, width, image_format)}{query}"
+
+        return {
+            "src": url(self.widths[-1], self.fallback_format),
+            "srcset": {f: ", ".join(f"{url(w, f)} {w}w" for w in self.widths) for f in self.formats},
+            "width": self.widths[-1]
+        }
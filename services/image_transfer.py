@@ -0,0 +1,127 @@
+import asyncio
+import errno
+import logging
+import os
+import time
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+try:
+    import fcntl
+    FICLONE = 0x40049409  # Linux ioctl：在支持的文件系统（btrfs、XFS 等）上做写时复制克隆
+except ImportError:  # Windows
+    fcntl = None
+
+
+def _reflink(src: str, dst: str):
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "reflink is not supported on this platform")
+    with open(src, 'rb') as source, open(dst, 'xb') as target:
+        try:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        except OSError:
+            target.close()
+            os.remove(dst)
+            raise
+
+
+def link_file(src: str, dst: str) -> Optional[str]:
+    """
+    不复制数据地把 src 放到 dst：优先 reflink（写时复制，互不影响），
+    否则硬链接；都不支持（例如跨文件系统）时返回 None。
+    """
+    try:
+        _reflink(src, dst)
+        return "reflink"
+    except OSError:
+        pass
+    try:
+        os.link(src, dst)
+        return "hardlink"
+    except OSError:
+        return None
+
+
+class ImageTransfer:
+    """
+    把 ComfyUI 的输出图片搬到本地临时文件（调用方再原子地重命名到最终位置）。
+
+    默认通过 /view 分块流式下载，不在内存中缓存整张图片；
+    配置了 ComfyUI 输出目录（与本服务在同一文件系统）时直接 reflink / 硬链接，
+    失败时退回 HTTP。每次搬运都返回 transfer、transfer_bytes、transfer_seconds。
+    """
+
+    def __init__(self, comfyui_output_dir: Optional[str] = None, chunk_size: int = 256 * 1024,
+                 local_node: Optional[str] = None):
+        self.comfyui_output_dir = comfyui_output_dir
+        self.chunk_size = chunk_size
+        # 输出目录所属的 ComfyUI 节点；其他节点渲染的图片总是走 HTTP
+        self.local_node = local_node
+
+    @staticmethod
+    def view_params(image: Dict[str, Any]) -> Dict[str, str]:
+        return {"filename": image["filename"],
+                "subfolder": image.get("subfolder", ""),
+                "type": image.get("type", "output")}
+
+    def local_path(self, image: Dict[str, Any]) -> Optional[str]:
+        """co-located 模式下输出文件在本机上的路径"""
+        if not self.comfyui_output_dir or image.get("type", "output") != "output":
+            return None
+        if self.local_node and image.get("node", self.local_node) != self.local_node:
+            return None
+        path = os.path.join(self.comfyui_output_dir, image.get("subfolder", ""), image["filename"])
+        # 防止 subfolder / filename 跳出输出目录
+        root = os.path.realpath(self.comfyui_output_dir)
+        if os.path.commonpath([root, os.path.realpath(path)]) != root:
+            return None
+        return path if os.path.isfile(path) else None
+
+    def _link(self, image: Dict[str, Any], tmp_path: str) -> Optional[Dict[str, Any]]:
+        source = self.local_path(image)
+        if source is None:
+            return None
+        started = time.monotonic()
+        method = link_file(source, tmp_path)
+        if method is None:
+            logger.warning(f"Cannot link {source} into the image directory, falling back to HTTP")
+            return None
+        return {"transfer": method, "transfer_bytes": 0,
+                "transfer_seconds": round(time.monotonic() - started, 4)}
+
+    def fetch(self, client, image: Dict[str, Any], tmp_path: str) -> Dict[str, Any]:
+        """把图片写入 tmp_path（BackendClient，阻塞）"""
+        stats = self._link(image, tmp_path)
+        if stats:
+            return stats
+        started = time.monotonic()
+        transferred = 0
+        with client.get("/view", params=self.view_params(image), stream=True) as response:
+            response.raise_for_status()
+            with open(tmp_path, 'xb') as f:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+                    transferred += len(chunk)
+        return {"transfer": "http", "transfer_bytes": transferred,
+                "transfer_seconds": round(time.monotonic() - started, 4)}
+
+    async def fetch_async(self, client, image: Dict[str, Any], tmp_path: str) -> Dict[str, Any]:
+        """fetch() 的 asyncio 版本（AsyncBackendClient）"""
+        stats = await asyncio.to_thread(self._link, image, tmp_path)
+        if stats:
+            return stats
+        started = time.monotonic()
+        transferred = 0
+        async with client.get("/view", params=self.view_params(image)) as response:
+            response.raise_for_status()
+            # 文件读写放到线程池，避免大图阻塞引擎的事件循环
+            f = await asyncio.to_thread(open, tmp_path, 'xb')
+            try:
+                async for chunk in response.content.iter_chunked(self.chunk_size):
+                    await asyncio.to_thread(f.write, chunk)
+                    transferred += len(chunk)
+            finally:
+                await asyncio.to_thread(f.close)
+        return {"transfer": "http", "transfer_bytes": transferred,
+                "transfer_seconds": round(time.monotonic() - started, 4)}
@@ -0,0 +1,92 @@
+import json
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from services.job_store import FINISHED_STATUSES, JobStore
+
+logger = logging.getLogger(__name__)
+
+
+class JobRunner:
+    """
+    在后台执行生成任务，事件写入 JobStore。
+
+    任务的生命周期与发起请求的连接无关：浏览器刷新或断线后，
+    客户端通过任务 id 重新订阅事件即可，不会重新生成。
+    有 asyncio 引擎时在引擎的事件循环中运行，否则在线程池中运行同步流水线。
+    """
+
+    def __init__(self,
+                 store: JobStore,
+                 engine=None,
+                 pipeline: Optional[Callable[..., Iterator[str]]] = None,
+                 max_workers: int = 4):
+        self.store = store
+        self.engine = engine
+        self.pipeline = pipeline
+        self._executor = None if engine is not None else ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="job")
+        self._futures: Dict[str, Future] = {}
+        self._cancelled: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, request: Dict[str, Any], user_input: str,
+               character_data: Optional[dict] = None,
+               use_cache: bool = True, stream: bool = False,
+               preset: Optional[str] = None, quality: Optional[str] = None) -> str:
+        """创建任务并立即开始执行，返回任务 id"""
+        job_id = self.store.create_job(request)
+
+        def emit(event: Dict[str, Any]):
+            self.store.append_event(job_id, event)
+
+        with self._lock:
+            if self.engine is not None:
+                future = self.engine.submit(emit, user_input, character_data, use_cache, stream, preset, quality)
+            else:
+                cancelled = self._cancelled[job_id] = threading.Event()
+                future = self._executor.submit(self._run_pipeline, emit, cancelled,
+                                               user_input, character_data, use_cache, stream, preset, quality)
+            self._futures[job_id] = future
+        future.add_done_callback(lambda f: self._finish(job_id, f))
+        return job_id
+
+    def _run_pipeline(self, emit, cancelled: threading.Event, *args):
+        lines = self.pipeline(*args)
+        try:
+            for line in lines:
+                emit(json.loads(line))
+                if cancelled.is_set():
+                    return
+        finally:
+            # 关闭生成器会触发其 finally，取消尚未开始的场景
+            lines.close()
+
+    def _finish(self, job_id: str, future: Future):
+        with self._lock:
+            self._futures.pop(job_id, None)
+            cancelled = self._cancelled.pop(job_id, None)
+        job = self.store.get_job(job_id)
+        if job is None or job["status"] in FINISHED_STATUSES:
+            return
+        if future.cancelled() or (cancelled is not None and cancelled.is_set()):
+            self.store.append_event(job_id, {"error": "Job cancelled"})
+        elif future.exception() is not None:
+            logger.error(f"Job {job_id} failed: {str(future.exception())}")
+            self.store.append_event(job_id, {"error": str(future.exception())})
+        else:
+            self.store.append_event(job_id, {"error": "Job ended without a result"})
+
+    def cancel(self, job_id: str) -> bool:
+        """取消仍在运行的任务"""
+        with self._lock:
+            future = self._futures.get(job_id)
+            cancelled = self._cancelled.get(job_id)
+        if future is None:
+            return False
+        if cancelled is not None:
+            cancelled.set()
+        future.cancel()
+        return True
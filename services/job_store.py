@@ -0,0 +1,135 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 出现这些事件后任务结束
+FINISHED_STATUSES = ("completed", "failed")
+
+
+def is_final_event(event: Dict[str, Any]) -> bool:
+    return "error" in event or event.get("status") == "completed"
+
+
+class JobStore:
+    """
+    生成任务与事件的持久化存储（SQLite WAL）。
+
+    每个事件按任务内递增的 seq 保存，客户端断线后可以用 events_after()
+    补回错过的事件，再通过 wait_for_events() 继续等待新事件。
+    """
+
+    def __init__(self, db_path: str, ttl: float = 7 * 24 * 3600):
+        self.db_path = db_path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                request TEXT NOT NULL,
+                last_seq INTEGER NOT NULL DEFAULT 0,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS job_events (
+                job_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                event TEXT NOT NULL,
+                PRIMARY KEY (job_id, seq)
+            )
+        """)
+        self._conn.commit()
+
+    def create_job(self, request: Dict[str, Any]) -> str:
+        """登记新任务，返回任务 id"""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            self._conn.execute(
+                "INSERT INTO jobs (id, status, request, created, updated) VALUES (?, 'queued', ?, ?, ?)",
+                (job_id, json.dumps(request, ensure_ascii=False), now, now))
+            self._conn.commit()
+        return job_id
+
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, status, request, last_seq, created, updated FROM jobs WHERE id = ?",
+                (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {"id": row[0], "status": row[1], "request": json.loads(row[2]),
+                "last_seq": row[3], "created": row[4], "updated": row[5]}
+
+    def append_event(self, job_id: str, event: Dict[str, Any]) -> int:
+        """追加一个事件并唤醒等待者，返回事件序号"""
+        with self._lock:
+            seq = self._conn.execute(
+                "SELECT last_seq FROM jobs WHERE id = ?", (job_id,)).fetchone()[0] + 1
+            if "error" in event:
+                status = "failed"
+            elif event.get("status") == "completed":
+                status = "completed"
+            else:
+                status = "running"
+            self._conn.execute(
+                "INSERT INTO job_events (job_id, seq, event) VALUES (?, ?, ?)",
+                (job_id, seq, json.dumps(event, ensure_ascii=False)))
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, last_seq = ?, updated = ? WHERE id = ?",
+                (status, seq, time.time(), job_id))
+            self._conn.commit()
+            self._changed.notify_all()
+        return seq
+
+    def events_after(self, job_id: str, after: int = 0) -> List[Tuple[int, Dict[str, Any]]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT seq, event FROM job_events WHERE job_id = ? AND seq > ? ORDER BY seq",
+                (job_id, after)).fetchall()
+        return [(seq, json.loads(event)) for seq, event in rows]
+
+    def wait_for_events(self, job_id: str, after: int, timeout: float) -> bool:
+        """等待序号大于 after 的事件出现或任务结束；超时返回 False"""
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                row = self._conn.execute(
+                    "SELECT status, last_seq FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                if row is None or row[1] > after or row[0] in FINISHED_STATUSES:
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._changed.wait(remaining)
+
+    def fail_unfinished(self, reason: str) -> int:
+        """把上次进程退出时仍未结束的任务标记为失败，返回受影响的任务数"""
+        with self._lock:
+            job_ids = [row[0] for row in self._conn.execute(
+                "SELECT id FROM jobs WHERE status NOT IN (?, ?)", FINISHED_STATUSES)]
+        for job_id in job_ids:
+            self.append_event(job_id, {"error": reason})
+        return len(job_ids)
+
+    def _prune(self, now: float):
+        """删除过期任务及其事件"""
+        expired = [row[0] for row in self._conn.execute(
+            "SELECT id FROM jobs WHERE updated < ?", (now - self.ttl,))]
+        for job_id in expired:
+            self._conn.execute("DELETE FROM job_events WHERE job_id = ?", (job_id,))
+            self._conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
@@ -0,0 +1,358 @@
+import asyncio
+import collections
+import itertools
+import logging
+import math
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import requests
+
+from config import CONFIG
+from services.http_client import get_backend
+from services.metrics import LLM_ENDPOINT_REQUESTS, LLM_FIRST_TOKEN_SECONDS, LLM_HEDGES
+from services.resilience import Resilience, pool_unavailable_event
+
+logger = logging.getLogger(__name__)
+
+EndpointSpec = Union[str, Dict[str, Any]]
+
+
+class LLMEndpoint:
+    """池中的一个 OpenAI 兼容端点：共享 HTTP 客户端、并发上限与当前在途请求数"""
+
+    def __init__(self, api_url: str, max_concurrency: int):
+        self.client = get_backend("lm_studio", api_url)
+        self.api_url = self.client.base_url
+        self.max_concurrency = max_concurrency
+        self.outstanding = 0
+
+    def available(self) -> bool:
+        return not self.client.resilience.breaker.is_open()
+
+    def status(self) -> Dict[str, Any]:
+        return {"api_url": self.api_url, "available": self.available() and not self.client.down,
+                "outstanding": self.outstanding, "max_concurrency": self.max_concurrency}
+
+
+class LatencyWindow:
+    """最近 size 个首 token 延迟样本，用于估计对冲阈值（分位数）"""
+
+    def __init__(self, size: int = 200):
+        self._samples: Deque[float] = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q: float, min_samples: int) -> Optional[float]:
+        """第 q 百分位（最近秩法）；样本少于 min_samples 时返回 None"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < max(min_samples, 1):
+            return None
+        return samples[max(0, math.ceil(q / 100 * len(samples)) - 1)]
+
+
+class StreamResponse:
+    """
+    已读到第一行的流式响应：iter_lines() 先产出缓存的第一行，再继续读取原响应；
+    关闭时归还端点的并发名额
+    """
+
+    def __init__(self, response: requests.Response, lines: Iterator[str], first: Optional[str],
+                 on_close: Callable[[], None]):
+        self.response = response
+        self.status_code = response.status_code
+        self._lines = lines
+        self._first = first
+        self._on_close = on_close
+
+    @property
+    def text(self) -> str:
+        return self.response.text
+
+    def iter_lines(self, **kwargs) -> Iterator[str]:
+        if self._first is not None:
+            yield self._first
+        yield from self._lines
+
+    def close(self):
+        if self._on_close is not None:
+            on_close, self._on_close = self._on_close, None
+            self.response.close()
+            on_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class LLMPool:
+    """
+    一组 OpenAI 兼容的 LLM 端点（LM Studio 等），对外提供与 BackendClient 相同的
+    post() / is_healthy() / resilience / unavailable_event()，代理无需区分单个端点还是池。
+
+    - 每个请求路由到在途请求最少的端点；端点熔断器打开时跳过，全部打开时照常发送（快速失败）
+    - 每个端点有自己的并发上限，全部占满时调用方排队等待空闲名额
+    - 开启 hedge 时，首个 token（流式为第一行 SSE，非流式为完整响应）超过近期观测的
+      hedge_percentile 分位仍未到达，就向另一个有空闲名额的端点发出同样的请求，
+      采用先成功的一方并取消另一方。同步的 post() 只对冲流式请求：requests 无法中途取消
+      还在等待响应的非流式请求，落败的一方会一直占着端点（异步池见 AsyncLLMPool）
+    """
+
+    def __init__(self, endpoints: Iterable[EndpointSpec], max_concurrency: int = 8, hedge: bool = False,
+                 hedge_percentile: float = 95, hedge_min_samples: int = 20, latency_window: int = 200):
+        self.endpoints: List[LLMEndpoint] = []
+        for spec in endpoints:
+            url, cap = (spec, max_concurrency) if isinstance(spec, str) else \
+                (spec["api_url"], spec.get("max_concurrency", max_concurrency))
+            if all(e.api_url != url.rstrip('/') for e in self.endpoints):
+                self.endpoints.append(LLMEndpoint(url, cap))
+        if not self.endpoints:
+            raise ValueError("LLM pool needs at least one endpoint")
+        self.name = "lm_studio"
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.latency_window = latency_window
+        self._windows: Dict[Tuple[str, bool], LatencyWindow] = {}
+        self._cond = threading.Condition()
+        self._async_waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = []
+        self._rotation = itertools.count()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def primary(self) -> LLMEndpoint:
+        return self.endpoints[0]
+
+    # ---- 路由与并发名额 ----
+
+    def _pick(self, exclude: Iterable[str] = (), live_only: bool = False) -> Optional[LLMEndpoint]:
+        """在锁内调用：选出有空闲名额且在途请求最少的端点并占用一个名额"""
+        excluded = set(exclude)
+        candidates = [e for e in self.endpoints if e.api_url not in excluded]
+        live = [e for e in candidates if e.available()]
+        # 有未熔断的端点时只在其中选择（名额满了就等待），否则让请求快速失败
+        candidates = live if live or live_only else candidates
+        candidates = [e for e in candidates if e.outstanding < e.max_concurrency]
+        if not candidates:
+            return None
+        # 在途请求数相同时轮流选择，避免总是压在第一个端点上
+        offset = next(self._rotation)
+        order = {e.api_url: (i - offset) % len(self.endpoints) for i, e in enumerate(self.endpoints)}
+        endpoint = min(candidates, key=lambda e: (e.outstanding, order[e.api_url]))
+        endpoint.outstanding += 1
+        LLM_ENDPOINT_REQUESTS.inc(endpoint=endpoint.api_url)
+        return endpoint
+
+    def acquire(self) -> LLMEndpoint:
+        """占用一个端点的名额，全部占满时阻塞等待（用完后调用 release）"""
+        with self._cond:
+            while True:
+                endpoint = self._pick()
+                if endpoint is not None:
+                    return endpoint
+                self._cond.wait()
+
+    def try_acquire(self, exclude: Iterable[str] = ()) -> Optional[LLMEndpoint]:
+        """对冲用：不等待，只选未熔断的端点；没有空闲名额时返回 None"""
+        with self._cond:
+            return self._pick(exclude, live_only=True)
+
+    async def acquire_async(self) -> LLMEndpoint:
+        """acquire() 的 asyncio 版本，等待期间不占用线程"""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                endpoint = self._pick()
+                if endpoint is not None:
+                    return endpoint
+                waiter = (loop, asyncio.Event())
+                self._async_waiters.append(waiter)
+            try:
+                await waiter[1].wait()
+            finally:
+                with self._cond:
+                    if waiter in self._async_waiters:
+                        self._async_waiters.remove(waiter)
+
+    def release(self, endpoint: LLMEndpoint):
+        with self._cond:
+            endpoint.outstanding -= 1
+            self._cond.notify()
+            waiters = list(self._async_waiters)
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:  # 事件循环已关闭
+                pass
+
+    # ---- 首 token 延迟与对冲 ----
+
+    def observe_first_token(self, path: str, stream: bool, seconds: float):
+        window = self._windows.get((path, stream))
+        if window is None:
+            window = self._windows.setdefault((path, stream), LatencyWindow(self.latency_window))
+        window.observe(seconds)
+        LLM_FIRST_TOKEN_SECONDS.observe(seconds, mode="stream" if stream else "complete")
+
+    def hedge_delay(self, path: str, stream: bool) -> Optional[float]:
+        """发出对冲请求前的等待时间；未开启、只有一个端点或样本不足时返回 None"""
+        if not self.hedge or len(self.endpoints) < 2:
+            return None
+        window = self._windows.get((path, stream))
+        return window.percentile(self.hedge_percentile, self.hedge_min_samples) if window else None
+
+    # ---- 请求 ----
+
+    def _attempt(self, endpoint: LLMEndpoint, path: str, kwargs: Dict[str, Any],
+                 opened: Optional[List[requests.Response]] = None):
+        """
+        在指定端点上发送请求并等到首个 token（占用的名额在此归还或交给 StreamResponse）。
+        流式请求打开后把响应放进 opened，供对冲的另一方取消时关闭
+        """
+        stream = kwargs.get("stream", False)
+        started = time.monotonic()
+        try:
+            response = endpoint.client.post(path, **kwargs)
+        except BaseException:
+            self.release(endpoint)
+            raise
+        if not stream:
+            self.release(endpoint)
+            if response.status_code == 200:
+                self.observe_first_token(path, False, time.monotonic() - started)
+            return response
+        if opened is not None:
+            opened.append(response)
+        try:
+            lines = response.iter_lines(decode_unicode=True)
+            first = None
+            if response.status_code == 200:
+                first = next((line for line in lines if line), None)
+                self.observe_first_token(path, True, time.monotonic() - started)
+        except BaseException:
+            response.close()
+            self.release(endpoint)
+            raise
+        return StreamResponse(response, lines, first, lambda: self.release(endpoint))
+
+    def post(self, path: str, **kwargs) -> Union[requests.Response, StreamResponse]:
+        """
+        发送到在途请求最少的端点；stream=True 时返回已读到第一行的 StreamResponse
+        （用法同 requests 的流式响应，须关闭）。开启对冲且样本足够时按首 token 延迟对冲流式请求
+        """
+        delay = self.hedge_delay(path, True) if kwargs.get("stream", False) else None
+        endpoint = self.acquire()
+        if delay is None:
+            return self._attempt(endpoint, path, kwargs)
+        return self._hedged(endpoint, path, kwargs, delay)
+
+    def _hedged(self, endpoint: LLMEndpoint, path: str, kwargs: Dict[str, Any], delay: float):
+        if self._executor is None:
+            with self._cond:
+                if self._executor is None:
+                    workers = sum(e.max_concurrency for e in self.endpoints)
+                    self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="llm-hedge")
+        opened: Dict[Future, List[requests.Response]] = {}
+
+        def start(target: LLMEndpoint) -> Future:
+            holder: List[requests.Response] = []
+            future = self._executor.submit(self._attempt, target, path, kwargs, holder)
+            opened[future] = holder
+            return future
+
+        first = start(endpoint)
+        done, _ = wait([first], timeout=delay)
+        backup = None if done else self.try_acquire(exclude=[endpoint.api_url])
+        if backup is None:
+            return first.result()
+        logger.info(f"No first token from {endpoint.api_url} after {delay:.2f}s, hedging to {backup.api_url}")
+        second = start(backup)
+        winner = _first_success([first, second])
+        LLM_HEDGES.inc(winner="primary" if winner is first else "hedge")
+        for future in (first, second):
+            if future is not winner:
+                _cancel(future, opened[future])
+        return winner.result()
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        endpoint = self.acquire()
+        try:
+            return endpoint.client.get(path, **kwargs)
+        finally:
+            self.release(endpoint)
+
+    # ---- 健康状态 ----
+
+    @property
+    def resilience(self) -> Resilience:
+        """重试策略：第一个未熔断端点的策略（全部熔断时为第一个端点，重试会被拒绝）"""
+        live = [e for e in self.endpoints if e.available()]
+        return (live or self.endpoints)[0].client.resilience
+
+    def is_healthy(self) -> bool:
+        """任一端点健康即可（读取各端点后台探测的缓存结果）"""
+        healthy = [e.client.is_healthy() for e in self.endpoints]
+        return any(healthy)
+
+    def unavailable_event(self) -> Optional[Dict[str, Any]]:
+        """所有端点都不可用时的流式错误事件"""
+        return pool_unavailable_event(self.name, (e.client for e in self.endpoints), "endpoint")
+
+    def status(self) -> List[Dict[str, Any]]:
+        return [e.status() for e in self.endpoints]
+
+
+def _first_success(futures: List[Future]) -> Future:
+    """先返回 200 响应的一方；都失败时为先完成的一方（由调用方按原逻辑处理错误）"""
+    pending = set(futures)
+    finished: List[Future] = []
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in sorted(done, key=futures.index):
+            finished.append(future)
+            if future.exception() is None and future.result().status_code == 200:
+                return future
+    return next((f for f in finished if f.exception() is None), finished[0])
+
+
+def _cancel(future: Future, opened: List[requests.Response]):
+    """取消对冲中落败的一方：已打开的流式响应立即关闭（后端随之停止生成），尚未打开的在打开后关闭"""
+    for response in opened:
+        response.close()
+
+    def discard(done: Future):
+        if done.exception() is None and isinstance(done.result(), StreamResponse):
+            done.result().close()
+    future.add_done_callback(discard)
+
+
+def llm_endpoints() -> List[EndpointSpec]:
+    """配置中的 LLM 端点：CONFIG["lm_studio"]["api_urls"]，为空时只用 api_url"""
+    settings = CONFIG["lm_studio"]
+    return list(settings.get("api_urls") or [settings["api_url"]])
+
+
+_pool: Optional[LLMPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_llm_pool() -> LLMPool:
+    """进程内共享的 LLM 端点池（按 CONFIG["lm_studio"] 创建）"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            settings = CONFIG["lm_studio"]
+            _pool = LLMPool(llm_endpoints(),
+                            max_concurrency=settings.get("max_concurrency", 8),
+                            hedge=settings.get("hedge", False),
+                            hedge_percentile=settings.get("hedge_percentile", 95),
+                            hedge_min_samples=settings.get("hedge_min_samples", 20))
+    return _pool
@@ -0,0 +1,249 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# 秒级阶段耗时的默认分桶：覆盖从毫秒级的提示词拼装到数分钟的渲染
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    """
+    指标基类。记录时只在锁内更新一个字典项；文本格式只在 /metrics 被抓取时生成，
+    没有抓取时开销接近于零。
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in items]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 function: Optional[Callable[[], Optional[float]]] = None):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._function = function  # 抓取时才求值的无标签指标（例如读取 ComfyUI 队列长度）
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], Optional[float]]):
+        self._function = function
+
+    @contextmanager
+    def track_inprogress(self, **labels) -> Iterator[None]:
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def _samples(self) -> List[str]:
+        if self._function is not None:
+            value = self._function()
+            return [] if value is None else [f"{self.name} {_format_value(value)}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 标签值 -> [各分桶计数（非累积）..., +Inf 计数, 总和]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((key, list(counts)) for key, counts in self._values.items())
+        lines = []
+        for key, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts[:-1]):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Prometheus 文本格式（0.0.4）"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "storybook_stage_seconds",
+    "Duration of generation stages: character, story, prompt, image_queue_wait, image_render, download, book",
+    ["stage"]))
+STORIES_IN_FLIGHT = REGISTRY.register(Gauge(
+    "storybook_stories_in_flight", "Stories currently being generated"))
+LLM_RETRIES = REGISTRY.register(Counter(
+    "storybook_llm_retries_total", "LLM requests retried after a failed attempt"))
+LLM_JSON_PARSE_FAILURES = REGISTRY.register(Counter(
+    "storybook_llm_json_parse_failures_total", "LLM responses that failed strict JSON parsing", ["kind"]))
+LLM_JSON_OUTCOMES = REGISTRY.register(Counter(
+    "storybook_llm_json_outcomes_total",
+    "LLM JSON responses by outcome: clean, repaired (local repair), fixed (continue/fix call) or failed",
+    ["kind", "outcome"]))
+LLM_TOKENS = REGISTRY.register(Counter(
+    "storybook_llm_tokens_total", "Tokens reported in the usage field of LLM responses", ["type"]))
+LLM_TOKENS_PER_SECOND = REGISTRY.register(Histogram(
+    "storybook_llm_tokens_per_second", "Completion tokens per second of LLM requests",
+    buckets=(1, 5, 10, 20, 40, 80, 160, 320)))
+LLM_ENDPOINT_REQUESTS = REGISTRY.register(Counter(
+    "storybook_llm_endpoint_requests_total", "LLM requests routed to each endpoint, including hedges",
+    ["endpoint"]))
+LLM_FIRST_TOKEN_SECONDS = REGISTRY.register(Histogram(
+    "storybook_llm_first_token_seconds",
+    "Time to first token of LLM requests (stream: first SSE line, complete: whole response)", ["mode"]))
+LLM_HEDGES = REGISTRY.register(Counter(
+    "storybook_llm_hedges_total", "Hedged LLM requests by which copy answered first: primary or hedge",
+    ["winner"]))
+COMFYUI_TIMEOUTS = REGISTRY.register(Counter(
+    "storybook_comfyui_timeouts_total", "ComfyUI prompts that did not finish before the timeout"))
+COMFYUI_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "storybook_comfyui_queue_depth", "Prompts remaining in the ComfyUI queue(s), as last reported over /ws or /queue"))
+COMFYUI_PLANNED = REGISTRY.register(Gauge(
+    "storybook_comfyui_planned_jobs", "Renders waiting locally for a submission slot on a ComfyUI node"))
+COMFYUI_DISPATCHES = REGISTRY.register(Counter(
+    "storybook_comfyui_dispatches_total", "Prompts dispatched to each ComfyUI node, including requeues", ["node"]))
+COMFYUI_REQUEUES = REGISTRY.register(Counter(
+    "storybook_comfyui_requeues_total", "Prompts requeued on another node after their node failed"))
+COMFYUI_MODEL_SWITCHES = REGISTRY.register(Counter(
+    "storybook_comfyui_model_switches_total",
+    "Prompts dispatched to a ComfyUI node whose previous prompt used a different checkpoint or LoRA", ["node"]))
+COMFYUI_CACHED_NODES = REGISTRY.register(Counter(
+    "storybook_comfyui_cached_nodes_total", "Workflow nodes ComfyUI reused from its cache (execution_cached)"))
+BACKEND_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "storybook_backend_request_seconds", "Time until response headers for requests to LM Studio and ComfyUI",
+    ["backend"]))
+BACKEND_ERRORS = REGISTRY.register(Counter(
+    "storybook_backend_errors_total", "Requests to a backend that failed or returned a 5xx status", ["backend"]))
+BACKEND_CIRCUIT_STATE = REGISTRY.register(Gauge(
+    "storybook_backend_circuit_state",
+    "Circuit breaker state per backend endpoint (LLM endpoint or ComfyUI node): 0 closed, 1 half-open, 2 open",
+    ["backend", "endpoint"]))
+BACKEND_REJECTED = REGISTRY.register(Counter(
+    "storybook_backend_rejected_total", "Requests failed fast because the endpoint's circuit was open",
+    ["backend", "endpoint"]))
+BACKEND_RETRIES_DENIED = REGISTRY.register(Counter(
+    "storybook_backend_retries_denied_total", "Retries skipped because the endpoint's retry budget was exhausted",
+    ["backend", "endpoint"]))
+
+
+def record_llm_usage(result: Optional[dict], seconds: float):
+    """从 OpenAI 兼容响应（或最后一个流式片段）的 usage 字段记录 token 用量和速度"""
+    usage = (result or {}).get('usage') or {}
+    prompt_tokens = usage.get('prompt_tokens') or 0
+    completion_tokens = usage.get('completion_tokens') or 0
+    if prompt_tokens:
+        LLM_TOKENS.inc(prompt_tokens, type="prompt")
+    if completion_tokens:
+        LLM_TOKENS.inc(completion_tokens, type="completion")
+        if seconds > 0:
+            LLM_TOKENS_PER_SECOND.observe(completion_tokens / seconds)
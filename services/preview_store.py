@@ -0,0 +1,57 @@
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from config import CONFIG
+
+
+class PreviewStore:
+    """
+    渲染途中的预览图（只在内存中，最多 max_items 张，先进先出淘汰）。
+
+    逐步预览是 /ws 推送的 JPEG / PNG 字节，直接保存；首遍预览只记下它在 ComfyUI 上的位置
+    （PreviewImage 写的临时文件），浏览器请求时再从对应节点的 /view 读取。
+    事件中只带 /previews/<key> 地址，不把图片写进任务事件日志。
+    """
+
+    def __init__(self, max_items: int = 256):
+        self.max_items = max_items
+        self._items: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _put(self, item: Dict[str, Any]) -> str:
+        key = uuid.uuid4().hex
+        with self._lock:
+            self._items[key] = item
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return key
+
+    def put_bytes(self, data: bytes, content_type: str) -> str:
+        return self._put({"data": data, "content_type": content_type})
+
+    def put_remote(self, node: str, image: Dict[str, Any]) -> str:
+        """ComfyUI 节点 node 上的图片（/view 参数 filename、subfolder、type）"""
+        return self._put({"node": node, "image": image})
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._items.get(key)
+
+    @staticmethod
+    def url_for(key: str) -> str:
+        return f"/previews/{key}"
+
+
+_store: Optional[PreviewStore] = None
+_store_lock = threading.Lock()
+
+
+def get_preview_store() -> PreviewStore:
+    """进程内共享的预览存储"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = PreviewStore(CONFIG["comfyui"].get("preview_store_size", 256))
+    return _store
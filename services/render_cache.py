@@ -0,0 +1,163 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class RenderCache:
+    """
+    以工作流图哈希为键的渲染结果缓存。
+
+    默认工作流使用固定种子，同一张绑定好的图必然渲染出同一张图片，
+    因此图片直接以图哈希命名存放在 static/images 下（写入是原子的），
+    并按总大小做 LRU 淘汰。enabled=False 时仍使用哈希文件名，只是不查缓存。
+    """
+
+    INDEX_FILE = ".render_cache.json"
+
+    def __init__(self,
+                 cache_dir: str = "static/images",
+                 max_bytes: int = 2 * 1024 ** 3,
+                 enabled: bool = True,
+                 prefix: str = "scene_",
+                 on_evict: Optional[Callable[[str], None]] = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.prefix = prefix
+        self.on_evict = on_evict  # 淘汰图片时的回调（例如同时删除派生图）
+        self.index_path = os.path.join(cache_dir, self.INDEX_FILE)
+        self._name_re = re.compile(rf"^{re.escape(prefix)}([0-9a-f]{{32}})\.png$")
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._entries: Dict[str, Dict[str, Any]] = self._load_index()
+
+    @staticmethod
+    def key_for(graph: Dict[str, Any]) -> str:
+        """计算绑定后工作流图的哈希（与键顺序无关）"""
+        canonical = json.dumps(graph, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:32]
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{self.prefix}{key}.png")
+
+    def _load_index(self) -> Dict[str, Dict[str, Any]]:
+        """读取索引，并与目录中实际存在的文件对齐"""
+        entries = {}
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Error loading render cache index, rebuilding: {str(e)}")
+
+        on_disk = {}
+        for filename in os.listdir(self.cache_dir):
+            match = self._name_re.match(filename)
+            if not match:
+                continue
+            stat = os.stat(os.path.join(self.cache_dir, filename))
+            key = match.group(1)
+            entry = entries.get(key) or {"last_used": stat.st_mtime, "render_seconds": None}
+            entry["size"] = stat.st_size
+            on_disk[key] = entry
+        return on_disk
+
+    def _save_index(self):
+        self._atomic_write(self.index_path, json.dumps(self._entries).encode('utf-8'))
+
+    def _atomic_write(self, path: str, data: bytes):
+        """先写临时文件再重命名，读者永远看不到半截文件"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".tmp_")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """命中时返回 {"image_path", "render_seconds", "latent"} 并刷新 LRU 时间（latent 为草稿保存的潜在图，可能为 None）"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            path = self.path_for(key)
+            if entry is None or not os.path.exists(path):
+                self._entries.pop(key, None)
+                return None
+            entry["last_used"] = time.time()
+        return {"image_path": path, "render_seconds": entry.get("render_seconds"), "latent": entry.get("latent")}
+
+    def put(self, key: str, data: bytes, render_seconds: Optional[float] = None) -> str:
+        """原子地写入渲染结果，返回图片路径"""
+        path = self.path_for(key)
+        self._atomic_write(path, data)
+        self._register(key, len(data), render_seconds)
+        return path
+
+    def temp_path(self) -> str:
+        """缓存目录中的临时文件路径（与最终文件同一文件系统，可原子重命名）"""
+        return os.path.join(self.cache_dir, f".tmp_{uuid.uuid4().hex}")
+
+    def put_file(self, key: str, tmp_path: str, render_seconds: Optional[float] = None,
+                 latent: Optional[Dict[str, Any]] = None) -> str:
+        """把 temp_path() 中已写好的文件原子地重命名为缓存图片，返回图片路径；latent 随条目保存"""
+        path = self.path_for(key)
+        try:
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except Exception:
+            self.discard_temp(tmp_path)
+            raise
+        self._register(key, size, render_seconds, latent)
+        return path
+
+    @staticmethod
+    def discard_temp(tmp_path: str):
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+
+    def _register(self, key: str, size: int, render_seconds: Optional[float],
+                  latent: Optional[Dict[str, Any]] = None):
+        with self._lock:
+            self._entries[key] = {
+                "size": size,
+                "last_used": time.time(),
+                "render_seconds": render_seconds
+            }
+            if latent:
+                self._entries[key]["latent"] = latent
+            self._evict()
+            self._save_index()
+
+    def _evict(self):
+        """超出容量时按最近使用时间淘汰"""
+        total = sum(entry["size"] for entry in self._entries.values())
+        if total <= self.max_bytes:
+            return
+        for key, entry in sorted(self._entries.items(), key=lambda item: item[1]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(self.path_for(key))
+            except FileNotFoundError:
+                pass
+            total -= entry["size"]
+            del self._entries[key]
+            if self.on_evict:
+                self.on_evict(self.path_for(key))
+            logger.info(f"Evicted cached render {key}")
@@ -0,0 +1,287 @@
+import logging
+import math
+import random
+import threading
+import time
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from config import CONFIG
+from services.metrics import BACKEND_CIRCUIT_STATE, BACKEND_REJECTED, BACKEND_RETRIES_DENIED
+
+logger = logging.getLogger(__name__)
+
+# 面向用户的后端名称（出现在流式错误信息里）
+BACKEND_LABELS = {"lm_studio": "LM Studio", "comfyui": "ComfyUI"}
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+def backend_event(backend: str, message: str, retry_after: Optional[float] = None) -> Dict[str, Any]:
+    """
+    后端不可用时的流式错误事件（所有后端失败事件都由这里构造）。
+    给出 retry_after 时向上取整到秒，写进消息和 retry_after 字段
+    """
+    event = {"error": message, "backend": backend}
+    if retry_after is not None:
+        seconds = math.ceil(max(0.0, retry_after))
+        event.update(error=f"{message}; retrying in {seconds} s", retry_after=seconds)
+    return event
+
+
+class BackendUnavailable(Exception):
+    """熔断器打开期间直接拒绝请求，不再等待连接或读取超时"""
+
+    def __init__(self, backend: str, retry_after: float, reason: str = ""):
+        self.backend = backend
+        self.retry_after = max(0.0, retry_after)
+        self.reason = reason
+        label = BACKEND_LABELS.get(backend, backend)
+        message = f"{label} is unavailable"
+        if reason:
+            message += f" ({reason})"
+        self._event = backend_event(backend, message, self.retry_after)
+        super().__init__(self._event["error"])
+
+    def event(self) -> Dict[str, Any]:
+        """流式接口中的错误事件"""
+        return dict(self._event)
+
+
+class Backoff:
+    """指数退避 + 完全抖动：第 n 次重试前等待 uniform(0, min(cap, base * 2^n)) 秒"""
+
+    def __init__(self, base: float = 1.0, cap: float = 15.0):
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+
+class RetryBudget:
+    """
+    令牌桶形式的重试预算：每个请求存入 ratio 个令牌，每次重试取走一个；
+    另按 per_second 随时间补充，保证低流量时也能重试。
+    后端整体出故障时，重试量被限制在请求量的 ratio 倍以内，不会把负载放大数倍。
+    """
+
+    def __init__(self, ratio: float = 0.2, per_second: float = 0.1, burst: float = 10):
+        self.ratio = ratio
+        self.per_second = per_second
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.per_second)
+        self._updated = now
+
+    def deposit(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self.burst, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class CircuitBreaker:
+    """
+    连续失败 failure_threshold 次后打开，open_seconds 内的请求直接被拒绝；
+    之后进入半开状态，只放行一个试探请求（或由后台健康探测代替）：
+    成功则关闭，失败则重新打开。
+    """
+
+    def __init__(self, name: str, base_url: str, failure_threshold: int = 5, open_seconds: float = 15):
+        self.name = name
+        self.base_url = base_url
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.last_error = ""
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+        BACKEND_CIRCUIT_STATE.set(_STATE_VALUES[CLOSED], backend=name, endpoint=base_url)
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            level = logging.INFO if state == CLOSED else logging.WARNING
+            logger.log(level, f"Circuit for {self.name} ({self.base_url}) {self.state} -> {state}"
+                              + (f" ({self.last_error})" if state == OPEN and self.last_error else ""))
+            self.state = state
+            BACKEND_CIRCUIT_STATE.set(_STATE_VALUES[state], backend=self.name, endpoint=self.base_url)
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        self._trial_in_flight = False
+
+    def retry_after(self) -> float:
+        return max(0.0, self._opened_at + self.open_seconds - time.monotonic())
+
+    def is_open(self) -> bool:
+        """是否处于拒绝请求的状态（打开且未到试探时间，或试探请求尚未返回）"""
+        with self._lock:
+            if self.state == OPEN:
+                return self.retry_after() > 0 or self._trial_in_flight
+            return self.state == HALF_OPEN and self._trial_in_flight
+
+    def acquire(self) -> Tuple[bool, bool]:
+        """请求前调用，返回 (是否放行, 是否为试探请求)；半开状态下只有第一个调用方获得试探机会"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True, False
+            if self.state == OPEN and self.retry_after() > 0:
+                return False, False
+            if self._trial_in_flight:
+                return False, False
+            self._set_state(HALF_OPEN)
+            self._trial_in_flight = True
+            return True, True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            if self.state != CLOSED:
+                self._set_state(CLOSED)
+
+    def record_failure(self, error: str = ""):
+        with self._lock:
+            self.failures += 1
+            self.last_error = error or self.last_error
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self._set_state(OPEN)
+
+    def release(self):
+        """试探请求没有结果（例如被取消）时归还试探机会"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_probe(self, healthy: bool, error: str = ""):
+        """
+        后台健康探测的结果：打开期间到达试探时间后由探测决定关闭或继续打开，
+        用户请求不必充当试探；关闭状态下探测失败也计入连续失败
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                if not healthy:
+                    self.failures += 1
+                    self.last_error = error or self.last_error
+                    if self.failures >= self.failure_threshold:
+                        self._set_state(OPEN)
+                return
+            if self._trial_in_flight or (self.state == OPEN and self.retry_after() > 0):
+                return
+            if healthy:
+                self.failures = 0
+                self._set_state(CLOSED)
+            else:
+                self.last_error = error or self.last_error
+                self._set_state(OPEN)
+
+
+class Resilience:
+    """
+    单个后端的重试与熔断策略，同步和异步客户端共用同一个实例（见 get_resilience）。
+
+    客户端在每个请求前调用 before_request()，根据结果调用 record()
+    （试探请求没有结果时调用 breaker.release()）；
+    调用方在重试前用 retry_delay() 取得退避时间，预算耗尽或熔断器打开时不再重试。
+    """
+
+    def __init__(self, name: str, base_url: str, max_retries: int = 3, backoff_base: float = 1.0, backoff_cap: float = 15.0,
+                 budget_ratio: float = 0.2, budget_per_second: float = 0.1, budget_burst: float = 10,
+                 failure_threshold: int = 5, open_seconds: float = 15):
+        self.name = name
+        self.base_url = base_url
+        self.max_retries = max_retries
+        self.backoff = Backoff(backoff_base, backoff_cap)
+        self.budget = RetryBudget(budget_ratio, budget_per_second, budget_burst)
+        self.breaker = CircuitBreaker(name, base_url, failure_threshold, open_seconds)
+
+    def unavailable(self) -> BackendUnavailable:
+        breaker = self.breaker
+        reason = f"{breaker.failures} consecutive failures"
+        if breaker.last_error:
+            reason += f", last error: {breaker.last_error}"
+        return BackendUnavailable(self.name, breaker.retry_after(), reason)
+
+    def before_request(self) -> bool:
+        """熔断器拒绝时抛出 BackendUnavailable；返回本次请求是否为半开状态下的试探请求"""
+        allowed, trial = self.breaker.acquire()
+        if not allowed:
+            BACKEND_REJECTED.inc(backend=self.name, endpoint=self.base_url)
+            raise self.unavailable()
+        self.budget.deposit()
+        return trial
+
+    def record(self, ok: bool, error: str = ""):
+        if ok:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure(error)
+
+    def retry_delay(self, attempt: int) -> Optional[float]:
+        """第 attempt 次（从 0 开始）失败后的退避秒数；不应再重试时返回 None"""
+        if self.breaker.is_open():
+            return None
+        if not self.budget.withdraw():
+            BACKEND_RETRIES_DENIED.inc(backend=self.name, endpoint=self.base_url)
+            logger.warning(f"Retry budget for {self.name} ({self.base_url}) exhausted, not retrying")
+            return None
+        return self.backoff.delay(attempt)
+
+    def unavailable_event(self) -> Optional[Dict[str, Any]]:
+        """熔断器打开时返回明确的流式错误事件，否则返回 None"""
+        return self.unavailable().event() if self.breaker.is_open() else None
+
+
+def backend_unavailable_event(client) -> Optional[Dict[str, Any]]:
+    """
+    客户端（BackendClient / AsyncBackendClient）对应的后端不可用时的流式错误事件：
+    熔断器打开，或最近一次请求 / 健康探测表明后端不可达；否则返回 None
+    """
+    event = client.resilience.unavailable_event()
+    if event is None and client.down:
+        label = BACKEND_LABELS.get(client.name, client.name)
+        event = backend_event(client.name, f"{label} is not reachable at {client.base_url}")
+    return event
+
+
+def pool_unavailable_event(backend: str, clients: Iterable, member: str) -> Optional[Dict[str, Any]]:
+    """
+    一组客户端（端点池或节点池的成员）全部不可用时的流式错误事件，任一成员可用时返回 None。
+    只有一个成员时直接用它的事件；否则汇总为一条，retry_after 取最早恢复的成员。
+    member 为成员的称呼（"endpoint" / "node"）
+    """
+    events = [backend_unavailable_event(client) for client in clients]
+    if not events or any(event is None for event in events):
+        return None
+    if len(events) == 1:
+        return events[0]
+    waits = [event["retry_after"] for event in events if "retry_after" in event]
+    label = BACKEND_LABELS.get(backend, backend)
+    return backend_event(backend, f"No {label} {member} is available ({len(events)} {member}s down)",
+                         min(waits) if waits else None)
+
+
+_instances: Dict[Tuple[str, str], Resilience] = {}
+_instances_lock = threading.Lock()
+
+
+def get_resilience(name: str, base_url: str) -> Resilience:
+    """按 CONFIG[name]["resilience"] 获取进程内共享的策略实例（每个后端地址一个）"""
+    key = (name, base_url.rstrip('/'))
+    with _instances_lock:
+        instance = _instances.get(key)
+        if instance is None:
+            instance = Resilience(name, key[1], **CONFIG[name].get("resilience", {}))
+            _instances[key] = instance
+    return instance
@@ -1,29 +1,119 @@
 import requests
-import json
 import base64
 import os
-from typing import Dict, Any, Optional
+from typing import Callable, Dict, Any, List, Optional, Sequence, Union
 import logging
 from PIL import Image
 import io
 import time
+from config import CONFIG
+from services.comfyui_pool import ComfyUINode, NodeFailed, get_pool
+from services.comfyui_tracker import PromptState
+from services.metrics import COMFYUI_CACHED_NODES, COMFYUI_REQUEUES, COMFYUI_TIMEOUTS
+from services.resilience import BackendUnavailable
+from services.preview_store import get_preview_store
+from services.submission_planner import canonical_prompt, canonicalize_loaders
+from services.workflow_templates import add_preview_output, draft_workflow, find_output_node, get_registry
+
+def cached_nodes(state: Optional[PromptState]) -> List[str]:
+    """prompt 执行时 ComfyUI 从缓存复用的节点（来自 /ws 的 execution_cached 消息）"""
+    nodes = list(state.cached_nodes) if state is not None else []
+    if nodes:
+        COMFYUI_CACHED_NODES.inc(len(nodes))
+    return nodes
+
+
+PreviewCallback = Callable[[Dict[str, Any]], None]
+
+
+def preview_listener(node_url: str, on_preview: PreviewCallback) -> PreviewCallback:
+    """
+    把 tracker 收到的预览转成 scene_preview 事件内容（kind、preview_url，逐步预览还有 step/steps）
+    交给 on_preview。逐步预览每 preview_interval 秒最多转发一张，首遍预览总是转发
+    """
+    store = get_preview_store()
+    interval = CONFIG["comfyui"].get("preview_interval", 1.0)
+    last = [0.0]
+
+    def listener(preview: Dict[str, Any]):
+        if preview["kind"] == "step":
+            now = time.monotonic()
+            if now - last[0] < interval:
+                return
+            last[0] = now
+            key = store.put_bytes(preview["data"], preview["content_type"])
+            on_preview({"kind": "step", "preview_url": store.url_for(key),
+                        "step": preview["step"], "steps": preview["steps"]})
+        else:
+            key = store.put_remote(node_url, preview["image"])
+            on_preview({"kind": preview["kind"], "preview_url": store.url_for(key)})
+    return listener
+
 
 class SDService:
-    def __init__(self, api_url: str = "http://localhost:8188", workflow_path: str = "workflows/default_workflow.json"):
-        self.api_url = api_url
+    def __init__(self, api_url: Union[str, Sequence[str], None] = None, workflow_path: Optional[str] = None):
+        # ComfyUI 节点池：api_url 可以是一个地址或地址列表，为空时使用 CONFIG["comfyui"] 中的节点
+        self.pool = get_pool([api_url] if isinstance(api_url, str) else api_url)
+        # 第一个节点的共享客户端（单节点部署时即唯一的节点）
+        self.client = self.pool.primary.client
+        self.api_url = self.pool.primary.api_url
         self.logger = logging.getLogger(__name__)
+        # 编译后的工作流模板在进程内缓存；workflow_path 为空时使用默认预设
+        self.workflows = get_registry()
         self.workflow_path = workflow_path
-        self.workflow = self._load_workflow()
-        
-    def _load_workflow(self) -> Dict[str, Any]:
-        """加载ComfyUI工作流配置"""
-        try:
-            with open(self.workflow_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            self.logger.error(f"Error loading workflow: {str(e)}")
-            raise
+        if workflow_path:
+            self.template = self.workflows.template(workflow_path)
+        else:
+            self.template, _ = self.workflows.preset()
+        self.output_node = self.template.output_node  # SaveImage 节点
+        self.timeout = CONFIG["comfyui"].get("render_timeout", 250)  # 单张图片最长等待（秒）
+        self.poll_interval = 1  # websocket 不可用时的轮询间隔
+        self.history_check_interval = 10  # websocket 可用时的 history 兜底检查间隔
+        self.tracker = self.pool.primary.tracker
     
+    def build_workflow(self,
+                       prompt: str,
+                       negative_prompt: str = "",
+                       width: Optional[int] = None,
+                       height: Optional[int] = None,
+                       steps: Optional[int] = None,
+                       preset: Optional[str] = None,
+                       quality: Optional[str] = None,
+                       **params: Any) -> Dict[str, Any]:
+        """
+        生成绑定了本次参数的工作流图。
+        未给出的参数使用预设（preset，为空时用默认预设）或模板中的默认值。
+        提示词和模型加载节点经过规范化：同一故事中负面提示词编码和加载节点逐字节相同，
+        ComfyUI 可以直接复用上一张图的结果。
+        quality 为 "draft" 时只做首遍采样（步数不超过 CONFIG["workflows"]["draft"]["steps"]），
+        并保存首遍潜在图供之后升级
+        """
+        draft = quality == "draft"
+        if draft and steps is None:
+            steps = self._draft_steps(preset)
+        params.update(prompt=canonical_prompt(prompt), negative_prompt=canonical_prompt(negative_prompt, dedupe=True),
+                      width=width, height=height, steps=steps)
+        if self.workflow_path and preset is None:
+            # 显式指定了工作流文件时直接绑定该模板
+            graph = self.template.bind(**params)
+        else:
+            _, graph = self.workflows.bind(preset, **params)
+        if draft:
+            graph = draft_workflow(graph, CONFIG["workflows"]["draft"]["latent_prefix"])
+        return canonicalize_loaders(graph)
+
+    def _draft_steps(self, preset: Optional[str]) -> Optional[int]:
+        """草稿的首遍步数：预设（或模板）步数与草稿步数上限中较小的一个"""
+        limit = CONFIG["workflows"]["draft"].get("steps")
+        if self.workflow_path and preset is None:
+            template, params = self.template, {}
+        else:
+            template, params = self.workflows.preset(preset)
+        current = params.get("steps", template.defaults().get("steps"))
+        if limit is None or not isinstance(current, int):
+            return limit
+        return min(limit, current)
+
     def generate_image(self, 
                       prompt: str, 
                       negative_prompt: str = "",
@@ -31,22 +121,70 @@ class SDService:
                       height: int = 600,
                       steps: int = 12) -> Optional[str]:
         """生成图像"""
+        return self.render(self.build_workflow(prompt, negative_prompt, width, height, steps))
+
+    def render(self, graph: Dict[str, Any]) -> Optional[str]:
+        """提交已绑定的工作流图并等待结果，返回 ComfyUI 输出文件名"""
+        image = self.render_image(graph)
+        return image['filename'] if image else None
+
+    def render_image(self, graph: Dict[str, Any], on_preview: Optional[PreviewCallback] = None,
+                     node: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        提交已绑定的工作流图并等待结果，返回输出图片信息（filename、subfolder、type，
+        渲染它的节点地址 node；图中有 SaveLatent 时还有 latent）。
+        节点在提交或渲染途中宕机时换一个节点重新排队；给出 node 时只在该节点上渲染
+        （例如读取该节点上保存的潜在图），该节点失败即返回 None。
+        给出 on_preview 时在首遍采样后加一个预览输出，渲染途中的预览经 on_preview 推送
+        """
+        output_node = find_output_node(graph) or self.output_node
+        graph, preview_node = self.with_preview(graph, on_preview)
+        failed = self.pinned_exclusions(node)
+        while True:
+            node = self.pool.acquire(graph, exclude=failed)
+            if node is None:
+                self.logger.error(f"Generation failed on all {len(failed)} ComfyUI node(s)")
+                return None
+            try:
+                return self._render_on(node, graph, output_node, on_preview, preview_node)
+            except NodeFailed as e:
+                failed.append(node.api_url)
+                self.logger.warning(f"ComfyUI node {node.api_url} failed: {str(e)}")
+                if len(failed) < len(self.pool.nodes):
+                    COMFYUI_REQUEUES.inc()
+            finally:
+                self.pool.release(node)
+
+    def pinned_exclusions(self, node: Optional[str]) -> List[str]:
+        """只允许在 node 上渲染时需要排除的其他节点"""
+        if node is None:
+            return []
+        node = node.rstrip('/')
+        return [n.api_url for n in self.pool.nodes if n.api_url != node]
+
+    @staticmethod
+    def with_preview(graph: Dict[str, Any], on_preview: Optional[PreviewCallback]):
+        """需要预览时返回加了首遍预览输出的图和预览节点 id"""
+        if on_preview is None or not CONFIG["comfyui"].get("previews", True):
+            return graph, None
+        return add_preview_output(graph)
+
+    def client_for(self, image: Dict[str, Any]):
+        """渲染该图片的节点的客户端（下载输出用）"""
+        return self.pool.node(image.get("node")).client
+
+    def _render_on(self, node: ComfyUINode, graph: Dict[str, Any], output_node: str,
+                   on_preview: Optional[PreviewCallback] = None,
+                   preview_node: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """在指定节点上渲染；节点不可用时抛出 NodeFailed，其他失败返回 None"""
         try:
-            # 复制工作流配置
-            workflow = {"prompt": self.workflow.copy()}
-            
-            # 更新工作流参数
-            workflow["prompt"]["5"]["inputs"]["width"] = 504  # 初始潜在空间尺寸
-            workflow["prompt"]["5"]["inputs"]["height"] = 304
-            workflow["prompt"]["10"]["inputs"]["width"] = width  # 上采样后的尺寸
-            workflow["prompt"]["10"]["inputs"]["height"] = height
-            workflow["prompt"]["3"]["inputs"]["steps"] = steps
-            workflow["prompt"]["6"]["inputs"]["text"] = prompt
-            workflow["prompt"]["7"]["inputs"]["text"] = negative_prompt
-            
-            # 发送请求到ComfyUI
-            self.logger.info("Sending request to ComfyUI...")
-            response = requests.post(f"{self.api_url}/prompt", json=workflow)
+            # 发送请求到ComfyUI，client_id 用于接收该 prompt 的 websocket 消息
+            workflow = {"prompt": graph, "client_id": node.tracker.client_id}
+            self.logger.info(f"Sending request to ComfyUI ({node.api_url})...")
+            try:
+                response = self._submit(node, workflow)
+            except (requests.exceptions.ConnectionError, BackendUnavailable) as e:
+                raise NodeFailed(str(e)) from e
             if response.status_code != 200:
                 self.logger.error(f"Error queuing prompt: {response.text}")
                 return None
@@ -54,37 +192,117 @@ class SDService:
             # 获取生成结果
             prompt_id = response.json()['prompt_id']
             self.logger.info(f"Generation started with prompt_id: {prompt_id}")
+            if on_preview is not None:
+                node.tracker.listen(prompt_id, preview_listener(node.api_url, on_preview), preview_node)
             
-            # 等待生成完成
-            max_retries = 250  # 最多等待250秒
-            retry_count = 0
-            while retry_count < max_retries:
-                try:
-                    history = requests.get(f"{self.api_url}/history/{prompt_id}")
-                    if history.status_code == 200:
-                        history_data = history.json()
-                        if prompt_id in history_data:
-                            outputs = history_data[prompt_id]['outputs']
-                            if outputs:
-                                # 获取生成的图像
-                                image_data = outputs['12']['images'][0]
-                                return image_data['filename']
-                    elif history.status_code == 404:
-                        self.logger.info(f"Generation in progress... ({retry_count + 1}/{max_retries})")
-                    else:
-                        self.logger.error(f"Error checking history: {history.status_code} - {history.text}")
-                except Exception as e:
-                    self.logger.error(f"Error while checking history: {str(e)}")
-                
-                time.sleep(1)  # 等待1秒
-                retry_count += 1
-            
-            self.logger.error("Generation timed out")
-            return None
+            latent_node = find_output_node(graph, "SaveLatent")
+            state = None
+            try:
+                outputs = self._wait_for_outputs(node, prompt_id, output_node)
+                if outputs and latent_node and latent_node not in outputs:
+                    # SaveLatent 可能在 SaveImage 之后才执行
+                    outputs = dict(outputs, **(self._wait_for_outputs(node, prompt_id, latent_node) or {}))
+            finally:
+                state = node.tracker.discard(prompt_id)
+            if not outputs or output_node not in outputs:
+                return None
+
+            # 获取生成的图像；cached_nodes 为 ComfyUI 从缓存复用、没有重新执行的节点
+            image_data = dict(outputs[output_node]['images'][0], node=node.api_url,
+                              cached_nodes=cached_nodes(state))
+            latents = (outputs.get(latent_node) or {}).get('latents') if latent_node else None
+            if latents:
+                image_data['latent'] = dict(latents[0], node=node.api_url)
+            self._delete_history(node, prompt_id)
+            return image_data
             
+        except NodeFailed:
+            raise
+        except BackendUnavailable as e:
+            raise NodeFailed(str(e)) from e
         except Exception as e:
             self.logger.error(f"Error generating image: {str(e)}")
             return None
+
+    def _submit(self, node: ComfyUINode, workflow: Dict[str, Any]) -> requests.Response:
+        """提交 /prompt；连接失败时按共享策略退避重试（至多多渲染一张，不会丢失场景）"""
+        resilience = node.client.resilience
+        attempt = 0
+        while True:
+            try:
+                return node.client.post("/prompt", json=workflow)
+            except requests.exceptions.ConnectionError as e:
+                delay = resilience.retry_delay(attempt) if attempt < resilience.max_retries - 1 else None
+                if delay is None:
+                    raise
+                self.logger.warning(f"Error queuing prompt, retrying in {delay:.1f}s: {str(e)}")
+                time.sleep(delay)
+                attempt += 1
+
+    def _wait_for_outputs(self, node: ComfyUINode, prompt_id: str, output_node: str) -> Optional[Dict[str, Any]]:
+        """
+        等待生成完成。
+
+        websocket 已连接时由 tracker 在输出节点完成后立即唤醒，
+        只每隔 history_check_interval 秒查一次 /history 兜底；
+        websocket 不可用时退回每秒轮询 /history。
+        节点的熔断器打开，或 websocket 断开且状态读取失败（节点已宕机）时
+        立即抛出 NodeFailed，不等到超时。
+        """
+        tracker = node.tracker
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            if node.client.resilience.breaker.is_open():
+                raise NodeFailed(f"gave up on prompt {prompt_id}: {node.client.resilience.unavailable()}")
+            if node.healthy is False and not tracker.connected():
+                raise NodeFailed(f"gave up on prompt {prompt_id}: node is not reachable")
+            remaining = deadline - time.monotonic()
+            if tracker.connected():
+                state = tracker.wait(prompt_id, output_node,
+                                     timeout=min(self.history_check_interval, remaining))
+                if state is not None:
+                    if state.error:
+                        self.logger.error(f"Generation failed: {state.error}")
+                        return None
+                    if output_node in state.outputs:
+                        return state.outputs
+                    # prompt 已结束但未收到输出（例如输出被缓存），从 history 读取
+                    outputs = self._get_history_outputs(node, prompt_id)
+                    if not outputs:
+                        self.logger.error(f"Generation finished without output for prompt_id: {prompt_id}")
+                    return outputs
+            else:
+                time.sleep(min(self.poll_interval, remaining))
+
+            outputs = self._get_history_outputs(node, prompt_id)
+            if outputs:
+                return outputs
+
+        COMFYUI_TIMEOUTS.inc()
+        self.logger.error("Generation timed out")
+        return None
+
+    def _get_history_outputs(self, node: ComfyUINode, prompt_id: str) -> Optional[Dict[str, Any]]:
+        """查询 /history，完成时返回 outputs"""
+        try:
+            history = node.client.get(f"/history/{prompt_id}")
+            if history.status_code == 200:
+                history_data = history.json()
+                if prompt_id in history_data:
+                    return history_data[prompt_id].get('outputs') or None
+                self.logger.debug(f"Generation in progress... ({prompt_id})")
+            else:
+                self.logger.error(f"Error checking history: {history.status_code} - {history.text}")
+        except Exception as e:
+            self.logger.error(f"Error while checking history: {str(e)}")
+        return None
+
+    def _delete_history(self, node: ComfyUINode, prompt_id: str):
+        """删除已读取的 history 记录，避免 ComfyUI 历史无限增长"""
+        try:
+            node.client.post("/history", json={"delete": [prompt_id]})
+        except Exception as e:
+            self.logger.warning(f"Error deleting history for {prompt_id}: {str(e)}")
             
     def generate_character_image(self, 
                                character_description: Dict[str, Any],
@@ -0,0 +1,123 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from flask import Response, abort, current_app, request
+from werkzeug.security import safe_join
+from werkzeug.utils import send_file
+
+
+class StaticFiles:
+    """
+    static/images 的缓存友好服务。
+
+    - 页面引用的地址带内容哈希版本号（?v=<哈希>），版本号与当前文件一致时返回
+      Cache-Control: public, max-age=..., immutable，浏览器重复访问时不再发请求；
+      没有或不匹配版本号时返回 no-cache，由浏览器带 If-None-Match 重新验证。
+    - ETag 为文件内容的 SHA-256（强校验器），命中时返回 304；支持 Range 请求。
+    - offload 为 "x-sendfile"（Apache / lighttpd）或 "x-accel-redirect"（nginx）时
+      只返回响应头，由反向代理发送文件内容（Range 也由代理处理）。
+    """
+
+    def __init__(self,
+                 directory: str = "static/images",
+                 url_prefix: str = "/static/images",
+                 max_age: int = 365 * 24 * 3600,
+                 offload: Optional[str] = None,
+                 accel_prefix: str = "/_images/",
+                 digest_entries: int = 4096):
+        if offload not in (None, "x-sendfile", "x-accel-redirect"):
+            raise ValueError(f"Unknown offload mode: {offload}")
+        self.directory = directory
+        self.url_prefix = url_prefix.rstrip('/')
+        self.max_age = max_age
+        self.offload = offload
+        self.accel_prefix = accel_prefix.rstrip('/') + '/'
+        self.digest_entries = digest_entries
+        # (path, mtime_ns, size) -> 内容哈希，文件被替换后自动失效
+        self._digests: "OrderedDict[Tuple[str, int, int], str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def version(self, path: str) -> Optional[str]:
+        """文件内容哈希（前 16 位十六进制）；文件不存在时返回 None"""
+        digest = self._digest(path)
+        return digest[:16] if digest else None
+
+    def _digest(self, path: str) -> Optional[str]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            digest = self._digests.get(key)
+            if digest:
+                self._digests.move_to_end(key)
+                return digest
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(block)
+        digest = sha.hexdigest()
+
+        with self._lock:
+            self._digests[key] = digest
+            while len(self._digests) > self.digest_entries:
+                self._digests.popitem(last=False)
+        return digest
+
+    def url(self, path: str, version: Optional[str] = None) -> str:
+        """带版本号的图片地址；version 省略时按文件内容计算"""
+        relative = os.path.relpath(path, self.directory).replace(os.sep, '/')
+        version = version or self.version(path)
+        url = f"{self.url_prefix}/{relative}"
+        return f"{url}?v={version}" if version else url
+
+    def resolve(self, filename: str) -> Optional[str]:
+        """把请求中的文件名映射到目录内的文件；越界、隐藏文件或不存在时返回 None"""
+        if any(part.startswith('.') for part in filename.split('/')):
+            return None
+        path = safe_join(self.directory, filename)
+        return path if path and os.path.isfile(path) else None
+
+    def send(self, path: str, version_path: Optional[str] = None) -> Response:
+        """
+        发送 path 指向的文件（调用方已校验路径）。
+        请求的 v 参数与 version_path（默认为文件本身）的内容哈希一致时允许长期缓存；
+        派生图以原图的哈希作为版本号。
+        """
+        etag = self._digest(path)
+        if etag is None:
+            abort(404)
+        requested = request.args.get('v')
+        immutable = bool(requested) and requested == self.version(version_path or path)
+
+        response = send_file(
+            os.path.abspath(path),
+            request.environ,
+            max_age=self.max_age if immutable else None,
+            etag=etag,
+            conditional=self.offload is None,
+            use_x_sendfile=self.offload is not None,
+            response_class=current_app.response_class
+        )
+        if immutable:
+            response.cache_control.immutable = True
+        if self.offload is not None:
+            response = self._offload(response, path)
+        return response
+
+    def _offload(self, response: Response, path: str) -> Response:
+        if self.offload == "x-accel-redirect":
+            relative = os.path.relpath(path, self.directory).replace(os.sep, '/')
+            del response.headers["X-Sendfile"]
+            response.headers["X-Accel-Redirect"] = self.accel_prefix + relative
+        # 304 仍由本服务判断；Range 交给代理，它看到的是完整文件
+        response = response.make_conditional(request.environ, accept_ranges=False)
+        if response.status_code == 304:
+            response.headers.pop("X-Sendfile", None)
+            response.headers.pop("X-Accel-Redirect", None)
+        return response
@@ -0,0 +1,83 @@
+import dataclasses
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+from models.character import Character
+from models.story import Scene, Story
+
+
+def story_record(character: Character, story: Story, scene_images: List[Optional[str]],
+                 latents: List[Optional[Dict[str, Any]]], book_path: str,
+                 preset: Optional[str], quality: str) -> Dict[str, Any]:
+    """保存到 StoryStore 的故事记录：角色、故事、预设、质量档位，以及每个场景的图片和草稿潜在图"""
+    return {
+        "character": dataclasses.asdict(character),
+        "story": dataclasses.asdict(story),
+        "preset": preset,
+        "quality": quality,
+        "scenes": [{"image_path": image_path, "latent": latent}
+                   for image_path, latent in zip(scene_images, latents)],
+        "book_path": book_path
+    }
+
+
+def load_story(record: Dict[str, Any]) -> Tuple[Character, Story]:
+    """从故事记录还原 Character 与 Story"""
+    character = Character(**record["character"])
+    data = dict(record["story"])
+    data["character"] = character
+    data["scenes"] = [Scene(**scene) for scene in data["scenes"]]
+    return character, Story(**data)
+
+
+class StoryStore:
+    """
+    已生成故事的持久化记录（SQLite WAL），按故事 id 读取。
+    /generate 完成时写入，POST /stories/<id>/upgrade 据此把草稿升级为最终质量。
+    """
+
+    def __init__(self, db_path: str, ttl: float = 30 * 24 * 3600):
+        self.db_path = db_path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS stories (
+                id TEXT PRIMARY KEY,
+                record TEXT NOT NULL,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            )
+        """)
+        self._conn.commit()
+
+    def save(self, record: Dict[str, Any]) -> str:
+        """保存新故事，返回故事 id"""
+        story_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._conn.execute("DELETE FROM stories WHERE updated < ?", (now - self.ttl,))
+            self._conn.execute(
+                "INSERT INTO stories (id, record, created, updated) VALUES (?, ?, ?, ?)",
+                (story_id, json.dumps(record, ensure_ascii=False), now, now))
+            self._conn.commit()
+        return story_id
+
+    def get(self, story_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT record FROM stories WHERE id = ?", (story_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update(self, story_id: str, record: Dict[str, Any]):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE stories SET record = ?, updated = ? WHERE id = ?",
+                (json.dumps(record, ensure_ascii=False), time.time(), story_id))
+            self._conn.commit()
@@ -0,0 +1,104 @@
+import asyncio
+import threading
+import time
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, Optional, Sequence, Tuple
+
+from services.workflow_templates import MODEL_INPUTS
+
+
+def canonical_prompt(text: str, dedupe: bool = False) -> str:
+    """
+    规范化提示词文本：逗号分隔、每项内部空白压缩为单个空格、去掉空项；
+    dedupe 时去掉重复项（保留首次出现的位置）。
+    ComfyUI 只在输入变化时重新执行节点，格式上的差异也会让编码节点失去缓存
+    """
+    terms = [" ".join(term.split()) for term in text.split(",")]
+    terms = [term for term in terms if term]
+    if dedupe:
+        terms = list(dict.fromkeys(terms))
+    return ", ".join(terms)
+
+
+def canonicalize_loaders(graph: Dict[str, Any]) -> Dict[str, Any]:
+    """模型加载节点中的数值输入统一为 float（1 与 1.0 序列化后不同），使同一组模型的加载节点逐字节相同"""
+    for node in graph.values():
+        inputs = node.get("inputs") or {}
+        if not any(name in inputs for name in MODEL_INPUTS):
+            continue
+        for name, value in inputs.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                inputs[name] = float(value)
+    return graph
+
+
+class PlannedJob:
+    """本地排队等待派发的一个渲染任务"""
+
+    def __init__(self, models: FrozenSet[str], exclude: Iterable[str],
+                 loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.models = models
+        self.exclude = set(exclude)
+        self.enqueued = time.monotonic()
+        self.node = None  # 派发后为选中的 ComfyUINode
+        self.event = threading.Event()
+        self.loop = loop
+        self.async_event = asyncio.Event() if loop is not None else None
+
+    def wake(self):
+        self.event.set()
+        if self.loop is not None:
+            try:
+                self.loop.call_soon_threadsafe(self.async_event.set)
+            except RuntimeError:  # 事件循环已关闭
+                pass
+
+
+class SubmissionPlanner:
+    """
+    ComfyUI 提交计划：每个节点最多 window 个已提交（运行中或在 ComfyUI 队列中）的 prompt，
+    其余任务在本地排队，节点空出时再决定下一个提交谁：
+
+    - 优先派发与节点当前 checkpoint / LoRA 相同的任务（同组任务连续执行，避免来回切换模型，
+      加载节点的输出也能被 ComfyUI 缓存复用）
+    - 没有同组任务时按先来先到，派发到得分（队列长度 + 模型切换代价）最低的节点
+    - 最早的任务等待超过 max_group_wait 秒后不再为同组任务让路
+    window 为 0 时不在本地排队，任务立即派发。
+    """
+
+    def __init__(self, window: int = 2, max_group_wait: float = 30):
+        self.window = window
+        self.max_group_wait = max_group_wait
+        self.pending: List[PlannedJob] = []
+
+    def _free(self, node) -> bool:
+        return self.window <= 0 or node.in_flight < self.window
+
+    @staticmethod
+    def _targets(job: PlannedJob, nodes: Sequence) -> List:
+        """任务可以使用的节点：排除已失败的节点，有可用节点时只用可用节点"""
+        allowed = [node for node in nodes if node.api_url not in job.exclude]
+        return [node for node in allowed if node.available()] or allowed
+
+    def next(self, nodes: Sequence, score: Callable[[Any, FrozenSet[str]], Tuple]) -> Optional[Tuple[PlannedJob, Any]]:
+        """选出下一个派发的 (任务, 节点)；没有可派发的组合时返回 None"""
+        free = {id(node) for node in nodes if self._free(node)}
+        if not free or not self.pending:
+            return None
+
+        def free_targets(job: PlannedJob) -> List:
+            return [node for node in self._targets(job, nodes) if id(node) in free]
+
+        oldest = self.pending[0]
+        if time.monotonic() - oldest.enqueued >= self.max_group_wait:
+            targets = free_targets(oldest)
+            if targets:
+                return oldest, min(targets, key=lambda node: score(node, oldest.models))
+        for job in self.pending:
+            same = [node for node in free_targets(job) if job.models and job.models <= node.models]
+            if same:
+                return job, min(same, key=lambda node: node.queue_depth())
+        for job in self.pending:
+            targets = free_targets(job)
+            if targets:
+                return job, min(targets, key=lambda node: score(node, job.models))
+        return None
@@ -0,0 +1,333 @@
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+from config import CONFIG
+
+logger = logging.getLogger(__name__)
+
+# (节点 id, 输入名)
+Target = Tuple[str, str]
+
+
+class WorkflowTemplate:
+    """
+    编译后的 ComfyUI 工作流模板（只读）。
+
+    加载时校验一次图结构，并按节点类型、标题和连线发现可绑定的参数，
+    不再依赖固定的节点 id。bind() 为每个请求生成独立的图：
+    只浅拷贝每个节点及其 inputs，连线列表等不可变部分与模板共享，
+    因此并发请求互不影响，也不需要深拷贝整个 JSON。
+    """
+
+    def __init__(self, name: str, graph: Dict[str, Any]):
+        self.name = name
+        self._graph = graph
+        self._validate()
+        self.output_node = self._find_output_node()
+        self.params: Dict[str, List[Target]] = self._discover_params()
+
+    # 校验与参数发现
+
+    def _validate(self):
+        if not isinstance(self._graph, dict) or not self._graph:
+            raise ValueError(f"Workflow {self.name} is empty or not an API-format graph")
+        for node_id, node in self._graph.items():
+            if not isinstance(node, dict) or not isinstance(node.get("class_type"), str) \
+                    or not isinstance(node.get("inputs"), dict):
+                raise ValueError(f"Workflow {self.name}: node {node_id} needs class_type and inputs")
+            for input_name, value in node["inputs"].items():
+                if self._is_link(value) and str(value[0]) not in self._graph:
+                    raise ValueError(f"Workflow {self.name}: node {node_id}.{input_name} "
+                                     f"links to missing node {value[0]}")
+
+    @staticmethod
+    def _is_link(value: Any) -> bool:
+        return isinstance(value, list) and len(value) == 2 and isinstance(value[1], int)
+
+    def _nodes(self, class_type: str) -> List[str]:
+        return sorted((node_id for node_id, node in self._graph.items()
+                       if node["class_type"] == class_type), key=_node_order)
+
+    def _title(self, node_id: str) -> str:
+        return (self._graph[node_id].get("_meta") or {}).get("title", "").lower()
+
+    def _source(self, node_id: str, input_name: str) -> Optional[str]:
+        value = self._graph[node_id]["inputs"].get(input_name)
+        return str(value[0]) if self._is_link(value) else None
+
+    def _find_output_node(self) -> str:
+        outputs = self._nodes("SaveImage")
+        if len(outputs) != 1:
+            raise ValueError(f"Workflow {self.name} must have exactly one SaveImage node, found {len(outputs)}")
+        return outputs[0]
+
+    def _text_nodes(self, role: str) -> List[str]:
+        """正/负向提示词节点：优先按标题识别，否则按 KSampler 的 positive/negative 连线识别"""
+        encoders = self._nodes("CLIPTextEncode")
+        titled = [n for n in encoders if role in self._title(n)]
+        if titled:
+            return titled
+        linked = {self._source(s, role) for s in self._nodes("KSampler")}
+        return [n for n in encoders if n in linked]
+
+    def _samplers(self) -> Tuple[Optional[str], Optional[str]]:
+        return split_samplers(self._graph)
+
+    def _discover_params(self) -> Dict[str, List[Target]]:
+        params: Dict[str, List[Target]] = {}
+
+        def add(name: str, node_id: Optional[str], input_name: str):
+            if node_id is not None and input_name in self._graph[node_id]["inputs"]:
+                params.setdefault(name, []).append((node_id, input_name))
+
+        positive, negative = self._text_nodes("positive"), self._text_nodes("negative")
+        if not positive or not negative:
+            raise ValueError(f"Workflow {self.name} needs positive and negative CLIPTextEncode nodes")
+        for node_id in positive:
+            add("prompt", node_id, "text")
+        for node_id in negative:
+            add("negative_prompt", node_id, "text")
+
+        latents = self._nodes("EmptyLatentImage")
+        upscales = self._nodes("LatentUpscale")
+        latent = latents[0] if latents else None
+        # 有上采样时 width/height 指最终尺寸，base_width/base_height 指初始潜在空间尺寸
+        final = upscales[0] if upscales else latent
+        add("width", final, "width")
+        add("height", final, "height")
+        if upscales:
+            add("base_width", latent, "width")
+            add("base_height", latent, "height")
+
+        base, hires = self._samplers()
+        for input_name in ("seed", "steps", "cfg", "sampler_name", "scheduler"):
+            add(input_name, base, input_name)
+        for input_name in ("seed", "steps", "cfg", "denoise"):
+            add(f"hires_{input_name}", hires, input_name)
+
+        checkpoints = self._nodes("CheckpointLoaderSimple")
+        add("checkpoint", checkpoints[0] if checkpoints else None, "ckpt_name")
+        loras = self._nodes("LoraLoader")
+        add("lora", loras[0] if loras else None, "lora_name")
+        add("lora_strength", loras[0] if loras else None, "strength_model")
+        add("filename_prefix", self.output_node, "filename_prefix")
+        return params
+
+    # 绑定
+
+    def defaults(self) -> Dict[str, Any]:
+        """模板中各参数的当前取值"""
+        return {name: self._graph[targets[0][0]]["inputs"][targets[0][1]]
+                for name, targets in self.params.items()}
+
+    def bind(self, **values: Any) -> Dict[str, Any]:
+        """返回绑定了参数的独立工作流图；值为 None 的参数保留模板默认值"""
+        unknown = [name for name in values if name not in self.params]
+        if unknown:
+            raise ValueError(f"Workflow {self.name} has no parameter(s): {', '.join(unknown)}")
+        graph = {node_id: dict(node, inputs=dict(node["inputs"]))
+                 for node_id, node in self._graph.items()}
+        for name, value in values.items():
+            if value is None:
+                continue
+            for node_id, input_name in self.params[name]:
+                graph[node_id]["inputs"][input_name] = value
+        return graph
+
+
+def _node_order(node_id: str):
+    return (0, int(node_id), "") if node_id.isdigit() else (1, 0, node_id)
+
+
+def find_output_node(graph: Dict[str, Any], class_type: str = "SaveImage") -> Optional[str]:
+    """已绑定图中 SaveImage（或 class_type 指定的其他输出）节点的 id"""
+    for node_id in sorted(graph, key=_node_order):
+        if graph[node_id].get("class_type") == class_type:
+            return node_id
+    return None
+
+
+# 渲染质量档位：draft 只做首遍采样（首遍分辨率、较少步数）并保存潜在图，final 为完整的两遍渲染
+QUALITIES = ("draft", "final")
+OUTPUT_CLASSES = ("SaveImage", "SaveLatent", "PreviewImage")
+
+
+def split_samplers(graph: Dict[str, Any]) -> Tuple[Optional[str], Optional[str]]:
+    """区分首个采样器和高清修复采样器（标题含 hires / refine，或输入来自上采样）"""
+    base, hires = None, None
+    for node_id in sorted(graph, key=_node_order):
+        node = graph[node_id]
+        if node.get("class_type") != "KSampler":
+            continue
+        title = (node.get("_meta") or {}).get("title", "").lower()
+        latent = node["inputs"].get("latent_image")
+        source = str(latent[0]) if WorkflowTemplate._is_link(latent) else None
+        source_class = graph[source]["class_type"] if source in graph else None
+        if "hires" in title or "refine" in title or source_class in ("LatentUpscale", "LatentUpscaleBy"):
+            hires = hires or node_id
+        else:
+            base = base or node_id
+    return base, hires
+
+
+def _next_id(graph: Dict[str, Any]) -> int:
+    return max((int(node_id) for node_id in graph if str(node_id).isdigit()), default=0) + 1
+
+
+def _relink(graph: Dict[str, Any], source: str, target: str) -> Dict[str, Any]:
+    """复制图，并把所有读取 source 输出的连线改为读取 target"""
+    graph = {node_id: dict(node, inputs=dict(node["inputs"])) for node_id, node in graph.items()}
+    for node in graph.values():
+        for name, value in node["inputs"].items():
+            if WorkflowTemplate._is_link(value) and str(value[0]) == source:
+                node["inputs"][name] = [target, value[1]]
+    return graph
+
+
+def _prune(graph: Dict[str, Any]) -> Dict[str, Any]:
+    """去掉不被任何输出节点用到的节点（例如改线后不再需要的上采样和第二遍采样器）"""
+    keep = set()
+    stack = [node_id for node_id, node in graph.items() if node["class_type"] in OUTPUT_CLASSES]
+    while stack:
+        node_id = stack.pop()
+        if node_id in keep:
+            continue
+        keep.add(node_id)
+        stack.extend(str(value[0]) for value in graph[node_id]["inputs"].values()
+                     if WorkflowTemplate._is_link(value))
+    return {node_id: node for node_id, node in graph.items() if node_id in keep}
+
+
+def draft_workflow(graph: Dict[str, Any], latent_prefix: str) -> Dict[str, Any]:
+    """
+    草稿工作流：去掉高清修复第二遍，直接解码首遍采样结果（首遍分辨率），
+    并用 SaveLatent 保存首遍潜在图，之后可以只补做第二遍（见 upgrade_workflow）。
+    没有第二遍的模板原样返回
+    """
+    base, hires = split_samplers(graph)
+    if base is None or hires is None:
+        return graph
+    graph = _relink(graph, hires, base)
+    graph[str(_next_id(graph))] = {"class_type": "SaveLatent",
+                                   "inputs": {"samples": [base, 0], "filename_prefix": latent_prefix},
+                                   "_meta": {"title": "Draft Latent"}}
+    return _prune(graph)
+
+
+def upgrade_workflow(graph: Dict[str, Any], latent: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    草稿升级工作流：用 LoadLatent 读取草稿保存的首遍潜在图，只运行高清修复第二遍。
+    graph 为同一场景按 final 质量绑定的图，latent 为 SaveLatent 的输出（filename、subfolder、type）；
+    没有第二遍时返回 None
+    """
+    base, hires = split_samplers(graph)
+    if base is None or hires is None:
+        return None
+    name = "/".join(part for part in (latent.get("subfolder"), latent["filename"]) if part)
+    load_id = str(_next_id(graph))
+    graph = _relink(graph, base, load_id)
+    graph[load_id] = {"class_type": "LoadLatent",
+                      "inputs": {"latent": f"{name} [{latent.get('type') or 'output'}]"},
+                      "_meta": {"title": "Draft Latent"}}
+    return _prune(graph)
+
+
+def add_preview_output(graph: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[str]]:
+    """
+    在首个采样器之后加一个低分辨率预览输出（VAEDecode + PreviewImage），
+    首遍采样结束就能看到画面，不必等高清修复和 SaveImage。
+    返回新图和 PreviewImage 节点 id；没有高清修复第二遍或找不到 VAE 时原样返回，id 为 None
+    """
+    base, hires = split_samplers(graph)
+    decoders = [node_id for node_id in sorted(graph, key=_node_order)
+                if graph[node_id].get("class_type") == "VAEDecode"]
+    if base is None or hires is None or not decoders:
+        return graph, None
+    vae = graph[decoders[0]]["inputs"].get("vae")
+    if not WorkflowTemplate._is_link(vae):
+        return graph, None
+    next_id = _next_id(graph)
+    decode_id, preview_id = str(next_id), str(next_id + 1)
+    graph = dict(graph)
+    graph[decode_id] = {"class_type": "VAEDecode", "inputs": {"samples": [base, 0], "vae": vae},
+                        "_meta": {"title": "First Pass Decode"}}
+    graph[preview_id] = {"class_type": "PreviewImage", "inputs": {"images": [decode_id, 0]},
+                         "_meta": {"title": "First Pass Preview"}}
+    return graph, preview_id
+
+
+# 加载模型文件的节点输入；这些值变化时 ComfyUI 需要重新加载模型
+MODEL_INPUTS = ("ckpt_name", "lora_name", "unet_name", "vae_name")
+
+
+def graph_models(graph: Dict[str, Any]) -> FrozenSet[str]:
+    """图中加载的模型文件（如 "ckpt_name:xxx.safetensors"），用于把任务派发到已加载这些模型的节点"""
+    models = set()
+    for node in graph.values():
+        inputs = node.get("inputs") or {}
+        for name in MODEL_INPUTS:
+            if isinstance(inputs.get(name), str):
+                models.add(f"{name}:{inputs[name]}")
+    return frozenset(models)
+
+
+class WorkflowRegistry:
+    """
+    workflows/*.json 模板与风格预设的内存缓存。
+
+    每个模板只加载和校验一次；预设是 "模板名 + 参数默认值" 的组合，
+    在 CONFIG["workflows"]["presets"] 中配置。
+    """
+
+    def __init__(self, directory: str = "workflows",
+                 presets: Optional[Dict[str, Dict[str, Any]]] = None,
+                 default_preset: str = "default"):
+        self.directory = directory
+        self.presets = presets or {}
+        self.default_preset = default_preset
+        self._templates: Dict[str, WorkflowTemplate] = {}
+        self._lock = threading.Lock()
+
+    def template(self, name: str) -> WorkflowTemplate:
+        """按名称（workflows/<name>.json）或路径获取模板"""
+        with self._lock:
+            template = self._templates.get(name)
+            if template is None:
+                path = name if name.endswith(".json") else os.path.join(self.directory, f"{name}.json")
+                with open(path, 'r', encoding='utf-8') as f:
+                    graph = json.load(f)
+                template = WorkflowTemplate(os.path.splitext(os.path.basename(path))[0], graph)
+                logger.info(f"Loaded workflow {template.name}: {', '.join(sorted(template.params))}")
+                self._templates[name] = template
+        return template
+
+    def preset(self, name: Optional[str] = None) -> Tuple[WorkflowTemplate, Dict[str, Any]]:
+        """返回预设对应的模板和参数默认值"""
+        name = name or self.default_preset
+        if name not in self.presets:
+            raise ValueError(f"Unknown workflow preset: {name}")
+        preset = self.presets[name]
+        return self.template(preset["workflow"]), dict(preset.get("params") or {})
+
+    def bind(self, preset: Optional[str] = None, **values: Any) -> Tuple[WorkflowTemplate, Dict[str, Any]]:
+        """按预设绑定参数；请求中显式给出的值覆盖预设默认值"""
+        template, params = self.preset(preset)
+        params.update({k: v for k, v in values.items() if v is not None})
+        return template, template.bind(**params)
+
+
+_registry: Optional[WorkflowRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> WorkflowRegistry:
+    """进程内共享的模板注册表，按 CONFIG["workflows"] 创建"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            settings = CONFIG["workflows"]
+            _registry = WorkflowRegistry(settings["dir"], settings["presets"], settings["default_preset"])
+    return _registry
@@ -112,4 +112,29 @@ class ImageUtils:
                  font=author_font, 
                  fill='black')
         
-        return cover
\ No newline at end of file
+        return cover
+    
+    # 网页派生图：各格式的保存参数
+    WEB_FORMATS = {
+        "avif": ("AVIF", {"speed": 8}),
+        "webp": ("WEBP", {"method": 4}),
+        "jpeg": ("JPEG", {"optimize": True, "progressive": True})
+    }
+    
+    def resize_to_width(self, image: Image.Image, width: int) -> Image.Image:
+        """按宽度等比缩放（不放大）"""
+        if image.width <= width:
+            return image.copy()
+        height = round(image.height * width / image.width)
+        return image.resize((width, height), Image.Resampling.LANCZOS)
+    
+    def save_web_image(self,
+                       image: Image.Image,
+                       path: str,
+                       image_format: str,
+                       quality: int = 80):
+        """以网页格式（avif / webp / jpeg）保存图像"""
+        pil_format, options = self.WEB_FORMATS[image_format]
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.save(path, pil_format, quality=quality, **options)
@@ -0,0 +1,83 @@
+import json
+from typing import Iterator, List, Optional
+
+
+class SceneStreamParser:
+    """
+    增量 JSON 解析器：逐块喂入 LLM 输出的文本，
+    顶层对象中 "scenes" 数组的每个元素一闭合就立即产出。
+
+    只跟踪括号层级和字符串状态，不构建完整的语法树；
+    完整文本保存在 text 中，流结束后仍需整体解析校验。
+    """
+
+    def __init__(self, array_key: str = "scenes"):
+        self.array_key = array_key
+        self.text = ""
+        self._pos = 0
+        self._stack: List[str] = []  # 每层容器的类型：'{' 或 '['，目标数组记为 'S'
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._last_string: Optional[str] = None
+        self._pending_key: Optional[str] = None
+        self._item_start: Optional[int] = None
+        self._root_closed = False
+
+    def feed(self, chunk: str) -> Iterator[dict]:
+        """喂入一段文本，产出新闭合的数组元素"""
+        self.text += chunk
+        text = self.text
+        while self._pos < len(text):
+            i = self._pos
+            ch = text[i]
+            self._pos += 1
+
+            if self._root_closed:
+                continue
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    self._last_string = text[self._string_start:i]
+                continue
+
+            if not self._stack:
+                # 根对象之前的内容（说明文字、代码块标记等）直接跳过
+                if ch == '{':
+                    self._stack.append('{')
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                self._string_start = i + 1
+            elif ch == ':':
+                if self._stack[-1] == '{':
+                    self._pending_key = self._last_string
+            elif ch == ',':
+                self._pending_key = None
+            elif ch in '{[':
+                if (ch == '[' and len(self._stack) == 1
+                        and self._pending_key == self.array_key):
+                    self._stack.append('S')
+                else:
+                    if ch == '{' and self._stack[-1] == 'S':
+                        self._item_start = i
+                    self._stack.append(ch)
+                self._pending_key = None
+            elif ch in '}]':
+                self._stack.pop()
+                if ch == '}' and self._stack and self._stack[-1] == 'S' and self._item_start is not None:
+                    raw = text[self._item_start:i + 1]
+                    self._item_start = None
+                    try:
+                        yield json.loads(raw)
+                    except json.JSONDecodeError:
+                        # 单个元素无法解析时交给最终的整体解析处理
+                        pass
+                if not self._stack:
+                    self._root_closed = True
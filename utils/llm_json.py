@@ -0,0 +1,193 @@
+import json
+import logging
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import CONFIG
+
+logger = logging.getLogger(__name__)
+
+_FENCE = re.compile(r"```(?:json|JSON)?[ \t]*\n?(.*?)(?:```|$)", re.DOTALL)
+# 模型有时用弯引号代替直引号包住键和值
+_SMART_QUOTES = "“”„"
+_CLOSERS = {'{': '}', '[': ']'}
+
+# 后端拒绝 response_format（HTTP 400）后在本进程内不再发送
+_response_format_supported = True
+
+
+class JSONRepairError(ValueError):
+    pass
+
+
+def with_response_format(payload: Dict[str, Any], name: str, schema: Dict[str, Any]) -> Dict[str, Any]:
+    """按配置为补全请求加上 JSON Schema 约束（OpenAI 兼容的 response_format）"""
+    if not (CONFIG["lm_studio"].get("response_format", True) and _response_format_supported):
+        return payload
+    return dict(payload, response_format={
+        "type": "json_schema",
+        "json_schema": {"name": name, "strict": True, "schema": schema}
+    })
+
+
+def response_format_rejected(payload: Dict[str, Any], status: int) -> Optional[Dict[str, Any]]:
+    """
+    带 response_format 的请求返回 400 时，认为后端不支持结构化输出：
+    关闭该功能并返回去掉 response_format 的请求体供调用方重发；否则返回 None
+    """
+    global _response_format_supported
+    if status != 400 or "response_format" not in payload:
+        return None
+    if _response_format_supported:
+        logger.warning("LLM backend rejected response_format, falling back to prompt-only JSON")
+    _response_format_supported = False
+    return {key: value for key, value in payload.items() if key != "response_format"}
+
+
+def _scan(text: str) -> Tuple[List[str], List[str], bool, int]:
+    """
+    逐字符扫描 JSON 文本并做局部修复：弯引号改为直引号、去掉对象和数组结尾多余的逗号、
+    字符串内的裸换行转义。返回 (输出字符, 未闭合的括号栈, 是否停在字符串内,
+    最近一个完整值之后的位置)
+    """
+    out: List[str] = []
+    stack: List[str] = []
+    in_string = False
+    closers = '"'
+    escape = False
+    safe = 0
+    for ch in text:
+        if in_string:
+            if escape:
+                escape = False
+                out.append(ch)
+            elif ch == '\\':
+                escape = True
+                out.append(ch)
+            elif ch in closers:
+                in_string = False
+                out.append('"')
+            elif ch == '\n':
+                out.append('\\n')
+            else:
+                out.append(ch)
+            continue
+        if ch == '"' or ch in _SMART_QUOTES:
+            in_string = True
+            # 直引号字符串里的弯引号是正文；弯引号开头的字符串可以用任意引号结束
+            closers = '"' if ch == '"' else '"' + _SMART_QUOTES
+            out.append('"')
+        elif ch in '{[':
+            stack.append(ch)
+            out.append(ch)
+        elif ch in '}]':
+            _drop_trailing_comma(out)
+            if stack:
+                out.append(_CLOSERS[stack.pop()])
+            if not stack:
+                break  # 顶层对象结束，忽略后面的说明文字
+            safe = len(out)
+        else:
+            out.append(ch)
+            if ch == ',' and stack:
+                safe = len(out)
+    return out, stack, in_string, safe
+
+
+def _drop_trailing_comma(out: List[str]):
+    i = len(out) - 1
+    while i >= 0 and out[i].isspace():
+        i -= 1
+    if i >= 0 and out[i] == ',':
+        del out[i]
+
+
+def _close(out: List[str], stack) -> str:
+    out = list(out)
+    _drop_trailing_comma(out)
+    return ''.join(out) + ''.join(_CLOSERS[ch] for ch in reversed(stack))
+
+
+def _candidates(text: str) -> List[str]:
+    """修复后的候选文本，按改动从小到大排列"""
+    out, stack, in_string, safe = _scan(text)
+    if not stack and not in_string:
+        return [''.join(out)]
+    # 被截断：只有断在两个完整的值之间时才补全括号；断在值中间（未闭合的字符串、
+    # 写了一半的键或数字）时不猜测内容，视为不完整，由调用方请求续写
+    if in_string or ''.join(out[safe:]).strip():
+        return []
+    return [_close(out, stack)]
+
+
+def _strip_fences(text: str) -> str:
+    match = _FENCE.search(text)
+    return match.group(1) if match and '{' in match.group(1) else text
+
+
+def loads_tolerant(text: str) -> Tuple[Any, bool]:
+    """
+    解析模型回复中的第一个 JSON 对象，返回 (数据, 是否经过修复)。
+    严格解析失败时依次处理代码块标记、弯引号、多余逗号、字符串内换行和断在完整值之间的截断；
+    仍无法解析时抛出 JSONRepairError
+    """
+    start = text.find('{')
+    if start < 0:
+        raise JSONRepairError("no JSON object found")
+    try:
+        data, _ = json.JSONDecoder().raw_decode(text, start)
+        return data, False
+    except json.JSONDecodeError as e:
+        strict_error = e
+
+    body = _strip_fences(text)
+    start = body.find('{')
+    if start < 0:
+        start, body = text.find('{'), text
+    for candidate in _candidates(body[start:]):
+        try:
+            return json.loads(candidate, strict=False), True
+        except json.JSONDecodeError:
+            continue
+    raise JSONRepairError(f"{strict_error.msg} (line {strict_error.lineno} column {strict_error.colno})")
+
+
+def finish_reason(result: Optional[Dict[str, Any]]) -> Optional[str]:
+    """补全响应的 finish_reason（"length" 表示达到 max_tokens 被截断）"""
+    return ((result or {}).get('choices') or [{}])[0].get('finish_reason')
+
+
+def looks_truncated(text: str) -> bool:
+    """文本中的 JSON 对象是否没有写完（括号或字符串未闭合）"""
+    body = _strip_fences(text)
+    start = body.find('{')
+    if start < 0:
+        return False
+    _, stack, in_string, _ = _scan(body[start:])
+    return bool(stack) or in_string
+
+
+def followup_payload(payload: Dict[str, Any], previous_text: str, error: str,
+                     truncated: bool) -> Dict[str, Any]:
+    """
+    针对无法使用的回复构造一次补救请求（代替整篇重新生成）：
+    回复被截断时让模型从断点继续写（续写不是完整对象，不带 response_format），
+    否则把错误告诉模型，让它只返回改正后的完整 JSON
+    """
+    if truncated:
+        instruction = ("Your previous reply was cut off. Continue exactly where it stopped, "
+                       "without repeating any of it. Output only the remaining JSON text.")
+        payload = {key: value for key, value in payload.items() if key != "response_format"}
+    else:
+        instruction = (f"Your previous reply could not be used: {error}. "
+                       "Reply with only the corrected, complete JSON object and nothing else.")
+    messages = payload["messages"] + [
+        {"role": "assistant", "content": previous_text},
+        {"role": "user", "content": instruction}
+    ]
+    return dict(payload, messages=messages)
+
+
+def combine_followup(previous_text: str, followup_text: str, truncated: bool) -> str:
+    """续写时拼接两段回复；改正时只用新回复"""
+    return previous_text + followup_text if truncated else followup_text
@@ -0,0 +1,58 @@
+from typing import Any, Dict, List, Optional
+
+from models.character import Character
+from models.story import Story
+
+
+def completed_event(character: Character,
+                    story: Story,
+                    scene_images: List[Optional[str]],
+                    book_path: str,
+                    derivatives=None,
+                    static_files=None) -> Dict[str, Any]:
+    """
+    /generate 最后一条 "completed" 事件的内容（同步与异步引擎共用）。
+    给出 static_files（StaticFiles）时图片地址带内容哈希版本号，可被浏览器长期缓存；
+    给出 derivatives（DerivativeStore）时 image_path 指向网页派生图，
+    image_sources 提供各格式的 srcset，image_original 保留原图地址。
+    会读取图片计算哈希，异步引擎中应放到线程池执行。
+    """
+    scenes = []
+    for scene, image_path in zip(story.scenes, scene_images):
+        version = static_files.version(image_path) if static_files and image_path else None
+        original = static_files.url(image_path, version) if version else image_path
+        item = {
+            'title': scene.title,
+            'description': scene.description,
+            'image_path': original
+        }
+        sources = derivatives.sources(image_path, version) if derivatives else None
+        if sources:
+            item.update(image_path=sources["src"], image_sources=sources, image_original=original)
+        scenes.append(item)
+    return {
+        "status": "completed",
+        "character": {
+            'name': character.name,
+            'age': character.age,
+            'personality': character.personality,
+            'appearance': character.appearance,
+            'backstory': character.backstory
+        },
+        'story': {
+            'title': story.title,
+            'scenes': scenes,
+            'moral': story.moral
+        },
+        'book_path': book_path
+    }
+
+
+def failure_event(message: str, backend=None) -> Dict[str, Any]:
+    """
+    阶段失败时的错误事件（同步与异步引擎共用）。backend 为负责该阶段的后端
+    （客户端或 ComfyUI 节点池，提供 unavailable_event()）：后端不可用时改用后端给出的事件
+    （由 services.resilience.backend_event 构造）说明哪个后端不可用
+    """
+    event = backend.unavailable_event() if backend is not None else None
+    return event or {"error": message}